@@ -0,0 +1,158 @@
+import time
+import asyncio
+import logging
+
+from asynch.tools.utils import create_scid
+
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+# 画质档位, 相对Mobile.config中的max_size, video_bit_rate, max_fps的比例
+ADAPTIVE_PROFILES = (
+    ('high', 1, 1, 1),
+    ('medium', 0.75, 0.5, 0.8),
+    ('low', 0.5, 0.25, 0.6),
+)
+# max_size为0(不限制)时, 降档所用的基准尺寸
+ADAPTIVE_BASE_SIZE = 1280
+
+
+def build_profiles(scrcpy_kwargs):
+    """return [(name, {max_size, video_bit_rate, max_fps}), ...], 从高到低"""
+    profiles = []
+    for name, size_ratio, bit_rate_ratio, fps_ratio in ADAPTIVE_PROFILES:
+        max_size = scrcpy_kwargs.get('max_size') or 0
+        if size_ratio != 1:
+            # 编码器要求尺寸为8的倍数
+            max_size = int((max_size or ADAPTIVE_BASE_SIZE) * size_ratio) // 8 * 8
+        profiles.append((name, {
+            'max_size': max_size,
+            'video_bit_rate': int(scrcpy_kwargs['video_bit_rate'] * bit_rate_ratio),
+            'max_fps': max(int(scrcpy_kwargs['max_fps'] * fps_ratio), 1),
+        }))
+    return profiles
+
+
+class AdaptiveController:
+    """
+    根据订阅者的发送队列延迟、丢帧和实际吞吐量, 在预设的画质档位之间切换, 以新参数重启scrcpy server
+    1.连续degrade_rounds个周期有订阅者延迟超过degrade_latency或丢帧, 降一档
+    2.连续upgrade_rounds个周期所有订阅者延迟低于upgrade_latency且无丢帧, 升一档
+    3.切换后hold_time秒内不再切换; 升档后很快又降档, 下次升档需要的周期数翻倍
+    """
+    # 统计周期,秒
+    interval = 2
+    degrade_latency = 0.5
+    degrade_rounds = 2
+    upgrade_latency = 0.1
+    upgrade_rounds = 8
+    max_upgrade_rounds = 64
+    hold_time = 10
+
+    def __init__(self, hub, scrcpy_kwargs):
+        self.hub = hub
+        self.device_id = hub.device_id
+        self.scrcpy_kwargs = dict(scrcpy_kwargs)
+        self.profiles = build_profiles(scrcpy_kwargs)
+        self.level = 0
+        self.bad_rounds = 0
+        self.good_rounds = 0
+        self.required_good_rounds = self.upgrade_rounds
+        self.switch_time = time.monotonic()
+        self.upgrade_time = None
+        # viewer_stats中的key -> (sent_bytes, dropped_frames)
+        self.last_counters = dict()
+        # 切换记录
+        self.switches = []
+        self.task = None
+
+    @property
+    def profile_name(self):
+        return self.profiles[self.level][0]
+
+    def start(self):
+        logging.info(f"【AdaptiveController】({self.device_id}:{self.hub.device_client.scid}) profiles {self.profiles}")
+        self.task = asyncio.create_task(self._adaptive_task())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def measure(self):
+        """return [(scid, throughput_kbps, queue_latency, dropped_frames), ...]"""
+        measurements = []
+        counters = dict()
+        for subscriber in list(self.hub.subscribers.values()):
+            # 其它worker的RegistryPeer展开为远端上报的各个订阅者, 未上报时不参与统计
+            for key, scid, sent_bytes, dropped_frames, latency in subscriber.viewer_stats():
+                last_sent_bytes, last_dropped_frames = self.last_counters.get(key, (sent_bytes, dropped_frames))
+                counters[key] = (sent_bytes, dropped_frames)
+                throughput = (sent_bytes - last_sent_bytes) * 8 / 1000 / self.interval
+                measurements.append((scid, int(throughput), latency, dropped_frames - last_dropped_frames))
+        self.last_counters = counters
+        return measurements
+
+    def decide(self, measurements):
+        """return (level, reason), 不切换时level为None"""
+        if not measurements:
+            return None, None
+        scid, throughput, latency, dropped = max(measurements, key=lambda item: (item[2], item[3]))
+        reason = f"worst {scid} throughput {throughput}kbps, queue_latency {latency:.3f}s, dropped {dropped}"
+        # 1.链路变差
+        if latency > self.degrade_latency or any(item[3] for item in measurements):
+            self.good_rounds = 0
+            self.bad_rounds += 1
+            if self.bad_rounds >= self.degrade_rounds and self.level < len(self.profiles) - 1:
+                # 刚升档就变差, 说明带宽不足以支撑更高档位
+                if self.upgrade_time and time.monotonic() - self.upgrade_time < self.interval * self.required_good_rounds:
+                    self.required_good_rounds = min(self.required_good_rounds * 2, self.max_upgrade_rounds)
+                return self.level + 1, f"degrade, {reason}"
+        # 2.链路恢复
+        elif latency < self.upgrade_latency:
+            self.bad_rounds = 0
+            self.good_rounds += 1
+            if self.good_rounds >= self.required_good_rounds and self.level > 0:
+                return self.level - 1, f"upgrade after {self.good_rounds} good rounds, {reason}"
+        # 3.两者之间, 保持
+        else:
+            self.bad_rounds = self.good_rounds = 0
+        return None, None
+
+    async def switch(self, level, reason):
+        old_name = self.profile_name
+        name, profile = self.profiles[level]
+        scrcpy_kwargs = dict(self.scrcpy_kwargs, **profile)
+        scid = create_scid()
+        logging.info(f"【AdaptiveController】({self.device_id}:{self.hub.device_client.scid}) switch profile "
+                     f"{old_name} -> {name} {profile}, reason: {reason}")
+        self.switches.append({'time': int(time.time()), 'from': old_name, 'to': name, 'reason': reason})
+        self.switches = self.switches[-20:]
+        self.bad_rounds = self.good_rounds = 0
+        self.last_counters.clear()
+        self.switch_time = time.monotonic()
+        self.upgrade_time = self.switch_time if level < self.level else None
+        self.level = level
+        await self.hub.restart_device_client(scid, scrcpy_kwargs)
+
+    async def _adaptive_task(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            measurements = self.measure()
+            if time.monotonic() - self.switch_time < self.hold_time:
+                continue
+            level, reason = self.decide(measurements)
+            if level is not None:
+                await self.switch(level, reason)
+
+    def stats(self):
+        return {
+            'profile': self.profile_name,
+            'settings': self.profiles[self.level][1],
+            'required_good_rounds': self.required_good_rounds,
+            'switches': self.switches,
+        }
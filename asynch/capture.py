@@ -0,0 +1,175 @@
+import json
+import mmap
+import time
+import struct
+import logging
+
+from asynch.constants import sc_packet_flag
+from asynch.recorder import KeyframeIndex, open_recorder
+from asynch.faststart import faststart
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+# 文件头: video_codec, width, height, audio_codec(无音频时为空)
+CAPTURE_HEADER = struct.Struct('>4sii4s')
+# 记录头: pts, length
+CAPTURE_RECORD = struct.Struct('>QL')
+# length最高位为1表示音频
+CAPTURE_AUDIO_FLAG = 1 << 31
+# mmap写入时每次扩展文件的大小
+CAPTURE_MMAP_CHUNK = 64 * 1024 * 1024
+# 文件写入缓冲
+CAPTURE_BUFFER_SIZE = 1024 * 1024
+
+
+class RawCapture:
+    """
+    原始packet抓取: 不封装, scrcpy的packet按顺序追加写入文件, 之后由manage.py remux离线转为mp4/mkv
+    1.文件格式与extension/test.py一致: CAPTURE_HEADER, 之后每个packet为CAPTURE_RECORD + payload
+      第一条记录为视频配置帧, 有音频时第二条为音频配置帧
+    2.接口与extension.recorder.Recorder一致, 由RecorderWriter的写入线程调用, 缓冲刷盘和mmap扩展不阻塞事件循环
+    3.use_mmap: 按CAPTURE_MMAP_CHUNK扩展文件并通过mmap写入, 关闭时截断到实际大小
+    4.关闭时写入同名.json, 包含meta和起止时间, remux时用于保存Video
+    """
+    def __init__(self, filename, video_audio_info, video_header, audio_header=None, use_mmap=False, meta=None):
+        self.filename = filename
+        self.meta = meta or dict()
+        self.use_mmap = use_mmap
+        self.file = None
+        self.mmap = None
+        self.offset = 0
+        self.start_time = int(time.time())
+        self.finish_time = None
+        self.first_pts = None
+        self.last_pts = None
+        if use_mmap:
+            self.file = open(filename, 'w+b')
+            self.file.truncate(CAPTURE_MMAP_CHUNK)
+            self.mmap = mmap.mmap(self.file.fileno(), CAPTURE_MMAP_CHUNK)
+        else:
+            self.file = open(filename, 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        audio_codec = video_audio_info.get('audio_encoder', '') if audio_header is not None else ''
+        self.append(CAPTURE_HEADER.pack(video_audio_info['video_encode'].encode(), video_audio_info['width'],
+                                        video_audio_info['height'], audio_codec.encode()))
+        self.write_record(video_header[0], video_header[1], 0)
+        if audio_header is not None:
+            self.write_record(audio_header[0], audio_header[1], CAPTURE_AUDIO_FLAG)
+
+    def append(self, data):
+        length = len(data)
+        if self.mmap is None:
+            self.file.write(data)
+        else:
+            if self.offset + length > len(self.mmap):
+                size = len(self.mmap) + max(CAPTURE_MMAP_CHUNK, length)
+                self.file.truncate(size)
+                self.mmap.resize(size)
+            self.mmap[self.offset:self.offset + length] = data
+        self.offset += length
+
+    def write_record(self, pts, data, flag):
+        self.append(CAPTURE_RECORD.pack(pts, len(data) | flag))
+        self.append(data)
+
+    def write_video_packet(self, pts, length, data):
+        self.write_record(pts, data, 0)
+        if not pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+            pts &= sc_packet_flag.SC_PACKET_PTS_MASK
+            if self.first_pts is None:
+                self.first_pts = pts
+            self.last_pts = pts
+        return True
+
+    def write_audio_packet(self, pts, length, data):
+        self.write_record(pts, data, CAPTURE_AUDIO_FLAG)
+        return True
+
+    def tell(self):
+        return self.offset
+
+    @property
+    def duration(self):
+        if self.first_pts is None:
+            return 0
+        return round((self.last_pts - self.first_pts) / 1000000)
+
+    def close_container(self):
+        """return 抓取时长(秒)"""
+        self.finish_time = int(time.time())
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+            self.file.truncate(self.offset)
+        self.file.close()
+        with open(self.filename + '.json', 'w') as f:
+            json.dump(dict(self.meta, start_time=self.start_time, finish_time=self.finish_time,
+                           duration=self.duration), f)
+        logging.info(f"【RawCapture】({self.filename}) closed, size {self.offset}, mmap {self.use_mmap}")
+        return self.duration
+
+
+def read_capture(filename):
+    """
+    读取原始packet文件
+    return video_audio_info, video_header, audio_header, packets; packets为[(typ, pts, data), ...]的迭代器
+    """
+    f = open(filename, 'rb')
+    video_codec, width, height, audio_codec = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))
+    video_audio_info = {
+        'video_encode': video_codec.replace(b'\x00', b'').decode('ascii'),
+        'width': width,
+        'height': height,
+        'audio_encoder': audio_codec.replace(b'\x00', b'').decode('ascii'),
+    }
+
+    def read_record():
+        header = f.read(CAPTURE_RECORD.size)
+        # 抓取进程异常退出时最后一条记录可能不完整
+        if len(header) < CAPTURE_RECORD.size:
+            return None
+        pts, length = CAPTURE_RECORD.unpack(header)
+        data = f.read(length & ~CAPTURE_AUDIO_FLAG)
+        if len(data) < length & ~CAPTURE_AUDIO_FLAG:
+            return None
+        return 'audio' if length & CAPTURE_AUDIO_FLAG else 'video', pts, data
+
+    def packets():
+        with f:
+            while True:
+                record = read_record()
+                if record is None:
+                    break
+                yield record
+
+    video_header = read_record()[1:]
+    audio_header = read_record()[1:] if video_audio_info['audio_encoder'] else None
+    return video_audio_info, video_header, audio_header, packets()
+
+
+def remux_capture(filename, output, recorder_format='mp4', fragmented=False):
+    """
+    原始packet文件转为mp4/mkv, 并生成关键帧索引, mp4的moov移动到文件头, 在remux的进程池中运行
+    return {'filename', 'output', 'duration'}
+    """
+    video_audio_info, video_header, audio_header, packets = read_capture(filename)
+    recorder = open_recorder(output, recorder_format, video_audio_info, video_header, audio_header, fragmented)
+    index = KeyframeIndex.create(output)
+    start_pts = None
+    try:
+        for typ, pts, data in packets:
+            if typ == 'audio':
+                assert recorder.write_audio_packet(pts, len(data), data)
+                continue
+            if not pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+                if start_pts is None:
+                    start_pts = pts & sc_packet_flag.SC_PACKET_PTS_MASK
+                if pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+                    index.add((pts & sc_packet_flag.SC_PACKET_PTS_MASK) - start_pts, recorder.tell())
+            assert recorder.write_video_packet(pts, len(data), data)
+    finally:
+        index.close()
+        duration = recorder.close_container()
+    if recorder_format == 'mp4' and duration:
+        faststart(output)
+    return {'filename': filename, 'output': output, 'duration': duration}
+
@@ -15,6 +15,8 @@ class sc_control_msg_type:
     SC_CONTROL_MSG_TYPE_SET_SCREEN_POWER_MODE = 10
     SC_CONTROL_MSG_TYPE_ROTATE_DEVICE = 11
     SC_CONTROL_MSG_TYPE_INJECT_SWIPE_EVENT = 30
+    SC_CONTROL_MSG_TYPE_INJECT_GESTURE = 31
+    SC_CONTROL_MSG_TYPE_SAVE_REPLAY = 32
 
 
 # ================================
@@ -32,3 +34,20 @@ class sc_copy_key:
     SC_COPY_KEY_NONE = 0
     SC_COPY_KEY_COPY = 1
     SC_COPY_KEY_CUT = 2
+
+
+# ================================
+# sc_packet_flag, frame_meta pts的最高两位
+# ================================
+class sc_packet_flag:
+    SC_PACKET_FLAG_CONFIG = 1 << 63
+    SC_PACKET_FLAG_KEY_FRAME = 1 << 62
+    SC_PACKET_PTS_MASK = SC_PACKET_FLAG_KEY_FRAME - 1
+
+
+# ================================
+# sc_device_msg_type, scrcpy server通过control_socket发送的消息
+# ================================
+class sc_device_msg_type:
+    SC_DEVICE_MSG_TYPE_CLIPBOARD = 0
+    SC_DEVICE_MSG_TYPE_ACK_CLIPBOARD = 1
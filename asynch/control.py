@@ -0,0 +1,251 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from asynch.constants import sc_control_msg_type, sc_device_msg_type
+from asynch.constants.input import android_motionevent_action
+from asynch.serializers import split_control_data
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+def get_move_touch_id(data, start, end):
+    """touch move消息返回touch_id, 其它消息返回None"""
+    if (end - start == 32 and data[start] == sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT
+            and data[start + 1] == android_motionevent_action.AMOTION_EVENT_ACTION_MOVE):
+        return bytes(data[start + 2:start + 10])
+    return None
+
+
+class ControlWriter:
+    """
+    control_socket的写入队列和写入task, 注入方只入队不等待drain
+    1.socket写入阻塞期间, 同一touch_id的move只保留最新一个, 中间没有down、up等非move消息才合并
+      其它touch_id的move不阻止合并, 各touch_id的轨迹相互独立, 多指手势的move顺序不影响结果
+    2.down、up、按键等其它消息按顺序写入, 不合并不丢弃
+    3.每次写入把队列中所有消息合并为一次write
+    4.写入失败或control_socket已关闭时无法保证消息送达, 关闭投屏会话, 之后的注入raise ConnectionError
+    """
+    # 队列中的消息超过该值时, 注入方等待写入
+    max_pending = 256
+
+    def __init__(self, device_client):
+        self.device = device_client
+        # [[data, touch_id, enqueue_time], ...]
+        self.queue = deque()
+        self.queue_event = asyncio.Event()
+        self.drained_event = asyncio.Event()
+        # touch_id -> 队列中尚未写入的move
+        self.pending_moves = dict()
+        # 统计
+        self.queued_msgs = 0
+        self.written_msgs = 0
+        self.written_batches = 0
+        self.coalesced_msgs = 0
+        self.lost_msgs = 0
+        self.error = None
+        self.max_queue_depth = 0
+        # 消息入队到写入完成的时间(秒), 指数平均和最大值
+        self.write_latency = 0
+        self.max_write_latency = 0
+        self.write_task = asyncio.create_task(self._write_task())
+
+    async def put(self, data):
+        if self.error:
+            raise ConnectionError(f"control writer closed by {type(self.error).__name__}: {self.error}")
+        for _, start, end in split_control_data(data, limit=False):
+            touch_id = get_move_touch_id(data, start, end)
+            msg = data[start:end] if start or end != len(data) else data
+            self.queued_msgs += 1
+            # 1.move, 覆盖队列中同一touch_id尚未写入的move
+            if touch_id is not None:
+                entry = self.pending_moves.get(touch_id)
+                if entry is not None:
+                    entry[0] = msg
+                    self.coalesced_msgs += 1
+                    continue
+                entry = [msg, touch_id, time.monotonic()]
+                self.pending_moves[touch_id] = entry
+            # 2.其它消息, 之前的move不能再被合并, 否则会越过该消息
+            else:
+                entry = [msg, None, time.monotonic()]
+                self.pending_moves.clear()
+            self.queue.append(entry)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self.queue_event.set()
+        # 3.写入跟不上且无法合并时, 注入方等待
+        while len(self.queue) >= self.max_pending and not self.write_task.done():
+            self.drained_event.clear()
+            await self.drained_event.wait()
+
+    async def flush(self):
+        """等待队列中的消息全部写入"""
+        while (self.queue or self.queue_event.is_set()) and not self.write_task.done():
+            self.drained_event.clear()
+            await self.drained_event.wait()
+
+    async def _write_task(self):
+        while True:
+            if not self.queue:
+                self.drained_event.set()
+                self.queue_event.clear()
+                await self.queue_event.wait()
+                continue
+            batch = [entry[0] for entry in self.queue]
+            enqueue_time = self.queue[0][2]
+            self.queue.clear()
+            self.pending_moves.clear()
+            try:
+                async with self.device.device_lock:
+                    if not self.device.control_socket:
+                        raise ConnectionError("control socket closed")
+                    await self.device.control_socket.write(b''.join(batch))
+            except Exception as e:
+                self.error = e
+                self.lost_msgs += len(batch) + len(self.queue)
+                self.queue.clear()
+                self.pending_moves.clear()
+                self.drained_event.set()
+                logging.error(f"【ControlWriter】({self.device.device_id}:{self.device.scid}) write error {type(e)}: {e}, "
+                              f"{self.lost_msgs} msgs lost, close session")
+                # 与video task结束时一致, 关闭所有ws_client
+                await self.device.hub.close_ws_clients()
+                return
+            self.written_msgs += len(batch)
+            self.written_batches += 1
+            latency = time.monotonic() - enqueue_time
+            self.write_latency = self.write_latency * 0.9 + latency * 0.1
+            self.max_write_latency = max(self.max_write_latency, latency)
+
+    async def close(self):
+        self.write_task.cancel()
+        try:
+            await self.write_task
+        except asyncio.CancelledError:
+            pass
+        self.queue.clear()
+        self.pending_moves.clear()
+        self.drained_event.set()
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.queue),
+            'max_queue_depth': self.max_queue_depth,
+            'queued_msgs': self.queued_msgs,
+            'written_msgs': self.written_msgs,
+            'written_batches': self.written_batches,
+            'coalesced_msgs': self.coalesced_msgs,
+            'lost_msgs': self.lost_msgs,
+            'write_latency': round(self.write_latency, 4),
+            'max_write_latency': round(self.max_write_latency, 4),
+            'error': str(self.error) if self.error else None,
+        }
+
+
+class ControlReader:
+    """
+    control_socket的读取task, 解析scrcpy server发送的消息并交给等待方
+    1.clipboard: type(1) + length(4) + text, 按请求顺序交给等待中的get_clipboard, 无等待方时为设备剪切板变化
+    2.ack_clipboard: type(1) + sequence(8), 交给等待该sequence的set_clipboard
+    """
+    def __init__(self, device_client):
+        self.device = device_client
+        self.control_socket = device_client.control_socket
+        # 等待clipboard的future, 按请求顺序
+        self.clipboard_waiters = deque()
+        # sequence -> 等待ack的future, 前端的sequence可能重复, 按请求顺序
+        self.ack_waiters = dict()
+        # 设备主动发送的最近一次剪切板
+        self.last_clipboard = None
+        # 统计
+        self.clipboard_msgs = 0
+        self.ack_msgs = 0
+        self.unsolicited_msgs = 0
+        # 剪切板请求往返时间(秒)
+        self.clipboard_rtt = None
+        self.read_task = asyncio.create_task(self._read_task())
+
+    def wait_clipboard(self):
+        future = asyncio.get_running_loop().create_future()
+        self.clipboard_waiters.append(future)
+        return future
+
+    def wait_ack(self, sequence):
+        future = asyncio.get_running_loop().create_future()
+        self.ack_waiters.setdefault(sequence, deque()).append(future)
+        return future
+
+    async def request(self, inject, future, timeout):
+        """inject: 注入请求的协程, 注入后等待回复; 超时后取消future, 之后到达的回复交给下一个等待方"""
+        start_time = time.monotonic()
+        try:
+            await inject
+            reply = await asyncio.wait_for(future, timeout)
+        finally:
+            if not future.done():
+                future.cancel()
+        self.clipboard_rtt = time.monotonic() - start_time
+        return reply
+
+    @staticmethod
+    def resolve(waiters, result):
+        """交给最早的未超时等待方, return 是否有等待方"""
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(result)
+                return True
+        return False
+
+    def on_clipboard(self, text):
+        self.clipboard_msgs += 1
+        if not self.resolve(self.clipboard_waiters, text):
+            self.unsolicited_msgs += 1
+            self.last_clipboard = text
+
+    def on_ack(self, sequence):
+        self.ack_msgs += 1
+        waiters = self.ack_waiters.pop(sequence, None)
+        if waiters and self.resolve(waiters, sequence) and waiters:
+            self.ack_waiters[sequence] = waiters
+
+    async def _read_task(self):
+        try:
+            while True:
+                msg_type = (await self.control_socket.read_exactly(1))[0]
+                if msg_type == sc_device_msg_type.SC_DEVICE_MSG_TYPE_CLIPBOARD:
+                    length = int.from_bytes(await self.control_socket.read_exactly(4), 'big')
+                    self.on_clipboard(await self.control_socket.read_exactly(length))
+                elif msg_type == sc_device_msg_type.SC_DEVICE_MSG_TYPE_ACK_CLIPBOARD:
+                    self.on_ack(int.from_bytes(await self.control_socket.read_exactly(8), 'big'))
+                else:
+                    # 未知消息无法确定长度, 后续数据无法解析
+                    logging.error(f"【ControlReader】({self.device.device_id}:{self.device.scid}) unknown device msg_type {msg_type}")
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.info(f"【ControlReader】({self.device.device_id}:{self.device.scid}) control socket closed {type(e)}")
+        finally:
+            self.cancel_waiters()
+
+    def cancel_waiters(self):
+        for future in [*self.clipboard_waiters, *(future for waiters in self.ack_waiters.values() for future in waiters)]:
+            if not future.done():
+                future.cancel()
+        self.clipboard_waiters.clear()
+        self.ack_waiters.clear()
+
+    async def close(self):
+        self.read_task.cancel()
+        try:
+            await self.read_task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self):
+        return {
+            'clipboard_msgs': self.clipboard_msgs,
+            'ack_msgs': self.ack_msgs,
+            'unsolicited_msgs': self.unsolicited_msgs,
+            'clipboard_rtt': round(self.clipboard_rtt, 4) if self.clipboard_rtt is not None else None,
+        }
+
@@ -1,14 +1,22 @@
 import os
 import json
+import math
+import time
 import struct
+import hashlib
 import logging
 import asyncio
-import datetime
 
 from asynch.tools.adb import AsyncAdbDevice
-from asynch.serializers import format_audio_data
-from django_scrcpy.settings import MEDIA_ROOT, BASE_DIR
-from asynch.constants import sc_control_msg_type, sc_copy_key, sc_screen_power_mode
+from asynch.control import ControlWriter, ControlReader
+from asynch.gesture import Gesture, MAX_TICKS, MAX_DURATION
+from asynch.recorder import RecorderWriter, KeyframeIndex, open_recorder, save_video
+from asynch.capture import RawCapture
+from asynch.faststart import FaststartQueue
+from asynch.serializers import AUDIO_DATA_PREFIX, CONTROL_MSG_VAR_LENGTH, utf8_truncate_index
+from asynch.tools.cache import ReplayBuffer
+from django_scrcpy.settings import MEDIA_ROOT, BASE_DIR, DEPLOY_CACHE_TTL, CAPTURE_MMAP
+from asynch.constants import sc_control_msg_type, sc_copy_key, sc_screen_power_mode, sc_packet_flag
 from asynch.constants.input import android_metastate, android_keyevent_action, android_motionevent_action, \
     android_motionevent_buttons
 logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
@@ -17,17 +25,39 @@ logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelnam
 class DeviceController:
     def __init__(self, device_client):
         self.device = device_client
+        # control_socket写入队列, 第一次注入时创建
+        self.writer = None
+        # control_socket读取task, 连接后创建
+        self.reader = None
+        # 等待设备回复的超时时间,秒
+        self.reply_timeout = 1
 
-    async def empty_control_socket(self, interval=0.02, loop=10):
-        for idx in range(loop):
-            try:
-                await asyncio.wait_for(self.device.control_socket.read(0x10000), timeout=interval)
-            except:
-                return
+    def start_reader(self):
+        self.reader = ControlReader(self.device)
 
     async def inject(self, msg):
-        async with self.device.device_lock:
-            await self.device.control_socket.write(msg)
+        """入队后立即返回, 由ControlWriter按顺序写入, 写入阻塞期间合并touch move"""
+        if self.writer is None:
+            self.writer = ControlWriter(self.device)
+        await self.writer.put(msg)
+
+    async def flush(self):
+        if self.writer:
+            await self.writer.flush()
+
+    async def close(self):
+        if self.writer:
+            await self.writer.close()
+            self.writer = None
+        if self.reader:
+            await self.reader.close()
+            self.reader = None
+
+    def stats(self):
+        return {
+            'writer': self.writer.stats() if self.writer else None,
+            'reader': self.reader.stats() if self.reader else None,
+        }
 
     async def inject_without_lock(self, msg):
         await self.device.control_socket.write(msg)
@@ -48,10 +78,18 @@ class DeviceController:
     async def inject_text(self, text):
         """
         inject_data: lens 5 + *
+        超过scrcpy server的最大长度(300字节)时按字符边界拆分为多条消息
         """
         msg_type = sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT
+        max_length = CONTROL_MSG_VAR_LENGTH[msg_type][1]
         buffer = text.encode("utf-8")
-        inject_data = struct.pack(">BI", msg_type, len(buffer)) + buffer
+        inject_data = b''
+        while True:
+            index = utf8_truncate_index(buffer, max_length)
+            inject_data += struct.pack(">BI", msg_type, index) + buffer[:index]
+            buffer = buffer[index:]
+            if not buffer:
+                break
         await self.inject(inject_data)
         return inject_data
 
@@ -106,17 +144,14 @@ class DeviceController:
         """
         msg_type = sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD
         inject_data = struct.pack(">BB", msg_type, copy_key)
-        async with self.device.device_lock:
-            await self.empty_control_socket()
-            await self.inject_without_lock(inject_data)
-            try:
-                # 剪切板为空时，此处为堵塞
-                _meta = await asyncio.wait_for(self.device.control_socket.read_exactly(5), 1)
-                msg_type, msg_lens = struct.unpack('>BI', _meta)
-                return await self.device.control_socket.read_exactly(msg_lens)
-            except Exception as e:
-                print(f'no clipborad ! {e}')
-                return b''
+        if not self.reader:
+            return b''
+        try:
+            # 剪切板为空时，设备不回复，等待超时
+            return await self.reader.request(self.inject(inject_data), self.reader.wait_clipboard(), self.reply_timeout)
+        except Exception as e:
+            logging.error(f"【DeviceController】({self.device.device_id}:{self.device.scid}) no clipboard {type(e)}")
+            return b''
 
     async def set_clipboard(self, text, sequence=1, paste=True):
         """
@@ -126,12 +161,19 @@ class DeviceController:
         """
         msg_type = sc_control_msg_type.SC_CONTROL_MSG_TYPE_SET_CLIPBOARD
         byte_data = text.encode("utf-8")
+        # 与scrcpy客户端一致, 超过最大长度时按字符边界截断
+        byte_data = byte_data[:utf8_truncate_index(byte_data, CONTROL_MSG_VAR_LENGTH[msg_type][1])]
         inject_data = struct.pack(">BQ?I", msg_type, sequence, paste, len(byte_data)) + byte_data
-        async with self.device.device_lock:
-            await self.empty_control_socket()
-            await self.inject_without_lock(inject_data)
-            sequence = (await self.device.control_socket.read_exactly(9))[1:]
-            return sequence
+        # sequence为0时设备不回复
+        if not sequence or not self.reader:
+            await self.inject(inject_data)
+            return b''
+        try:
+            sequence = await self.reader.request(self.inject(inject_data), self.reader.wait_ack(sequence), self.reply_timeout)
+            return struct.pack('>Q', sequence)
+        except Exception as e:
+            logging.error(f"【DeviceController】({self.device.device_id}:{self.device.scid}) set clipboard no ack {type(e)}")
+            return b''
 
     async def set_screen_power_mode(self, screen_power_mode=sc_screen_power_mode.SC_SCREEN_POWER_MODE_NORMAL):
         """
@@ -139,55 +181,46 @@ class DeviceController:
         """
         msg_type = sc_control_msg_type.SC_CONTROL_MSG_TYPE_SET_SCREEN_POWER_MODE
         inject_data = struct.pack(">BB", msg_type, screen_power_mode)
-        await self.inject_without_lock(inject_data)
+        await self.inject(inject_data)
         return inject_data
 
+    async def play_gesture(self, gesture):
+        """按预先计算的轨迹播放手势, return 实际耗时(秒)"""
+        return await gesture.play(self)
+
     async def swipe(self, x, y, end_x, end_y, resolution, unit=5, delay=1):
         """
         swipe (x,y) to (end_x, end_y), 匀速移动，每unit个像素点出发一次touch move事件
+        delay为总时长, move事件数与原实现一致; 每步时长小于MIN_TICK时按MIN_TICK, 总时长相应变长
         """
-        x_1, y_1 = x, y
-        end_x, end_y = min(end_x, resolution[0]), min(end_y, resolution[1])
-        step = 1
-        while True:
-            if x_1 > end_x:
-                x_1 -= min(x-end_x, unit)
-            elif x_1 < end_x:
-                x_1 += min(end_x-x_1, unit)
-            if y_1 > end_y:
-                y_1 -= min(y_1-end_y, unit)
-            elif y < end_y:
-                y_1 += min(end_y-y_1, unit)
-            if x_1 == end_x and y_1 == end_y:
-                break
-            step += 1
-        unit_delay = delay/step
-        await self.inject_touch_event(x, y, resolution, android_motionevent_action.AMOTION_EVENT_ACTION_DOWN)
-        while True:
-            if x > end_x:
-                x -= min(x-end_x, unit)
-            elif x < end_x:
-                x += min(end_x-x, unit)
-            if y > end_y:
-                y -= min(y-end_y, unit)
-            elif y < end_y:
-                y += min(end_y-y, unit)
-            await self.inject_touch_event(x, y, resolution, android_motionevent_action.AMOTION_EVENT_ACTION_MOVE)
-            await asyncio.sleep(unit_delay)
-            if x == end_x and y == end_y:
-                await self.inject_touch_event(x, y, resolution, android_motionevent_action.AMOTION_EVENT_ACTION_UP)
-                break
+        # unit、delay来自ws消息, 非正数或NaN时unit按1像素、delay按0, 避免除零
+        unit = unit if unit > 0 else 1
+        delay = delay if delay > 0 else 0
+        steps = max(math.ceil(max(abs(end_x - x), abs(end_y - y)) / unit), 1)
+        steps = min(steps, MAX_TICKS - 1)
+        gesture = Gesture(resolution, tick=delay / steps)
+        end = (min(end_x, resolution[0]), min(end_y, resolution[1]))
+        gesture.line((x, y), end, min(steps * gesture.tick, MAX_DURATION))
+        return await self.play_gesture(gesture)
 
 
 class DeviceClient:
     # socket超时时间,毫秒
     connect_timeout = 300
-
-    def __init__(self, ws_client, scid):
+    # scrcpy-server jar
+    server_file_path = os.path.join(BASE_DIR, "asset/scrcpy-server-v2.1.1")
+    server_file_info = None
+    # 部署缓存, (device_id, jar_sha1) -> 上次确认设备上jar有效的时间
+    deploy_cache = dict()
+    # 本进程中正在录制的文件
+    recording_files = set()
+
+    def __init__(self, hub, scid, scrcpy_kwargs):
         # scrcpy参数
-        self.scrcpy_kwargs = json.loads(ws_client.query_params['config'][0])
+        self.raw_scrcpy_kwargs = dict(scrcpy_kwargs)
+        self.scrcpy_kwargs = scrcpy_kwargs
         # devices
-        self.device_id = ws_client.device_id
+        self.device_id = hub.device_id
         self.adb_device = AsyncAdbDevice(self.device_id)
         # 单个安卓设备上scrcpy进程的投屏id
         self.scrcpy_kwargs['scid'] = self.scid = scid
@@ -205,10 +238,15 @@ class DeviceClient:
         self.resolution = None
         # 设备控制并发锁
         self.device_lock = asyncio.Lock()
+        # scrcpy server就绪, 由deploy_socket的日志触发
+        self.server_ready = asyncio.Event()
+        # 启动各阶段耗时(从开始启动算起), 毫秒
+        self.start_time = None
+        self.start_timings = dict()
         # 设备控制器
         self.controller = DeviceController(self)
-        # 需要推流的ws_client
-        self.ws_client = ws_client
+        # 推流中心，负责向多个ws_client分发数据
+        self.hub = hub
         # 音视频信息
         self.video_audio_info = dict()
         # 录屏相关
@@ -216,6 +254,25 @@ class DeviceClient:
         self.recorder_format = self.scrcpy_kwargs.pop('recorder_format', None)
         self.recorder_filename = os.path.join(MEDIA_ROOT, 'video', f"{self.device_id}_{self.scid}.{self.recorder_format}")
         self.recorder = None
+        # 原始packet抓取时, 即时回放等仍需封装的录屏使用mp4
+        self.mux_format = 'mp4' if self.recorder_format == 'raw' else self.recorder_format
+        self.recorder_fragmented = self.scrcpy_kwargs.pop('recorder_fragmented', None) and self.mux_format == 'mp4'
+        self.recorder_segment_time = self.scrcpy_kwargs.pop('recorder_segment_time', None) or 0
+        self.recorder_segment_size = self.scrcpy_kwargs.pop('recorder_segment_size', None) or 0
+        # 分段保存Video的future
+        self.segment_futures = []
+        # 即时回放
+        replay_time = self.scrcpy_kwargs.pop('replay_time', None) or 0
+        replay_size = self.scrcpy_kwargs.pop('replay_size', None) or 0
+        self.replay = ReplayBuffer(replay_time, replay_size * 1024 * 1024) if replay_time else None
+        self.replay_count = 0
+        # 自适应画质, 由DeviceHub中的AdaptiveController切换
+        self.adaptive_enable = self.scrcpy_kwargs.pop('adaptive_enable', None)
+        self.scrcpy_kwargs.pop('warm_pool', None)
+        self.scrcpy_kwargs.pop('headless_record', None)
+        self.scrcpy_kwargs.pop('headless_schedule', None)
+        # 是否使用预热池中已启动的scrcpy server
+        self.warm_start = False
 
     async def cancel_task(self, task):
         logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) task cancel {task}")
@@ -239,13 +296,53 @@ class DeviceClient:
         shell_socket = await self.adb_device.create_shell_socket(command)
         return shell_socket
 
+    @classmethod
+    def get_server_file_info(cls):
+        """jar的sha1、大小和修改时间, 进程内只计算一次"""
+        if cls.server_file_info is None:
+            with open(cls.server_file_path, 'rb') as f:
+                sha1 = hashlib.sha1(f.read()).hexdigest()
+            cls.server_file_info = {
+                'sha1': sha1,
+                'size': os.path.getsize(cls.server_file_path),
+                # 设备上jar的修改时间由sha1得出, 多台服务器部署同一jar时结果一致, 不会互相覆盖推送
+                'mtime': int(sha1[:7], 16),
+                # 设备上的文件名带上hash, 不同版本的jar互不覆盖
+                'device_path': f"/data/local/tmp/scrcpy-server-{sha1[:12]}.jar",
+            }
+        return cls.server_file_info
+
+    async def push_server(self):
+        """设备上没有jar或jar已过期时才推送, return 是否推送"""
+        info = self.get_server_file_info()
+        cache_key = (self.device_id, info['sha1'])
+        # 1.缓存有效期内不再校验
+        checked_time = self.deploy_cache.get(cache_key)
+        if checked_time and time.time() - checked_time < DEPLOY_CACHE_TTL:
+            return False
+        # 2.一次STAT校验大小和修改时间
+        device_stat = await self.adb_device.stat(info['device_path'])
+        device_mtime = int(device_stat['mtime'].timestamp()) if device_stat['mtime'] else None
+        pushed = device_stat['size'] != info['size'] or device_mtime != info['mtime']
+        # 3.推送时设置修改时间, 作为下次校验依据; 已用STAT校验, 推送后不再重复校验
+        if pushed:
+            await self.adb_device.push_file(self.server_file_path, info['device_path'], check=False, mtime=info['mtime'])
+        self.deploy_cache[cache_key] = time.time()
+        return pushed
+
+    def invalidate_deploy_cache(self):
+        if self.server_file_info:
+            self.deploy_cache.pop((self.device_id, self.server_file_info['sha1']), None)
+
     async def deploy_server(self):
         # 1.推送jar包
-        server_file_path = os.path.join(BASE_DIR, "asset/scrcpy-server-v2.1.1")
-        await self.adb_device.push_file(server_file_path, "/data/local/tmp/scrcpy-server.jar")
+        start_time = time.perf_counter()
+        pushed = await self.push_server()
+        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) {'push' if pushed else 'reuse'} scrcpy-server, "
+                     f"cost {(time.perf_counter() - start_time) * 1000:.0f}ms")
         # 2.启动一个adb socket去部署scrcpy_server
         commands = [
-            "CLASSPATH=/data/local/tmp/scrcpy-server.jar",
+            f"CLASSPATH={self.get_server_file_info()['device_path']}",
             "app_process",
             "/",
             "com.genymobile.scrcpy.Server",
@@ -254,20 +351,35 @@ class DeviceClient:
         ]
         self.deploy_socket = await self.shell(commands)
 
+    def mark_timing(self, phase):
+        if self.start_time is None:
+            return
+        self.start_timings[phase] = int((time.perf_counter() - self.start_time) * 1000)
+
     async def create_socket(self):
-        # 1.video_socket
+        # 1.video_socket, 等待server就绪
         socket_name = 'localabstract:scrcpy_%s' % self.scrcpy_kwargs['scid']
-        self.video_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout)
-        dummy_byte = await self.video_socket.read_exactly(1)
+        self.video_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout,
+                                                                           ready=self.server_ready)
+        self.mark_timing('first_socket')
+        # 2.server按video、audio、control的顺序accept, video_socket连接后即可建立其它socket, 同时读取dummy_byte
+        dummy_byte_task = asyncio.create_task(self.video_socket.read_exactly(1))
+        try:
+            # 3.audio_socket
+            if self.scrcpy_kwargs['audio']:
+                self.audio_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout)
+            # 4.control_socket
+            if self.scrcpy_kwargs['control']:
+                self.control_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout)
+        except BaseException:
+            dummy_byte_task.cancel()
+            raise
+        self.mark_timing('sockets')
+        dummy_byte = await dummy_byte_task
+        self.mark_timing('dummy_byte')
         if not len(dummy_byte) or dummy_byte != b"\x00":
             raise ConnectionError("not receive Dummy Byte")
-        # 2.audio_socket
-        if self.scrcpy_kwargs['audio']:
-            self.audio_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout)
-        # 3.control_socket
-        if self.scrcpy_kwargs['control']:
-            self.control_socket = await self.adb_device.create_connection_socket(socket_name, timeout=self.connect_timeout)
-        # 4.metadata
+        # 5.metadata
         self.device_name = (await self.video_socket.read_exactly(64)).decode("utf-8").rstrip("\x00")
         video_info = (await self.video_socket.read_exactly(12))
         self.video_audio_info['video_encode'] = video_info[:4].replace(b'\x00', b'').decode('ascii')
@@ -281,149 +393,280 @@ class DeviceClient:
                 self.audio_socket = None
             else:
                 self.video_audio_info['audio_encoder'] = accept_audio_encode.replace(b'\x00', b'').decode('ascii')
+        self.mark_timing('metadata')
+        # control_socket的设备消息由ControlReader读取
+        if self.control_socket:
+            self.controller.start_reader()
+        # 6.之后的音视频数据由FrameDemuxer解包, 音频数据直接带上发送前缀
+        self.video_socket.attach_demuxer()
+        if self.audio_socket:
+            self.audio_socket.attach_demuxer(prefix=AUDIO_DATA_PREFIX)
 
     async def _deploy_task(self):
-        while True:
-            data = await self.deploy_socket.read_string_line()
-            if not data:
-                break
-            logging.info(f"【DeviceClient】({self.device_id}:{self.scid})" + data.rstrip('\r\n').rstrip('\n'))
+        try:
+            while True:
+                data = await self.deploy_socket.read_string_line()
+                if not data:
+                    break
+                # server打印设备信息后立即打开LocalServerSocket, 此时开始连接
+                if not self.server_ready.is_set() and 'Device:' in data:
+                    self.mark_timing('server_ready')
+                    self.server_ready.set()
+                logging.info(f"【DeviceClient】({self.device_id}:{self.scid})" + data.rstrip('\r\n').rstrip('\n'))
+        finally:
+            # server已退出或日志不可用, 连接时不再等待日志
+            self.server_ready.set()
 
     async def _video_task(self):
         try:
             while True:
-                # 1.读取frame_meta
-                frame_meta = await self.video_socket.read_exactly(12)
-                pts = struct.unpack('>Q', frame_meta[:8])[0]
-                data_length = struct.unpack('>L', frame_meta[8:])[0]
-                current_nal_data = await self.video_socket.read_exactly(data_length)
-                # 2.向录屏工具写入 当前nal
-                self.write_recoder(pts, data_length, current_nal_data, typ='video')
+                # 1.读取frame
+                pts, current_nal_data = await self.video_socket.read_frame()
+                # 2.向录屏线程写入 当前nal
+                self.write_recoder(pts, current_nal_data, typ='video')
+                if self.replay is not None:
+                    self.replay.put_video(pts, current_nal_data)
                 # 3.向前端发送当前nal
-                await self.ws_client.send(bytes_data=current_nal_data)
+                self.hub.publish_video(pts, current_nal_data)
         finally:
-            # 多次调用ws-close，有且只有一次会生效，所以ws-client的disconnect方法只会执行一次，即stop方法只执行一次
-            await self.ws_client.close()
+            # 关闭所有ws_client，最后一个ws_client断开时hub执行stop方法
+            await self.hub.close_ws_clients()
 
     async def _audio_task(self):
         is_raw = self.scrcpy_kwargs['audio_codec'] == 'raw'
         is_opus = self.scrcpy_kwargs['audio_codec'] == 'opus'
         is_acc = self.scrcpy_kwargs['audio_codec'] == 'aac'
+        prefix_length = len(AUDIO_DATA_PREFIX)
         try:
             while True:
-                # 1.读取frame_meta
-                frame_meta = await self.audio_socket.read_exactly(12)
-                pts = struct.unpack('>Q', frame_meta[:8])[0]
-                data_length = struct.unpack('>L', frame_meta[8:])[0]
-                current_nal_data = await self.audio_socket.read_exactly(data_length)
-                # 2.向录屏工具写入当前nal
-                self.write_recoder(pts, data_length, current_nal_data, typ='audio')
+                # 1.读取frame, audio_data带有发送前缀
+                pts, audio_data = await self.audio_socket.read_frame()
+                current_nal_data = memoryview(audio_data)[prefix_length:]
+                # 2.向录屏线程写入当前nal
+                if self.recorder:
+                    self.write_recoder(pts, current_nal_data, typ='audio')
+                if self.replay is not None:
+                    self.replay.put_audio(pts, current_nal_data)
                 # 3.向前端发送当前nal
                 # any(b'\x00\x00') is False
                 if is_raw and (not any(current_nal_data)):
                     continue
                 elif is_opus and (current_nal_data == b'\xfc\xff\xfe'):
                     continue
-                elif is_acc and (current_nal_data.find(b'ZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZ')>=0):
+                elif is_acc and (audio_data.find(b'ZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZ', prefix_length)>=0):
                     continue
-                await self.ws_client.send(bytes_data=format_audio_data(current_nal_data))
+                self.hub.publish_audio(pts, audio_data)
         finally:
-            # 多次调用ws-close，有且只有一次会生效，所以ws-client的disconnect方法只会执行一次，即stop方法只执行一次
-            await self.ws_client.close()
+            # 关闭所有ws_client，最后一个ws_client断开时hub执行stop方法
+            await self.hub.close_ws_clients()
 
     # check login state
     async def check_login_task(self):
         while True:
             await asyncio.sleep(5)
-            if not await self.ws_client.check_login():
+            for subscriber in list(self.hub.subscribers.values()):
+                if subscriber.ws_client:
+                    await subscriber.ws_client.check_login()
+            if not self.hub.subscribers:
                 return
             if not self.video_socket:
                 return
 
     async def handle_first_config_nal(self):
         # 1.video_config_packet
-        frame_meta = await self.video_socket.read_exactly(12)
-        pts = struct.unpack('>Q', frame_meta[:8])[0]
-        data_length = struct.unpack('>L', frame_meta[8:])[0]
-        video_config_nal = await self.video_socket.read_exactly(data_length)
-        await self.ws_client.send(bytes_data=video_config_nal)
-        self.video_audio_info['video_header'] = [pts, data_length, video_config_nal]
+        pts, video_config_nal = await self.video_socket.read_frame()
+        self.hub.publish_video(pts, video_config_nal)
+        self.video_audio_info['video_header'] = [pts, len(video_config_nal), video_config_nal]
+        if self.replay is not None:
+            self.replay.put_video(pts, video_config_nal)
         # 2.audio_config_packet
         if self.scrcpy_kwargs['audio']:
-            frame_meta = await self.audio_socket.read_exactly(12)
-            pts = struct.unpack('>Q', frame_meta[:8])[0]
-            data_length = struct.unpack('>L', frame_meta[8:])[0]
-            audio_config_nal = await self.audio_socket.read_exactly(data_length)
-            await self.ws_client.send(bytes_data=format_audio_data(audio_config_nal))
-            self.video_audio_info['audio_header'] = [pts, data_length, audio_config_nal]
+            pts, audio_data = await self.audio_socket.read_frame()
+            self.hub.publish_audio(pts, audio_data, config=True)
+            audio_config_nal = audio_data[len(AUDIO_DATA_PREFIX):]
+            self.video_audio_info['audio_header'] = [pts, len(audio_config_nal), audio_config_nal]
+
+    def get_segment_filename(self, index):
+        """第一个分段沿用recorder_filename, 之后的分段加上序号"""
+        if not index:
+            return self.recorder_filename
+        return os.path.join(MEDIA_ROOT, 'video', f"{self.device_id}_{self.scid}_{index}.{self.recorder_format}")
+
+    def get_segment_video_id(self, index):
+        return f"{self.scid}_{index}" if index else self.scid
+
+    def get_headers(self):
+        """return video_header, audio_header; (pts, data), 无音频时audio_header为None"""
+        video_header = self.video_audio_info['video_header'][0], self.video_audio_info['video_header'][2]
+        audio_header = None
+        if self.video_audio_info.get('audio_encoder'):
+            audio_header = self.video_audio_info['audio_header'][0], self.video_audio_info['audio_header'][2]
+        return video_header, audio_header
+
+    def open_recorder(self, index=0, video_header=None, filename=None):
+        filename = filename or self.get_segment_filename(index)
+        default_video_header, audio_header = self.get_headers()
+        recorder = open_recorder(filename, self.mux_format, self.video_audio_info, video_header or default_video_header,
+                                 audio_header, self.recorder_fragmented)
+        self.recording_files.add(filename)
+        return recorder
+
+    def open_capture(self):
+        """原始packet抓取, 不分段, 由RecorderWriter的写入线程写入, manage.py remux离线封装并保存为Video"""
+        meta = {'device_id': self.device_id, 'video_id': self.scid, 'config': self.scrcpy_kwargs}
+        capture = RawCapture(self.recorder_filename, self.video_audio_info, *self.get_headers(), CAPTURE_MMAP, meta)
+        self.recording_files.add(self.recorder_filename)
+        return RecorderWriter(capture, self.device_id, self.scid)
 
     def start_recorder(self):
         if self.recorder_enable:
             try:
-                from extension.recorder import Recorder
-                recorder_format = 'matroska' if self.recorder_format == 'mkv' else self.recorder_format
-                self.recorder = Recorder(recorder_format, self.recorder_filename, self.scrcpy_kwargs['audio'])
-                assert self.recorder.add_video_stream(self.video_audio_info['video_encode'], self.video_audio_info['width'], self.video_audio_info['height'])
-                assert self.recorder.write_video_header(*self.video_audio_info['video_header'])
-                if self.video_audio_info.get('audio_encoder'):
-                    assert self.recorder.add_audio_stream(self.video_audio_info['audio_encoder'])
-                    assert self.recorder.write_audio_header(*self.video_audio_info['audio_header'])
-                assert self.recorder.write_header()
+                if self.recorder_format == 'raw':
+                    self.recorder = self.open_capture()
+                    return
+                # 之后的packet由写入线程写入, 不阻塞事件循环
+                loop = asyncio.get_running_loop()
+                self.recorder = RecorderWriter(
+                    self.open_recorder(), self.device_id, self.scid,
+                    segment_time=self.recorder_segment_time, segment_size=self.recorder_segment_size * 1024 * 1024,
+                    open_segment=self.open_recorder, video_filename=self.get_segment_filename,
+                    on_segment=lambda segment: self.segment_futures.append(
+                        asyncio.run_coroutine_threadsafe(self.save_video(segment), loop)),
+                )
             except Exception as e:
                 logging.error(f"【DeviceClient】({self.device_id}:{self.scid}) recorder_error start_recorder {type(e)}: {str(e)}")
                 del self.recorder
                 self.recorder = None
 
-    def write_recoder(self, *args, typ='video'):
+    def write_recoder(self, pts, data, typ='video'):
         if self.recorder:
-            try:
-                if typ == 'video':
-                    assert self.recorder.write_video_packet(*args)
-                else:
-                    assert self.recorder.write_audio_packet(*args)
-            except Exception as e:
-                logging.error(f"【DeviceClient】({self.device_id}:{self.scid}) recorder_error write_recoder {type(e)}: {str(e)}")
-                del self.recorder
-                self.recorder = None
+            self.recorder.write(pts, data, typ=typ)
+
+    async def save_video(self, segment):
+        """已关闭的分段保存为Video, 时长为0的分段删除文件, 即时回放的segment中带有filename、video_id、group_id"""
+        filename = segment.get('filename') or self.get_segment_filename(segment['index'])
+        video_id = segment.get('video_id') or self.get_segment_video_id(segment['index'])
+        self.recording_files.discard(filename)
+        try:
+            await save_video(filename, segment,
+                             video_id=video_id,
+                             device_id=self.device_id,
+                             format=self.mux_format,
+                             config=json.dumps(self.scrcpy_kwargs),
+                             group_id=segment.get('group_id', self.scid))
+            if self.mux_format == 'mp4':
+                FaststartQueue.submit(filename, video_id)
+            return True
+        except Exception as e:
+            logging.error(f"【DeviceClient】({self.device_id}:{self.scid}) recorder_error save_video {segment} {type(e)}: {str(e)}")
+            return False
+
+    def write_replay(self, filename, gops):
+        """在线程中把即时回放写入录屏文件, return 时长(秒)"""
+        recorder = self.open_recorder(video_header=gops[0][0], filename=filename)
+        index = KeyframeIndex.create(filename)
+        start_pts = None
+        video_config = gops[0][0]
+        try:
+            for gop_config, packets in gops:
+                # gop之间分辨率变化(旋转), 在关键帧前写入新的配置帧
+                if gop_config is not video_config and gop_config is not None:
+                    video_config = gop_config
+                    assert recorder.write_video_packet(gop_config[0], len(gop_config[1]), gop_config[1])
+                for typ, pts, data in packets:
+                    if typ == 'video':
+                        pts_value = pts & sc_packet_flag.SC_PACKET_PTS_MASK
+                        if start_pts is None:
+                            start_pts = pts_value
+                        if pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+                            index.add(pts_value - start_pts, recorder.tell())
+                        assert recorder.write_video_packet(pts, len(data), data)
+                    else:
+                        assert recorder.write_audio_packet(pts, len(data), data)
+        finally:
+            index.close()
+            duration = recorder.close_container()
+        return duration
+
+    async def save_replay(self):
+        """即时回放保存为Video, return Video的video_id, 没有可保存的数据时return None"""
+        if self.replay is None or not self.replay.gops:
+            return None
+        gops = self.replay.dump()
+        self.replay_count += 1
+        video_id = f"{self.scid}_replay_{self.replay_count}"
+        filename = os.path.join(MEDIA_ROOT, 'video', f"{self.device_id}_{video_id}.{self.mux_format}")
+        finish_time = time.time()
+        try:
+            duration = await asyncio.to_thread(self.write_replay, filename, gops)
+        except Exception as e:
+            logging.error(f"【DeviceClient】({self.device_id}:{self.scid}) replay_error {type(e)}: {str(e)}")
+            self.recording_files.discard(filename)
+            KeyframeIndex.remove(filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+            return None
+        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) save replay {video_id}, duration {duration}s")
+        if await self.save_video({
+            'index': 0, 'duration': duration, 'start_time': finish_time - duration, 'finish_time': finish_time,
+            'filename': filename, 'video_id': video_id, 'group_id': '',
+        }):
+            return video_id
 
     async def stop_recorder(self):
         if self.recorder:
             try:
-                from general.models import Video
-                duration = self.recorder.close_container()
-                assert duration
-                data = dict(
-                    video_id=self.scid,
-                    device_id=self.device_id,
-                    format=self.recorder_format,
-                    duration=duration,
-                    size=int(os.path.getsize(self.recorder_filename)/ 1024),
-                    start_time=datetime.datetime.fromtimestamp(self.recorder.start_time),
-                    finish_time=datetime.datetime.fromtimestamp(self.recorder.finish_time),
-                    config=json.dumps(self.scrcpy_kwargs)
-                )
-                await Video.objects.acreate(**data)
+                duration = await self.recorder.close()
+                if self.recorder.error:
+                    self.recording_files.discard(self.get_segment_filename(self.recorder.segment_index))
+                    os.remove(self.get_segment_filename(self.recorder.segment_index))
+                    KeyframeIndex.remove(self.get_segment_filename(self.recorder.segment_index))
+                # 原始packet抓取由manage.py remux保存
+                elif self.recorder_format == 'raw':
+                    self.recording_files.discard(self.recorder_filename)
+                else:
+                    await self.save_video(self.recorder.segment_info(duration))
+                # 等待之前的分段保存完成
+                for future in self.segment_futures:
+                    await asyncio.wrap_future(future)
             except Exception as e:
                 logging.error(f"【DeviceClient】({self.device_id}:{self.scid}) recorder_error stop_recorder {type(e)}: {str(e)}")
-                try:
-                    os.remove(self.recorder_filename)
-                except:
-                    pass
             finally:
+                self.segment_futures.clear()
                 del self.recorder
                 self.recorder = None
 
-    async def start(self):
-        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) =======> start {self.scrcpy_kwargs}")
-        # 1.start deploy server
-        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) (1).start deploy")
+    @property
+    def server_alive(self):
+        return self.deploy_task is not None and not self.deploy_task.done()
+
+    async def prepare(self):
+        """部署并启动scrcpy server, server等待socket连接"""
         async with self.device_lock:
             await self.deploy_server()
         self.deploy_task = asyncio.create_task(self._deploy_task())
+
+    async def start(self):
+        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) =======> start {self.scrcpy_kwargs}")
+        self.start_time = time.perf_counter()
+        # 1.start deploy server, 预热的server已部署
+        self.warm_start = self.server_alive
+        if self.warm_start:
+            logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) (1).warm server, skip deploy")
+        else:
+            logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) (1).start deploy")
+            await self.prepare()
+        self.mark_timing('deploy')
         # 2.create socket and get first config nal
         logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) (2).start socket")
-        await self.create_socket()
-        await self.handle_first_config_nal()
+        try:
+            await self.create_socket()
+            await self.handle_first_config_nal()
+            self.mark_timing('first_config_nal')
+        except BaseException:
+            # 设备上的jar可能已被清理, 下次启动重新校验
+            self.invalidate_deploy_cache()
+            raise
         # 3.start_recorder
         logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) (3).start recorder")
         self.start_recorder()
@@ -436,6 +679,9 @@ class DeviceClient:
             self.audio_task = asyncio.create_task(self._audio_task())
         # 6.check login task
         # self.video_task = asyncio.create_task(self.check_login_task())
+        self.mark_timing('total')
+        logging.info(f"【DeviceClient】({self.device_id}:{self.scid}) =======> {'warm' if self.warm_start else 'cold'} started, "
+                     f"timings(ms) {self.start_timings}")
 
     async def stop(self):
         try:
@@ -454,6 +700,7 @@ class DeviceClient:
                 await self.cancel_task(self.audio_task)
                 self.audio_task = None
             # 3.close control socket
+            await self.controller.close()
             if self.control_socket:
                 await self.control_socket.disconnect()
                 self.control_socket = None
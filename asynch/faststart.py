@@ -0,0 +1,203 @@
+import os
+import time
+import array
+import struct
+import asyncio
+import logging
+
+from asynch.recorder import KeyframeIndex
+from django_scrcpy.settings import FASTSTART_WORKERS
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+ATOM_HEADER = struct.Struct('>I4s')
+ATOM_SIZE64 = struct.Struct('>Q')
+# 需要递归查找stco/co64的容器atom
+CONTAINER_ATOMS = (b'moov', b'trak', b'mdia', b'minf', b'stbl')
+# 复制数据的块大小
+COPY_CHUNK = 1024 * 1024
+# 首帧时间模型: 播放器跳过超过该距离(字节)的数据时发起新的Range请求
+SEEK_DISTANCE = 1024 * 1024
+
+
+def read_atoms(filename):
+    """顶层atom, return [(type, offset, size), ...]"""
+    atoms = []
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        offset = 0
+        while offset + ATOM_HEADER.size <= file_size:
+            f.seek(offset)
+            size, atom_type = ATOM_HEADER.unpack(f.read(ATOM_HEADER.size))
+            if size == 1:
+                size = ATOM_SIZE64.unpack(f.read(ATOM_SIZE64.size))[0]
+            elif size == 0:
+                size = file_size - offset
+            if size < ATOM_HEADER.size:
+                raise ValueError(f"invalid atom {atom_type} at {offset}")
+            atoms.append((atom_type, offset, size))
+            offset += size
+    return atoms
+
+
+def patch_chunk_offsets(moov, shift, start=0, end=None):
+    """moov中所有stco/co64的chunk偏移加上shift, stco溢出32位时抛出ValueError"""
+    end = len(moov) if end is None else end
+    offset = start
+    while offset + ATOM_HEADER.size <= end:
+        size, atom_type = ATOM_HEADER.unpack_from(moov, offset)
+        header_size = ATOM_HEADER.size
+        if size == 1:
+            size = ATOM_SIZE64.unpack_from(moov, offset + header_size)[0]
+            header_size += ATOM_SIZE64.size
+        if size < header_size or offset + size > end:
+            raise ValueError(f"invalid atom {atom_type} in moov")
+        if atom_type in CONTAINER_ATOMS:
+            patch_chunk_offsets(moov, shift, offset + header_size, offset + size)
+        elif atom_type in (b'stco', b'co64'):
+            # version(1) flags(3) entry_count(4)
+            count = struct.unpack_from('>I', moov, offset + header_size + 4)[0]
+            fmt = '>%dI' % count if atom_type == b'stco' else '>%dQ' % count
+            entries_offset = offset + header_size + 8
+            entries = [value + shift for value in struct.unpack_from(fmt, moov, entries_offset)]
+            if atom_type == b'stco' and entries and entries[-1] >= 1 << 32:
+                raise ValueError("stco overflow, co64 required")
+            struct.pack_into(fmt, moov, entries_offset, *entries)
+        offset += size
+
+
+def copy_range(src, dst, offset, size):
+    src.seek(offset)
+    while size:
+        data = src.read(min(size, COPY_CHUNK))
+        if not data:
+            raise EOFError(f"unexpected end of file at {src.tell()}")
+        dst.write(data)
+        size -= len(data)
+
+
+def estimate_ttff(atoms, bandwidth, rtt):
+    """
+    按atom布局估算的首帧时间(秒), 只是模型估算, 不读取文件也不是实测值, 实测见benchmarks/faststart.py
+    模型: 播放器从文件头顺序读取, 依次需要moov和第一个mdat的开头
+    需要的数据在已读取位置之前或距离超过SEEK_DISTANCE时发起新的Range请求, 每次请求耗时rtt, 读取耗时 字节数 / bandwidth(字节/秒)
+    """
+    moov = next((atom for atom in atoms if atom[0] == b'moov'), None)
+    mdat = next((atom for atom in atoms if atom[0] == b'mdat'), None)
+    if moov is None or mdat is None:
+        return None
+    elapsed = rtt
+    position = 0
+    for start, end in ((moov[1], moov[1] + moov[2]), (mdat[1], mdat[1] + ATOM_HEADER.size)):
+        if start < position or start - position > SEEK_DISTANCE:
+            elapsed += rtt
+        else:
+            start = position
+        elapsed += (end - start) / bandwidth
+        position = end
+    return round(elapsed, 3)
+
+
+def faststart(filename, bandwidth=2.5 * 1024 * 1024, rtt=0.05):
+    """
+    mp4的moov移动到文件头(ftyp之后), 只复制数据不重新编码, 同时修正关键帧索引中的偏移
+    写入临时文件后os.replace, 正在读取的请求不受影响, 保留原文件的修改时间
+    return None(moov已在mdat之前或不是mp4) 或 {'moov_size', 'estimated_ttff_before', 'estimated_ttff_after', 'elapsed'}
+    estimated_ttff_*为estimate_ttff按bandwidth、rtt估算的首帧时间, 不是实测值
+    """
+    start_time = time.perf_counter()
+    atoms = read_atoms(filename)
+    types = [atom[0] for atom in atoms]
+    if b'moov' not in types or b'mdat' not in types or types.index(b'moov') < types.index(b'mdat'):
+        return None
+    _, moov_offset, moov_size = atoms[types.index(b'moov')]
+    # moov插入到ftyp之后, 其间的atom后移moov_size
+    insert_offset = atoms[0][2] if types[0] == b'ftyp' else 0
+    with open(filename, 'rb') as src:
+        src.seek(moov_offset)
+        moov = bytearray(src.read(moov_size))
+        patch_chunk_offsets(moov, moov_size)
+        temp_filename = filename + '.faststart'
+        with open(temp_filename, 'wb') as dst:
+            copy_range(src, dst, 0, insert_offset)
+            dst.write(moov)
+            for atom_type, offset, size in atoms:
+                if offset >= insert_offset and atom_type != b'moov':
+                    copy_range(src, dst, offset, size)
+    stat = os.stat(filename)
+    os.utime(temp_filename, (stat.st_atime, stat.st_mtime))
+    os.replace(temp_filename, filename)
+    # 关键帧索引的偏移位于mdat中, 同样后移
+    try:
+        index = KeyframeIndex.load(filename)
+    except FileNotFoundError:
+        index = None
+    if index is not None:
+        entries = array.array('q', index.entries)
+        for idx in range(1, len(entries), 2):
+            if insert_offset <= entries[idx] < moov_offset:
+                entries[idx] += moov_size
+        with open(index.filename + '.faststart', 'wb') as f:
+            entries.tofile(f)
+        os.replace(index.filename + '.faststart', index.filename)
+    new_atoms = [atoms[0]] if insert_offset else []
+    new_atoms.append((b'moov', insert_offset, moov_size))
+    new_atoms += [(t, o + moov_size if o < moov_offset else o, s) for t, o, s in atoms if o >= insert_offset and t != b'moov']
+    return {
+        'moov_size': moov_size,
+        'estimated_ttff_before': estimate_ttff(atoms, bandwidth, rtt),
+        'estimated_ttff_after': estimate_ttff(new_atoms, bandwidth, rtt),
+        'elapsed': round(time.perf_counter() - start_time, 3),
+    }
+
+
+class FaststartQueue:
+    """
+    录屏完成后的faststart后台队列, 最多FASTSTART_WORKERS个任务同时在线程中复制文件, 0则关闭
+    完成后以一条UPDATE语句更新Video.size
+    """
+    queue = None
+    tasks = []
+    # 统计
+    done = 0
+    failed = 0
+    last_result = None
+
+    @classmethod
+    def submit(cls, filename, video_id):
+        if not FASTSTART_WORKERS:
+            return
+        if cls.queue is None:
+            cls.queue = asyncio.Queue()
+            cls.tasks = [asyncio.create_task(cls._worker_task()) for _ in range(FASTSTART_WORKERS)]
+        cls.queue.put_nowait((filename, video_id))
+
+    @classmethod
+    async def _worker_task(cls):
+        from general.models import Video
+        while True:
+            filename, video_id = await cls.queue.get()
+            try:
+                result = await asyncio.to_thread(faststart, filename)
+                if result is not None:
+                    await Video.objects.filter(video_id=video_id).aupdate(size=int(os.path.getsize(filename) / 1024))
+                    cls.last_result = result
+                    logging.info(f"【FaststartQueue】({video_id}) faststart {result}")
+                cls.done += 1
+            except Exception as e:
+                cls.failed += 1
+                logging.error(f"【FaststartQueue】({video_id}) faststart error {type(e)}: {e}")
+                if os.path.exists(filename + '.faststart'):
+                    os.remove(filename + '.faststart')
+            finally:
+                cls.queue.task_done()
+
+    @classmethod
+    def stats(cls):
+        return {
+            'pending': cls.queue.qsize() if cls.queue else 0,
+            'done': cls.done,
+            'failed': cls.failed,
+            'last_result': cls.last_result,
+        }
+
@@ -0,0 +1,235 @@
+import math
+import struct
+import asyncio
+import logging
+
+from asynch.constants import sc_control_msg_type
+from asynch.constants.input import android_motionevent_action, android_motionevent_buttons
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+TOUCH_EVENT = struct.Struct(">BBqiiHHHii")
+# 默认每个tick的时长,秒
+DEFAULT_TICK = 1 / 120
+# tick的最小时长,秒, 更短的tick设备也无法区分
+MIN_TICK = 0.002
+# 单个手势的上限, 防止一条ws消息预先计算大量事件: 总时长(含delay),秒; 所有track的tick总数; track数
+MAX_DURATION = 60
+MAX_TICKS = 12000
+MAX_TRACKS = 10
+# curve的点数上限, 每个tick的计算量与点数的平方成正比; path的点数上限
+MAX_CURVE_POINTS = 16
+MAX_PATH_POINTS = 256
+# ws消息中可用的track类型
+TRACK_TYPES = ('line', 'curve', 'path', 'pinch')
+# ws消息中坐标、距离、角度的绝对值上限, touch_id为int64
+MAX_COORDINATE = 1000000
+TOUCH_ID_RANGE = (-(1 << 63), (1 << 63) - 1)
+# ws消息中track参数的类型
+TRACK_NUMBER_ARGS = ('duration', 'delay', 'start_distance', 'end_distance', 'angle')
+TRACK_POINT_ARGS = ('start', 'end', 'center')
+TRACK_POINTS_ARGS = ('points',)
+
+
+def pack_touch_event(action, touch_id, x, y, resolution):
+    pressure = 0 if action == android_motionevent_action.AMOTION_EVENT_ACTION_UP else 1
+    x = min(max(int(x), 0), resolution[0])
+    y = min(max(int(y), 0), resolution[1])
+    return TOUCH_EVENT.pack(sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, action, touch_id, x, y,
+                            int(resolution[0]), int(resolution[1]), pressure,
+                            android_motionevent_buttons.AMOTION_EVENT_BUTTON_PRIMARY, pressure)
+
+
+def bezier(points, t):
+    """de Casteljau, points: [(x, y), ...]"""
+    points = list(points)
+    while len(points) > 1:
+        points = [(x1 + (x2 - x1) * t, y1 + (y2 - y1) * t) for (x1, y1), (x2, y2) in zip(points, points[1:])]
+    return points[0]
+
+
+def polyline(points, t):
+    """按长度匀速经过各点"""
+    lengths = [math.dist(p1, p2) for p1, p2 in zip(points, points[1:])]
+    distance = sum(lengths) * t
+    for (x1, y1), (x2, y2), length in zip(points, points[1:], lengths):
+        if distance <= length and length:
+            ratio = distance / length
+            return x1 + (x2 - x1) * ratio, y1 + (y2 - y1) * ratio
+        distance -= length
+    return points[-1]
+
+
+def check_number(value, name):
+    """json.loads可以解析出NaN、Infinity, 只接受有限且不超过MAX_COORDINATE的数"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            not math.isfinite(value) or abs(value) > MAX_COORDINATE:
+        raise ValueError(f"invalid {name} {value!r}")
+    return value
+
+
+def check_point(value, name):
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        raise ValueError(f"invalid {name} {value!r}")
+    return tuple(check_number(item, name) for item in value)
+
+
+def check_touch_id(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not TOUCH_ID_RANGE[0] <= value <= TOUCH_ID_RANGE[1]:
+        raise ValueError(f"invalid touch_id {value!r}")
+    return value
+
+
+def check_track_args(kwargs):
+    """校验ws消息中track的参数, 参数名不对时由调用raise TypeError"""
+    for name, value in kwargs.items():
+        if name in TRACK_NUMBER_ARGS:
+            check_number(value, name)
+        elif name in TRACK_POINT_ARGS:
+            kwargs[name] = check_point(value, name)
+        elif name in TRACK_POINTS_ARGS:
+            if not isinstance(value, list):
+                raise ValueError(f"invalid {name} {value!r}")
+            kwargs[name] = [check_point(point, name) for point in value]
+        elif name == 'touch_id':
+            check_touch_id(value)
+        elif name == 'touch_ids':
+            if not isinstance(value, list) or len(value) != 2:
+                raise ValueError(f"invalid touch_ids {value!r}")
+            kwargs[name] = [check_touch_id(touch_id) for touch_id in value]
+    return kwargs
+
+
+class Gesture:
+    """
+    预先计算好每个tick要发送的touch事件, 播放时按单调时钟的deadline发送
+    1.每个track是一个touch_id的轨迹: 第一个tick按下, 之后每个tick移动, 最后一个tick抬起
+    2.同一tick的所有事件合并为一次注入, 多个touch_id同时移动
+    3.deadline = 开始时间 + tick序号 * tick, 单次sleep的误差不会累积
+    """
+    def __init__(self, resolution, tick=DEFAULT_TICK):
+        self.resolution = resolution
+        self.tick = max(tick, MIN_TICK)
+        # [(touch_id, start_tick, [(x, y), ...]), ...]
+        self.tracks = []
+        self.frames = None
+        # 播放统计
+        self.max_lateness = 0
+
+    def ticks(self, duration):
+        return max(round(duration / self.tick), 1)
+
+    def add_track(self, touch_id, points, delay=0):
+        """points: 每个tick的位置, 第一个为按下位置"""
+        self.tracks.append((touch_id, round(delay / self.tick), [tuple(point) for point in points]))
+        self.frames = None
+        return self
+
+    def add_sampled(self, touch_id, func, duration, delay=0):
+        """超过MAX_DURATION、MAX_TICKS或MAX_TRACKS时raise ValueError"""
+        if not 0 < duration or not 0 <= delay or duration + delay > MAX_DURATION:
+            raise ValueError(f"gesture duration {duration} delay {delay} out of range")
+        if len(self.tracks) >= MAX_TRACKS:
+            raise ValueError(f"gesture tracks more than {MAX_TRACKS}")
+        cnt = self.ticks(duration)
+        if sum(len(points) for _, _, points in self.tracks) + cnt + 1 > MAX_TICKS:
+            raise ValueError(f"gesture ticks more than {MAX_TICKS}")
+        return self.add_track(touch_id, [func(idx / cnt) for idx in range(cnt + 1)], delay)
+
+    def line(self, start, end, duration, touch_id=0, delay=0):
+        return self.add_sampled(touch_id, lambda t: bezier((start, end), t), duration, delay)
+
+    def curve(self, points, duration, touch_id=0, delay=0):
+        """贝塞尔曲线, points: 起点, 控制点..., 终点"""
+        if not 2 <= len(points) <= MAX_CURVE_POINTS:
+            raise ValueError(f"curve points {len(points)} out of range")
+        return self.add_sampled(touch_id, lambda t: bezier(points, t), duration, delay)
+
+    def path(self, points, duration, touch_id=0, delay=0):
+        """折线, 匀速经过points中的各点"""
+        if not 2 <= len(points) <= MAX_PATH_POINTS:
+            raise ValueError(f"path points {len(points)} out of range")
+        return self.add_sampled(touch_id, lambda t: polyline(points, t), duration, delay)
+
+    def pinch(self, center, start_distance, end_distance, duration, angle=0, touch_ids=(0, 1), delay=0):
+        """两指缩放, end_distance > start_distance为放大, angle: 两指连线的角度"""
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        for sign, touch_id in zip((-1, 1), touch_ids):
+            def func(t, sign=sign):
+                radius = (start_distance + (end_distance - start_distance) * t) / 2 * sign
+                return center[0] + radius * cos, center[1] + radius * sin
+            self.add_sampled(touch_id, func, duration, delay)
+        return self
+
+    @classmethod
+    def from_dict(cls, data, resolution):
+        """
+        ws消息中的手势描述
+        {"tick": 0.008, "tracks": [{"type": "line"|"curve"|"path"|"pinch", "duration": 0.3, "delay": 0, ...}, ...]}
+        line: start, end; curve/path: points; pinch: center, start_distance, end_distance, angle; 均可带touch_id
+        type只能是TRACK_TYPES, 坐标为有限数, touch_id为int64, 格式错误或超过上限时raise ValueError
+        """
+        try:
+            tick = float(data.get('tick', DEFAULT_TICK))
+            if not math.isfinite(tick) or tick > MAX_DURATION:
+                raise ValueError(f"invalid tick {tick}")
+            gesture = cls((int(resolution[0]), int(resolution[1])), tick)
+            if not isinstance(data['tracks'], list):
+                raise ValueError("tracks must be a list")
+            for track in data['tracks']:
+                kwargs = dict(track)
+                track_type = kwargs.pop('type')
+                if track_type not in TRACK_TYPES:
+                    raise ValueError(f"unknown track type {track_type!r}")
+                getattr(gesture, track_type)(**check_track_args(kwargs))
+        except ValueError:
+            raise
+        except (TypeError, KeyError, IndexError, AttributeError) as e:
+            raise ValueError(f"invalid gesture {type(e).__name__}: {e}")
+        return gesture
+
+    def build(self):
+        """return [tick_data, ...], tick_data: 该tick所有touch事件拼接后的bytes"""
+        if self.frames is not None:
+            return self.frames
+        end_tick = max((start + len(points) - 1 for _, start, points in self.tracks), default=-1)
+        frames = [[] for _ in range(end_tick + 1)]
+        for touch_id, start, points in self.tracks:
+            for idx, (x, y) in enumerate(points):
+                if idx == 0:
+                    action = android_motionevent_action.AMOTION_EVENT_ACTION_DOWN
+                else:
+                    action = android_motionevent_action.AMOTION_EVENT_ACTION_MOVE
+                frames[start + idx].append(pack_touch_event(action, touch_id, x, y, self.resolution))
+            frames[start + len(points) - 1].append(pack_touch_event(android_motionevent_action.AMOTION_EVENT_ACTION_UP,
+                                                                    touch_id, *points[-1], self.resolution))
+        self.frames = [b''.join(frame) for frame in frames]
+        return self.frames
+
+    def active_ups(self, tick_idx):
+        """tick_idx已发送但尚未抬起的touch_id的抬起事件, 中途取消时发送"""
+        return b''.join(pack_touch_event(android_motionevent_action.AMOTION_EVENT_ACTION_UP, touch_id,
+                                         *points[min(tick_idx - start, len(points) - 1)], self.resolution)
+                        for touch_id, start, points in self.tracks if start <= tick_idx < start + len(points) - 1)
+
+    async def play(self, controller):
+        frames = self.build()
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        idx = -1
+        try:
+            for idx, data in enumerate(frames):
+                delay = start_time + idx * self.tick - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_lateness = max(self.max_lateness, -delay)
+                if data:
+                    await controller.inject(data)
+        except asyncio.CancelledError:
+            ups = self.active_ups(idx)
+            if ups:
+                await controller.inject(ups)
+            raise
+        return loop.time() - start_time
+
@@ -0,0 +1,292 @@
+import os
+import json
+import asyncio
+import logging
+import datetime
+
+from asynch.hub import DeviceHub
+from asynch.device import DeviceClient
+from asynch.subscriber import HubSubscriber
+from asynch.recorder import RecorderWriter, KeyframeIndex, open_recorder, save_video
+from asynch.capture import RawCapture
+from asynch.faststart import FaststartQueue
+from asynch.serializers import AUDIO_DATA_PREFIX
+from asynch.tools.utils import create_scid
+from asynch.tools.cache import FRAME_TYPE_CONFIG, FRAME_TYPE_AUDIO_CONFIG, FRAME_TYPE_KEY, FRAME_TYPE_AUDIO
+from django_scrcpy.settings import MEDIA_ROOT, HEADLESS_MAX_DEVICES, CAPTURE_MMAP
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+def parse_schedule(schedule):
+    """"09:00-12:00,22:00-02:00" -> [(540, 720), (1320, 120)], 单位为分钟"""
+    windows = []
+    for item in (schedule or '').replace(' ', '').split(','):
+        if not item:
+            continue
+        start, end = item.split('-')
+        windows.append(tuple(int(t.split(':')[0]) * 60 + int(t.split(':')[1]) for t in (start, end)))
+    return windows
+
+
+def in_schedule(windows, now=None):
+    """windows为空则全天, 结束时间小于开始时间时跨零点"""
+    if not windows:
+        return True
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for start, end in windows:
+        if start <= end and start <= minute < end:
+            return True
+        if start > end and (minute >= start or minute < end):
+            return True
+    return False
+
+
+class RecordingSubscriber(HubSubscriber):
+    """
+    无ws_client的录屏订阅者, 与投屏共享DeviceHub的数据源(本进程的DeviceClient或所有者worker的RemoteDeviceClient)
+    1.从gop缓存补发的配置帧开始, 第一个关键帧到达时打开Recorder, 之前的delta帧丢弃
+    2.packet交给RecorderWriter线程写入(recorder_format为raw时写入线程调用RawCapture顺序写入), 不解码, 队列有界, 满时丢帧, 每个设备的内存占用有上限
+    3.scrcpy server退出时close_client只做标记, 由HeadlessRecorder移除订阅者并保存录屏
+    """
+    def __init__(self, device_id, recorder_format='mp4', segment_time=0, segment_size=0, fragmented=False):
+        self.ws_client = None
+        self.scid = create_scid()
+        self.device_id = device_id
+        self.recorder_format = recorder_format
+        self.segment_time = segment_time
+        self.segment_size = segment_size
+        self.fragmented = fragmented
+        self.hub = None
+        self.writer = None
+        self.video_config = None
+        self.audio_config = None
+        self.has_audio = False
+        # 分段保存Video的future
+        self.segment_futures = []
+        self.closed = asyncio.Event()
+        # 统计
+        self.dropped_frames = 0
+
+    @property
+    def client(self):
+        return self
+
+    def on_attach(self, hub):
+        self.hub = hub
+
+    def get_segment_filename(self, index):
+        if not index:
+            return os.path.join(MEDIA_ROOT, 'video', f"{self.device_id}_{self.scid}.{self.recorder_format}")
+        return os.path.join(MEDIA_ROOT, 'video', f"{self.device_id}_{self.scid}_{index}.{self.recorder_format}")
+
+    def get_segment_video_id(self, index):
+        return f"{self.scid}_{index}" if index else self.scid
+
+    def open_recorder(self, index=0, video_header=None):
+        filename = self.get_segment_filename(index)
+        recorder = open_recorder(filename, self.recorder_format, self.hub.device_client.video_audio_info,
+                                 video_header or self.video_config, self.audio_config if self.has_audio else None,
+                                 self.fragmented)
+        DeviceClient.recording_files.add(filename)
+        return recorder
+
+    def start_writer(self):
+        loop = asyncio.get_running_loop()
+        self.has_audio = bool(self.audio_config and self.hub.device_client.video_audio_info.get('audio_encoder'))
+        try:
+            if self.recorder_format == 'raw':
+                # 原始packet抓取, 由manage.py remux离线封装
+                meta = {'device_id': self.device_id, 'video_id': self.scid, 'config': self.hub.scrcpy_kwargs}
+                filename = self.get_segment_filename(0)
+                capture = RawCapture(filename, self.hub.device_client.video_audio_info, self.video_config,
+                                     self.audio_config if self.has_audio else None, CAPTURE_MMAP, meta)
+                DeviceClient.recording_files.add(filename)
+                self.writer = RecorderWriter(capture, self.device_id, self.scid)
+            else:
+                self.writer = RecorderWriter(
+                    self.open_recorder(), self.device_id, self.scid,
+                    segment_time=self.segment_time, segment_size=self.segment_size * 1024 * 1024,
+                    open_segment=self.open_recorder, video_filename=self.get_segment_filename,
+                    on_segment=lambda segment: self.segment_futures.append(
+                        asyncio.run_coroutine_threadsafe(self.save_video(segment), loop)),
+                )
+            logging.info(f"【RecordingSubscriber】({self.device_id}:{self.scid}) =======> recording")
+        except Exception as e:
+            logging.error(f"【RecordingSubscriber】({self.device_id}:{self.scid}) recorder_error start {type(e)}: {str(e)}")
+            self.closed.set()
+
+    def feed(self, frame_type, pts, data):
+        if self.closed.is_set():
+            return
+        if frame_type == FRAME_TYPE_CONFIG:
+            self.video_config = (pts, data)
+            if self.writer:
+                self.writer.write(pts, data)
+        elif frame_type == FRAME_TYPE_AUDIO_CONFIG:
+            self.audio_config = (pts, data[len(AUDIO_DATA_PREFIX):])
+        elif self.writer is None:
+            if frame_type != FRAME_TYPE_KEY or self.video_config is None:
+                self.dropped_frames += 1
+                return
+            self.start_writer()
+            if self.writer:
+                self.writer.write(pts, data)
+        elif frame_type == FRAME_TYPE_AUDIO:
+            if self.has_audio:
+                self.writer.write(pts, memoryview(data)[len(AUDIO_DATA_PREFIX):], typ='audio')
+        else:
+            self.writer.write(pts, data)
+
+    def drop_droppable(self):
+        pass
+
+    async def close_client(self):
+        self.closed.set()
+
+    async def save_video(self, segment):
+        filename = self.get_segment_filename(segment['index'])
+        DeviceClient.recording_files.discard(filename)
+        try:
+            await save_video(filename, segment,
+                             video_id=self.get_segment_video_id(segment['index']),
+                             device_id=self.device_id,
+                             format=self.recorder_format,
+                             config=json.dumps(self.hub.scrcpy_kwargs),
+                             group_id=self.scid)
+            if self.recorder_format == 'mp4':
+                FaststartQueue.submit(filename, self.get_segment_video_id(segment['index']))
+        except Exception as e:
+            logging.error(f"【RecordingSubscriber】({self.device_id}:{self.scid}) recorder_error save_video {segment} {type(e)}: {str(e)}")
+
+    async def close(self):
+        self.closed.set()
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        duration = await writer.close()
+        if writer.error:
+            filename = self.get_segment_filename(writer.segment_index)
+            DeviceClient.recording_files.discard(filename)
+            os.remove(filename)
+            KeyframeIndex.remove(filename)
+        # 原始packet抓取由manage.py remux保存
+        elif self.recorder_format == 'raw':
+            DeviceClient.recording_files.discard(self.get_segment_filename(0))
+        else:
+            await self.save_video(writer.segment_info(duration))
+        for future in self.segment_futures:
+            await asyncio.wrap_future(future)
+        self.segment_futures.clear()
+
+    def stats(self):
+        return {
+            'scid': self.scid,
+            'type': self.__class__.__name__,
+            'dropped_frames': self.dropped_frames,
+            'recorder': self.writer.stats() if self.writer else None,
+        }
+
+
+class HeadlessRecorder:
+    """
+    无浏览器的录屏服务, 由manage.py record运行, 不依赖投屏页面
+    1.每interval秒同步一次: 在线且在录屏时间段内的设备开始录屏, 离线、超出时间段或scrcpy server退出的设备停止录屏
+    2.通过DeviceHub.attach订阅, 开启DEVICE_REGISTRY_ENABLE时与ASGI worker中的投屏共享同一个scrcpy server
+    3.同时录屏的设备数不超过max_devices, 每个设备一个RecorderWriter线程和有界队列
+    """
+    # 同步间隔,秒
+    interval = 10
+
+    def __init__(self, device_ids=None, schedule='', max_devices=HEADLESS_MAX_DEVICES):
+        # None则录制config中headless_record为true的设备
+        self.device_ids = device_ids
+        # 设备config中没有headless_schedule时使用
+        self.schedule = schedule
+        self.max_devices = max_devices
+        # device_id -> RecordingSubscriber
+        self.recordings = dict()
+
+    async def get_candidates(self):
+        """return {device_id: scrcpy_kwargs}, 在线且当前需要录屏的设备"""
+        from general.adb import AdbDevice
+        from general.models import Mobile
+        devices = await asyncio.to_thread(AdbDevice.list, True)
+        candidates = dict()
+        async for mobile in Mobile.objects.all():
+            if not devices.get(mobile.device_id, {}).get('online'):
+                continue
+            scrcpy_kwargs = json.loads(mobile.config)
+            device_id = mobile.device_id.replace(',', '.').replace('_', ':')
+            if self.device_ids is not None:
+                if device_id not in self.device_ids and mobile.device_id not in self.device_ids:
+                    continue
+            elif not scrcpy_kwargs.get('headless_record'):
+                continue
+            if not in_schedule(parse_schedule(scrcpy_kwargs.get('headless_schedule') or self.schedule)):
+                continue
+            candidates[device_id] = scrcpy_kwargs
+        return candidates
+
+    async def start(self, device_id, scrcpy_kwargs):
+        subscriber = RecordingSubscriber(
+            device_id, scrcpy_kwargs.get('recorder_format') or 'mp4',
+            segment_time=scrcpy_kwargs.get('recorder_segment_time') or 0,
+            segment_size=scrcpy_kwargs.get('recorder_segment_size') or 0,
+            fragmented=scrcpy_kwargs.get('recorder_fragmented'),
+        )
+        # 录屏由订阅者完成, DeviceClient不再录屏
+        scrcpy_kwargs = dict(scrcpy_kwargs, recorder_enable=False, adaptive_enable=False)
+        try:
+            await DeviceHub.attach(device_id, subscriber, scrcpy_kwargs)
+        except Exception as e:
+            logging.error(f"【HeadlessRecorder】({device_id}) start error {type(e)}: {e}")
+            return False
+        self.recordings[device_id] = subscriber
+        return True
+
+    async def stop(self, device_id):
+        subscriber = self.recordings.pop(device_id)
+        hub = subscriber.hub
+        if hub is not None and not hub.closed:
+            await hub.remove_subscriber(subscriber)
+        else:
+            await subscriber.close()
+        logging.info(f"【HeadlessRecorder】({device_id}:{subscriber.scid}) stopped {subscriber.stats()}")
+
+    async def sync(self):
+        candidates = await self.get_candidates()
+        # 1.停止不再需要的录屏
+        for device_id, subscriber in list(self.recordings.items()):
+            if device_id not in candidates or subscriber.closed.is_set():
+                await self.stop(device_id)
+        # 2.开始新的录屏
+        for device_id, scrcpy_kwargs in candidates.items():
+            if device_id in self.recordings:
+                continue
+            if len(self.recordings) >= self.max_devices:
+                logging.warning(f"【HeadlessRecorder】 max_devices {self.max_devices} reached, "
+                                f"{len(candidates) - len(self.recordings)} devices waiting")
+                break
+            await self.start(device_id, scrcpy_kwargs)
+
+    async def close(self):
+        for device_id in list(self.recordings):
+            await self.stop(device_id)
+
+    def stats(self):
+        return {device_id: subscriber.stats() for device_id, subscriber in self.recordings.items()}
+
+    async def run(self):
+        logging.info(f"【HeadlessRecorder】 =======> start, devices: {self.device_ids or 'headless_record'}, "
+                     f"schedule: {self.schedule or 'all day'}, max_devices: {self.max_devices}")
+        try:
+            while True:
+                try:
+                    await self.sync()
+                except Exception as e:
+                    logging.error(f"【HeadlessRecorder】 sync error {type(e)}: {e}")
+                logging.info(f"【HeadlessRecorder】 recording {len(self.recordings)} devices")
+                await asyncio.sleep(self.interval)
+        finally:
+            await asyncio.shield(self.close())
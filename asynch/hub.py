@@ -0,0 +1,274 @@
+import json
+import time
+import asyncio
+import logging
+
+from asynch.device import DeviceClient
+from asynch.adaptive import AdaptiveController
+from asynch.subscriber import HubSubscriber
+from asynch.registry import DeviceRegistry, RemoteDeviceClient
+from asynch.tools.utils import create_scid
+from asynch.tools.cache import GopCache, get_video_frame_type, FRAME_TYPE_AUDIO, FRAME_TYPE_AUDIO_CONFIG
+from django_scrcpy.settings import GOP_CACHE_MAX_BYTES, GOP_CACHE_MAX_FRAMES, DEVICE_REGISTRY_ENABLE
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+def config_diff(requested, running):
+    """return {key: {'requested': 请求的值, 'running': 正在运行的值}, ...}, 参数一致时为空"""
+    return {key: {'requested': requested.get(key), 'running': running.get(key)}
+            for key in sorted(set(requested) | set(running)) if requested.get(key) != running.get(key)}
+
+
+class DeviceHub:
+    """
+    单个安卓设备的推流中心: 一个DeviceClient(一个scrcpy server)的音视频数据分发给多个订阅者
+    引用计数为订阅者数量, 最后一个订阅者离开时停止scrcpy server
+    多worker部署时, 只有获得DeviceRegistry所有权的worker启动scrcpy server, 其它worker通过RemoteDeviceClient接收数据
+    """
+    # device_id -> DeviceHub
+    hubs = dict()
+    # 启动DeviceClient超时时间,秒
+    start_timeout = 4
+
+    @classmethod
+    async def subscribe(cls, ws_client):
+        scrcpy_kwargs = json.loads(ws_client.query_params['config'][0])
+        return await cls.attach(ws_client.device_id, HubSubscriber(ws_client), scrcpy_kwargs)
+
+    @classmethod
+    async def attach(cls, device_id, subscriber, scrcpy_kwargs):
+        while True:
+            hub = cls.hubs.get(device_id)
+            if hub is None:
+                hub = cls.hubs[device_id] = cls(device_id)
+            # hub在等待锁期间被关闭，重新获取
+            if await hub.add_subscriber(subscriber, scrcpy_kwargs):
+                return hub
+
+    @classmethod
+    async def warm(cls, device_id, scrcpy_kwargs):
+        """预热设备, 设备已有hub时不预热"""
+        if device_id in cls.hubs:
+            return False
+        hub = cls.hubs[device_id] = cls(device_id)
+        return await hub.prepare(scrcpy_kwargs)
+
+    @classmethod
+    def all_stats(cls):
+        return [hub.stats() for hub in list(cls.hubs.values())]
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.device_client = None
+        # 第一个订阅者的scrcpy参数
+        self.scrcpy_kwargs = None
+        # 自适应画质, 仅在启动scrcpy server的worker中运行
+        self.adaptive = None
+        # 自适应画质切换时重启DeviceClient, 期间不关闭ws_client
+        self.restarting = False
+        # 多worker设备所有权, 仅所有者worker持有
+        self.registry = None
+        # client -> HubSubscriber
+        self.subscribers = dict()
+        # 最近的gop, 新加入的ws_client立即解码出画面
+        self.gop_cache = GopCache(GOP_CACHE_MAX_BYTES, GOP_CACHE_MAX_FRAMES)
+        # 启动和停止DeviceClient的并发锁
+        self.lock = asyncio.Lock()
+        self.closed = False
+        self.created_time = time.time()
+        # 预热完成时间, 第一个订阅者到来后清空
+        self.warm_time = None
+
+    @property
+    def ref_count(self):
+        return len(self.subscribers)
+
+    def create_device_client(self, scid, scrcpy_kwargs):
+        if DEVICE_REGISTRY_ENABLE and self.registry is None:
+            registry = DeviceRegistry(self)
+            if not registry.acquire():
+                return RemoteDeviceClient(self, scid, scrcpy_kwargs)
+            self.registry = registry
+        return DeviceClient(self, scid, scrcpy_kwargs)
+
+    async def add_subscriber(self, subscriber, scrcpy_kwargs):
+        async with self.lock:
+            if self.closed:
+                return False
+            # 1.第一个订阅者, 启动scrcpy server
+            if not self.subscribers:
+                try:
+                    await self.start_device_client(subscriber.scid, scrcpy_kwargs)
+                except BaseException:
+                    await subscriber.close()
+                    await self.close()
+                    raise
+            # 2.后加入的订阅者(或其它worker已启动的会话), 共享已启动的scrcpy server, 参数不一致时记录未生效的参数
+            subscriber.config_mismatch = config_diff(scrcpy_kwargs, self.scrcpy_kwargs)
+            if subscriber.config_mismatch:
+                logging.warning(f"【DeviceHub】({self.device_id}:{subscriber.scid}) config differs from running session "
+                                f"{self.device_client.scid}, reuse running session, not applied: {subscriber.config_mismatch}")
+            # 3.先补发gop缓存, 启动期间发布的配置帧也在其中
+            subscriber.on_attach(self)
+            for frame_type, pts, data in self.gop_cache.dump():
+                subscriber.feed(frame_type, pts, data)
+            self.subscribers[subscriber.client] = subscriber
+            logging.info(f"【DeviceHub】({self.device_id}) gop_cache {self.gop_cache.stats()}")
+            logging.info(f"【DeviceHub】({self.device_id}:{self.device_client.scid}) add {subscriber.__class__.__name__} "
+                         f"{subscriber.scid}, ref_count: {self.ref_count}")
+            return True
+
+    async def remove_subscriber(self, client):
+        async with self.lock:
+            subscriber = self.subscribers.pop(client, None)
+            if subscriber is None:
+                return
+            await subscriber.close()
+            logging.info(f"【DeviceHub】({self.device_id}) remove {subscriber.__class__.__name__} {subscriber.scid}, "
+                         f"ref_count: {self.ref_count}, stats: {subscriber.stats()}")
+            if not self.subscribers:
+                await self.close()
+
+    async def start_device_client(self, scid, scrcpy_kwargs):
+        # 1.预热的server参数不一致或已退出, 重新启动
+        if self.device_client and (scrcpy_kwargs != self.scrcpy_kwargs or not self.device_client.server_alive):
+            await self.device_client.stop()
+            self.device_client = None
+        if self.device_client is None:
+            self.scrcpy_kwargs = scrcpy_kwargs
+            self.device_client = self.create_device_client(scid, dict(scrcpy_kwargs))
+        self.warm_time = None
+        # 2.连接scrcpy server
+        await asyncio.wait_for(self.device_client.start(), self.start_timeout)
+        # 其它worker已启动的会话, 以所有者的参数为准
+        if isinstance(self.device_client, RemoteDeviceClient):
+            self.scrcpy_kwargs = self.device_client.raw_scrcpy_kwargs
+        if self.registry:
+            await self.registry.start_server()
+        self.start_adaptive()
+
+    async def prepare(self, scrcpy_kwargs):
+        """预热: 启动scrcpy server等待连接, 第一个订阅者到来时直接连接"""
+        async with self.lock:
+            if self.closed or self.device_client:
+                return False
+            scid = create_scid()
+            device_client = self.create_device_client(scid, dict(scrcpy_kwargs))
+            self.device_client = device_client
+            # 其它worker已拥有该设备
+            if not isinstance(device_client, DeviceClient):
+                await self.close()
+                return False
+            self.scrcpy_kwargs = scrcpy_kwargs
+            try:
+                await asyncio.wait_for(device_client.prepare(), self.start_timeout)
+                if self.registry:
+                    await self.registry.start_server()
+            except Exception as e:
+                logging.error(f"【DeviceHub】({self.device_id}:{scid}) prepare error {type(e)}: {e}")
+                await self.close()
+                return False
+            self.warm_time = time.time()
+            logging.info(f"【DeviceHub】({self.device_id}:{scid}) warm server prepared")
+            return True
+
+    async def close_idle(self, ttl):
+        """关闭预热超过ttl秒仍无订阅者的hub, 或scrcpy server已退出的预热hub"""
+        async with self.lock:
+            if self.closed or not self.warm_time:
+                return False
+            if time.time() - self.warm_time < ttl and self.device_client.server_alive:
+                return False
+            logging.info(f"【DeviceHub】({self.device_id}:{self.device_client.scid}) warm server expired")
+            await self.close()
+            return True
+
+    def start_adaptive(self):
+        device_client = self.device_client
+        if isinstance(device_client, DeviceClient) and device_client.adaptive_enable and not device_client.recorder_enable:
+            self.adaptive = AdaptiveController(self, self.scrcpy_kwargs)
+            self.adaptive.start()
+
+    async def restart_device_client(self, scid, scrcpy_kwargs):
+        """以新参数重启scrcpy server, 订阅者保持连接, 新的配置帧到达后前端重新配置解码器"""
+        async with self.lock:
+            if self.closed:
+                return
+            self.restarting = True
+            try:
+                await self.device_client.stop()
+                # 旧参数的帧已无意义, 丢弃以尽快消除积压延迟
+                for subscriber in self.subscribers.values():
+                    subscriber.drop_droppable()
+                self.device_client = DeviceClient(self, scid, scrcpy_kwargs)
+                await asyncio.wait_for(self.device_client.start(), self.start_timeout)
+            except Exception as e:
+                logging.error(f"【DeviceHub】({self.device_id}:{scid}) restart error {type(e)}: {e}")
+                self.restarting = False
+                await self.close_ws_clients()
+            finally:
+                self.restarting = False
+
+    async def close(self):
+        self.closed = True
+        if self.hubs.get(self.device_id) is self:
+            del self.hubs[self.device_id]
+        if self.adaptive:
+            await self.adaptive.stop()
+            self.adaptive = None
+        if self.device_client:
+            await self.device_client.stop()
+            self.device_client = None
+        # scrcpy server停止后才释放所有权
+        if self.registry:
+            await self.registry.release()
+            self.registry = None
+
+    def publish(self, frame_type, pts, data):
+        if frame_type == FRAME_TYPE_AUDIO_CONFIG:
+            self.gop_cache.put_audio_config(pts, data)
+        elif frame_type != FRAME_TYPE_AUDIO:
+            self.gop_cache.put_video(pts, data)
+        if self.registry:
+            self.registry.publish(frame_type, pts, data)
+        for subscriber in self.subscribers.values():
+            subscriber.feed(frame_type, pts, data)
+
+    def publish_video(self, pts, data):
+        self.publish(get_video_frame_type(pts), pts, data)
+
+    def publish_audio(self, pts, data, config=False):
+        """data: 已加上音频前缀的数据"""
+        self.publish(FRAME_TYPE_AUDIO_CONFIG if config else FRAME_TYPE_AUDIO, pts, data)
+
+    async def close_ws_clients(self):
+        if self.restarting:
+            return
+        # 多次调用ws-close，有且只有一次会生效，所以ws-client的disconnect方法只会执行一次
+        for subscriber in list(self.subscribers.values()):
+            await subscriber.close_client()
+
+    def ring_stats(self):
+        if self.registry and self.registry.ring:
+            return self.registry.ring.stats()
+        ring = getattr(self.device_client, 'ring', None)
+        return ring.stats() if ring else None
+
+    def stats(self):
+        return {
+            'device_id': self.device_id,
+            'scid': self.device_client.scid if self.device_client else None,
+            'source': self.device_client.__class__.__name__ if self.device_client else None,
+            'ref_count': self.ref_count,
+            'uptime': int(time.time() - self.created_time),
+            'gop_cache': self.gop_cache.stats(),
+            'ring': self.ring_stats(),
+            'adaptive': self.adaptive.stats() if self.adaptive else None,
+            'start_timings': getattr(self.device_client, 'start_timings', None),
+            'control': self.device_client.controller.stats() if self.device_client else None,
+            'recorder': self.device_client.recorder.stats() if getattr(self.device_client, 'recorder', None) else None,
+            'replay': self.device_client.replay.stats() if getattr(self.device_client, 'replay', None) else None,
+            'warm': bool(self.warm_time),
+            'warm_start': getattr(self.device_client, 'warm_start', False),
+            'subscribers': [subscriber.stats() for subscriber in self.subscribers.values()],
+        }
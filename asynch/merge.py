@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import logging
+
+from asynch.recorder import KeyframeIndex
+from asynch.faststart import faststart
+from django_scrcpy.settings import MEDIA_ROOT
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+# Video.config中决定能否stream copy拼接的参数
+MERGE_CONFIG_KEYS = ('video_codec', 'max_size', 'crop', 'audio', 'audio_codec')
+
+
+def video_filename(device_id, video_id, recorder_format):
+    """录屏文件路径, 与DeviceClient、RecordingSubscriber的命名一致"""
+    return os.path.join(MEDIA_ROOT, 'video', f"{device_id}_{video_id}.{recorder_format}")
+
+
+def merge_key(video):
+    """format与编码参数相同的录屏才能拼接"""
+    config = json.loads(video.config)
+    if not config.get('audio'):
+        config['audio_codec'] = None
+    return (video.device_id, video.format) + tuple(config.get(key) for key in MERGE_CONFIG_KEYS)
+
+
+def plan_merge(videos, max_gap=0, min_count=2):
+    """
+    videos按start_time排序, 相邻且merge_key相同的录屏分为一组, 间隔超过max_gap(秒, 0为不限制)时分组
+    return [[video, ...], ...], 只返回录屏数不少于min_count的分组
+    """
+    groups = []
+    current = []
+    for video in videos:
+        if current:
+            previous = current[-1]
+            if merge_key(video) != merge_key(previous) or \
+                    (max_gap and (video.start_time - previous.finish_time).total_seconds() > max_gap):
+                groups.append(current)
+                current = []
+        current.append(video)
+    if current:
+        groups.append(current)
+    return [group for group in groups if len(group) >= min_count]
+
+
+def merge_videos(output, filenames, recorder_format='mp4'):
+    """
+    多个录屏文件stream copy拼接为output, 同时生成关键帧索引, mp4的moov移动到文件头, 在merge的进程池中运行
+    无法读取或与第一个文件不兼容(分辨率、extradata不同)的文件跳过, 不拼接
+    return {'output', 'duration', 'merged': [拼接的文件], 'skipped': [跳过的文件], 'elapsed'}
+    """
+    from extension.recorder import Concat
+    start_time = time.perf_counter()
+    concat = Concat('matroska' if recorder_format == 'mkv' else recorder_format, output)
+    index = KeyframeIndex.create(output)
+    merged, skipped = [], []
+    try:
+        for filename in filenames:
+            keyframes = concat.add_input(filename)
+            if keyframes is None:
+                skipped.append(filename)
+                continue
+            for pts, offset in keyframes:
+                index.add(pts, offset)
+            merged.append(filename)
+    finally:
+        index.close()
+        duration = concat.close_container()
+    if recorder_format == 'mp4' and duration:
+        faststart(output)
+    return {
+        'output': output,
+        'duration': duration,
+        'merged': merged,
+        'skipped': skipped,
+        'elapsed': round(time.perf_counter() - start_time, 3),
+    }
@@ -0,0 +1,64 @@
+import json
+import asyncio
+import logging
+
+from asynch.hub import DeviceHub
+from django_scrcpy.settings import WARM_POOL_SIZE, WARM_POOL_TTL, WARM_POOL_ALL
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+class WarmPool:
+    """
+    scrcpy server预热池, 为在线设备提前部署并启动scrcpy server, ws_client连接时直接连接socket
+    1.每个worker最多预热WARM_POOL_SIZE个设备, 多worker时由DeviceRegistry保证一个设备只在一个worker预热
+    2.预热超过WARM_POOL_TTL秒仍未使用, 或scrcpy server已退出, 关闭后重新预热
+    3.预热的server被使用后, 会话结束时hub关闭, 下一轮后台补充
+    """
+    # 补充间隔,秒
+    interval = 10
+    task = None
+
+    @classmethod
+    def ensure_started(cls):
+        if WARM_POOL_SIZE and cls.task is None:
+            cls.task = asyncio.create_task(cls._pool_task())
+
+    @classmethod
+    async def get_candidates(cls):
+        """return [(device_id, scrcpy_kwargs), ...], 在线且需要预热的设备"""
+        from general.adb import AdbDevice
+        from general.models import Mobile
+        devices = await asyncio.to_thread(AdbDevice.list, True)
+        candidates = []
+        async for mobile in Mobile.objects.all():
+            if not devices.get(mobile.device_id, {}).get('online'):
+                continue
+            # 与MobileAdmin.screen访问时使用的config一致, 才能直接使用预热的server
+            scrcpy_kwargs = json.loads(mobile.config)
+            if WARM_POOL_ALL or scrcpy_kwargs.get('warm_pool'):
+                candidates.append((mobile.device_id.replace(',', '.').replace('_', ':'), scrcpy_kwargs))
+        return candidates
+
+    @classmethod
+    async def refill(cls):
+        # 1.关闭过期的预热
+        for hub in list(DeviceHub.hubs.values()):
+            await hub.close_idle(WARM_POOL_TTL)
+        # 2.补充预热
+        warm_count = sum(1 for hub in DeviceHub.hubs.values() if hub.warm_time)
+        for device_id, scrcpy_kwargs in await cls.get_candidates():
+            if warm_count >= WARM_POOL_SIZE:
+                break
+            if await DeviceHub.warm(device_id, scrcpy_kwargs):
+                warm_count += 1
+
+    @classmethod
+    async def _pool_task(cls):
+        logging.info(f"【WarmPool】 =======> start, size: {WARM_POOL_SIZE}, ttl: {WARM_POOL_TTL}")
+        while True:
+            try:
+                await cls.refill()
+            except Exception as e:
+                logging.error(f"【WarmPool】 refill error {type(e)}: {e}")
+            await asyncio.sleep(cls.interval)
+
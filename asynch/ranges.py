@@ -0,0 +1,279 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import secrets
+import mimetypes
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from asynch.device import DeviceClient
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+# 没有对应Video的录屏文件, 在该时间(秒)内有修改视为其它worker正在录制
+RECORDING_MTIME = 15
+# 正在录制的文件, 请求的位置还未写入时等待的时间,秒
+RECORDING_WAIT = 5
+# 正在录制的文件检查增长的间隔,秒
+RECORDING_POLL = 0.2
+# 每次读取的字节数
+READ_CHUNK = 1024 * 1024
+# 一个请求最多的range数, 超过时忽略Range返回整个文件
+MAX_RANGES = 16
+# ASGI扩展: 服务器直接sendfile文件描述符, 数据不经过Python
+ZEROCOPY_SEND = 'http.response.zerocopysend'
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+async def has_video(full_filename):
+    """录屏文件名为{device_id}_{video_id}.{format}, device_id和video_id都可能含有_, 按每个_拆分查询"""
+    from general.models import Video
+    name, ext = os.path.splitext(os.path.basename(full_filename))
+    query = Q()
+    for idx, char in enumerate(name):
+        if char == '_':
+            query |= Q(device_id=name[:idx], video_id=name[idx + 1:])
+    if not query:
+        return False
+    return await Video.objects.filter(query, format=ext[1:]).aexists()
+
+
+async def is_recording(full_filename):
+    """
+    1.本进程正在录制的文件
+    2.录制结束后才保存Video, 有对应Video的文件已完成
+    3.都不是时可能是其它worker正在录制的文件, 最近RECORDING_MTIME秒内有修改才视为正在录制
+    """
+    if full_filename in DeviceClient.recording_files:
+        return True
+    if await has_video(full_filename):
+        return False
+    return time.time() - os.path.getmtime(full_filename) < RECORDING_MTIME
+
+
+async def wait_growth(full_filename, size, timeout=RECORDING_WAIT):
+    """等待正在录制的文件大于size, return 当前大小"""
+    deadline = time.monotonic() + timeout
+    current = os.path.getsize(full_filename)
+    while current <= size and time.monotonic() < deadline and await is_recording(full_filename):
+        await asyncio.sleep(RECORDING_POLL)
+        current = os.path.getsize(full_filename)
+    return current
+
+
+def parse_range(range_header):
+    """
+    "bytes=0-499,1000-,-500" -> [(0, 499), (1000, None), (None, 500)]
+    不是bytes单位、格式错误或range数超过MAX_RANGES时return None, 按没有Range处理
+    """
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        match = RANGE_RE.match(spec)
+        if not match or not any(match.groups()):
+            return None
+        first, last = (int(value) if value else None for value in match.groups())
+        if first is not None and last is not None and last < first:
+            return None
+        ranges.append((first, last))
+    return ranges if len(ranges) <= MAX_RANGES else None
+
+
+def resolve_ranges(ranges, size):
+    """按文件大小转换为[(start, end), ...](含end), 丢弃不可满足的range, 重叠和相邻的range合并"""
+    resolved = []
+    for first, last in ranges:
+        if first is None:
+            if not last:
+                continue
+            start, end = max(size - last, 0), size - 1
+        else:
+            start, end = first, size - 1 if last is None else min(last, size - 1)
+        if start < size:
+            resolved.append((start, end))
+    resolved.sort()
+    merged = []
+    for start, end in resolved:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(stat):
+    return quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+
+def not_modified(request, etag, last_modified):
+    """If-None-Match优先于If-Modified-Since"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag in (tag.removeprefix('W/') for tag in etags)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def if_range_matches(request, etag, last_modified):
+    """If-Range与当前文件一致时Range才生效, 只接受强ETag或完全相同的Last-Modified"""
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return etag is not None and if_range == etag
+    return last_modified is not None and parse_http_date_safe(if_range) == last_modified
+
+
+class FileRangeResponse(StreamingHttpResponse):
+    """
+    文件的一个或多个区间, 由segments描述: bytes(multipart的分隔头) 或 (offset, length)
+    1.默认在线程池中os.pread读取READ_CHUNK, 每块一次系统调用, 不阻塞事件循环
+    2.ASGI服务器支持http.response.zerocopysend时由RangeASGIHandler交给服务器sendfile
+    3.length为None时读到文件末尾, follow为True时等待正在录制的文件继续增长, 直到录制结束, 此时不能zerocopy
+    """
+    def __init__(self, filename, segments, follow=False, *args, **kwargs):
+        self.filename = filename
+        self.segments = segments
+        self.follow = follow
+        super().__init__(self.iter_segments(), *args, **kwargs)
+
+    @property
+    def zerocopy(self):
+        return all(isinstance(segment, bytes) or segment[1] is not None for segment in self.segments)
+
+    async def iter_segments(self):
+        fd = os.open(self.filename, os.O_RDONLY)
+        try:
+            for segment in self.segments:
+                if isinstance(segment, bytes):
+                    yield segment
+                    continue
+                offset, remaining = segment
+                while remaining is None or remaining > 0:
+                    size = READ_CHUNK if remaining is None else min(remaining, READ_CHUNK)
+                    data = await asyncio.to_thread(os.pread, fd, size, offset)
+                    if not data:
+                        if self.follow and (await wait_growth(self.filename, offset) > offset or await is_recording(self.filename)):
+                            continue
+                        break
+                    offset += len(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+                    yield data
+        finally:
+            os.close(fd)
+
+    async def send_zerocopy(self, send):
+        """segments通过http.response.zerocopysend发送, 分隔头通过http.response.body发送"""
+        with open(self.filename, 'rb') as f:
+            for segment in self.segments:
+                if isinstance(segment, bytes):
+                    await send({'type': 'http.response.body', 'body': segment, 'more_body': True})
+                else:
+                    await send({'type': ZEROCOPY_SEND, 'file': f, 'offset': segment[0], 'count': segment[1], 'more_body': True})
+        await send({'type': 'http.response.body'})
+
+
+async def serve_file(request, filename, content_type=None, attachment=False, recording=None):
+    """
+    视频文件的Range响应, asynch的video_stream和VideoModelViewSet.stream共用
+    1.按请求的区间返回, 支持多个区间(multipart/byteranges)、后缀区间(bytes=-500)
+    2.已完成的文件返回ETag和Last-Modified, 支持If-None-Match、If-Modified-Since(304)和If-Range
+    3.正在录制的文件(fMP4)大小不断增长, 总大小未知: 不返回校验信息, Content-Range总大小为*,
+      请求的位置还未写入时等待, 没有Range时一直读到录制结束
+    4.recording为None时由is_recording判断, 调用方已知是否正在录制(如已有Video)时直接传入
+    """
+    stat = os.stat(filename)
+    size = stat.st_size
+    if recording is None:
+        recording = await is_recording(filename)
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = last_modified = None
+    if not recording:
+        etag, last_modified = file_etag(stat), int(stat.st_mtime)
+        if not_modified(request, etag, last_modified):
+            resp = HttpResponseNotModified()
+            resp['ETag'] = etag
+            resp['Last-Modified'] = http_date(last_modified)
+            return resp
+    ranges = parse_range(request.META.get('HTTP_RANGE', ''))
+    if ranges is not None and not if_range_matches(request, etag, last_modified):
+        ranges = None
+    total = '*' if recording else size
+    if ranges is None:
+        resp = FileRangeResponse(filename, [(0, None if recording else size)], follow=recording, content_type=content_type)
+        if not recording:
+            resp['Content-Length'] = str(size)
+        if attachment:
+            resp['Content-Disposition'] = 'attachment;filename="%s"' % os.path.basename(filename)
+    else:
+        if recording and all(first is not None and first >= size for first, _ in ranges):
+            size = await wait_growth(filename, min(first for first, _ in ranges))
+        resolved = resolve_ranges(ranges, size)
+        if not resolved:
+            resp = HttpResponse(status=416)
+            resp['Content-Range'] = 'bytes */%s' % size
+            return resp
+        if len(resolved) == 1:
+            start, end = resolved[0]
+            resp = FileRangeResponse(filename, [(start, end - start + 1)], status=206, content_type=content_type)
+            resp['Content-Length'] = str(end - start + 1)
+            resp['Content-Range'] = 'bytes %s-%s/%s' % (start, end, total)
+        else:
+            boundary = secrets.token_hex(16)
+            segments = []
+            for start, end in resolved:
+                segments.append(f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+                                f"Content-Range: bytes {start}-{end}/{total}\r\n\r\n".encode())
+                segments.append((start, end - start + 1))
+            segments.append(f"\r\n--{boundary}--\r\n".encode())
+            resp = FileRangeResponse(filename, segments, status=206,
+                                     content_type=f'multipart/byteranges; boundary={boundary}')
+            resp['Content-Length'] = str(sum(len(s) if isinstance(s, bytes) else s[1] for s in segments))
+    if etag is not None:
+        resp['ETag'] = etag
+        resp['Last-Modified'] = http_date(last_modified)
+    resp['Accept-Ranges'] = 'bytes'
+    return resp
+
+
+class RangeASGIHandler(ASGIHandler):
+    """ASGI服务器在scope的extensions中声明http.response.zerocopysend时, FileRangeResponse由服务器sendfile发送"""
+    async def handle(self, scope, receive, send):
+        if ZEROCOPY_SEND in (scope.get('extensions') or {}):
+            send = ZerocopySend(send)
+        await super().handle(scope, receive, send)
+
+    async def send_response(self, response, send):
+        if not isinstance(send, ZerocopySend) or not isinstance(response, FileRangeResponse) or not response.zerocopy:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append((b"Set-Cookie", c.output(header="").encode("ascii").strip()))
+        await send({"type": "http.response.start", "status": response.status_code, "headers": response_headers})
+        await response.send_zerocopy(send)
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+class ZerocopySend:
+    """标记支持zerocopysend的ASGI send"""
+    def __init__(self, send):
+        self.send = send
+
+    async def __call__(self, message):
+        await self.send(message)
+
@@ -0,0 +1,302 @@
+import os
+import time
+import array
+import datetime
+import queue
+import bisect
+import asyncio
+import logging
+import threading
+
+from asynch.constants import sc_packet_flag
+from django_scrcpy.settings import RECORDER_QUEUE_SIZE
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+# fMP4: 空moov, 每个关键帧或每秒一个moof/mdat分片, 每个packet后flush, 录制中的文件可直接播放
+FRAGMENTED_MP4_OPTIONS = {
+    'movflags': 'frag_keyframe+empty_moov+default_base_moof',
+    'frag_duration': '1000000',
+    'flush_packets': '1',
+}
+
+
+def open_recorder(filename, recorder_format, video_audio_info, video_header, audio_header=None, fragmented=False):
+    """
+    创建Recorder并写入文件头
+    video_audio_info: video_encode、width、height、audio_encoder; video_header/audio_header: (pts, data), audio_header为None时不录音频
+    """
+    from extension.recorder import Recorder
+    recorder = Recorder('matroska' if recorder_format == 'mkv' else recorder_format, filename, audio_header is not None)
+    assert recorder.add_video_stream(video_audio_info['video_encode'], video_audio_info['width'], video_audio_info['height'])
+    assert recorder.write_video_header(video_header[0], len(video_header[1]), video_header[1])
+    if audio_header is not None:
+        assert recorder.add_audio_stream(video_audio_info['audio_encoder'])
+        assert recorder.write_audio_header(audio_header[0], len(audio_header[1]), audio_header[1])
+    assert recorder.write_header(FRAGMENTED_MP4_OPTIONS if fragmented and recorder_format == 'mp4' else None)
+    return recorder
+
+
+async def save_video(filename, segment, **fields):
+    """
+    已关闭的录屏文件保存为Video, segment见RecorderWriter.segment_info, fields: video_id、device_id、format、config、group_id
+    时长为0或保存失败时删除录屏文件和关键帧索引, 并抛出异常
+    """
+    from general.models import Video
+    try:
+        assert segment['duration'], 'duration is 0'
+        await Video.objects.acreate(
+            duration=segment['duration'],
+            size=int(os.path.getsize(filename) / 1024),
+            start_time=datetime.datetime.fromtimestamp(segment['start_time']),
+            finish_time=datetime.datetime.fromtimestamp(segment['finish_time']),
+            segment_index=segment['index'],
+            **fields,
+        )
+    except Exception:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        KeyframeIndex.remove(filename)
+        raise
+
+
+class KeyframeIndex:
+    """
+    录屏的关键帧索引, 与录屏文件同名加.idx后缀, 边录边写, 录制中的文件也可使用
+    1.文件内容为int64数组(本机字节序): [pts_0, offset_0, pts_1, offset_1, ...]
+    2.pts为相对分段第一帧的微秒数, offset为关键帧之前的写入位置, 从offset开始读取一定包含该关键帧
+    """
+    suffix = '.idx'
+
+    def __init__(self, filename, entries=None):
+        self.filename = filename
+        self.entries = entries if entries is not None else array.array('q')
+        self.file = None
+
+    @classmethod
+    def index_filename(cls, video_filename):
+        return video_filename + cls.suffix
+
+    @classmethod
+    def create(cls, video_filename):
+        index = cls(cls.index_filename(video_filename))
+        index.file = open(index.filename, 'wb')
+        return index
+
+    @classmethod
+    def load(cls, video_filename):
+        entries = array.array('q')
+        with open(cls.index_filename(video_filename), 'rb') as f:
+            data = f.read()
+        # 录制中的文件可能只写入了半条
+        entries.frombytes(data[:len(data) - len(data) % (entries.itemsize * 2)])
+        return cls(cls.index_filename(video_filename), entries)
+
+    def add(self, pts, offset):
+        entry = array.array('q', (pts, offset))
+        self.entries.extend(entry)
+        entry.tofile(self.file)
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __len__(self):
+        return len(self.entries) // 2
+
+    def lookup(self, timestamp):
+        """
+        timestamp(秒)所在gop的字节范围, 没有关键帧时return None
+        return {'timestamp': 关键帧的时间(秒), 'start': 起始字节, 'end': 结束字节(含), 最后一个gop为None即到文件末尾}
+        """
+        if not len(self):
+            return None
+        pts_list = self.entries[0::2]
+        idx = max(bisect.bisect_right(pts_list, int(timestamp * 1000000)) - 1, 0)
+        return {
+            'timestamp': pts_list[idx] / 1000000,
+            'start': self.entries[idx * 2 + 1],
+            'end': self.entries[idx * 2 + 3] - 1 if idx + 1 < len(self) else None,
+        }
+
+    @classmethod
+    def remove(cls, video_filename):
+        try:
+            os.remove(cls.index_filename(video_filename))
+        except FileNotFoundError:
+            pass
+
+
+class RecorderWriter:
+    """
+    录屏写入线程: 事件循环只把packet放入有界队列, 由线程调用Recorder写入, Recorder在libav调用期间释放GIL
+    1.队列满时丢弃视频delta帧直到下一个关键帧, 丢弃音频帧; 配置帧不丢弃, 丢弃队列中积压的packet后入队
+    2.写入失败后不再写入, 关闭时返回的时长为0
+    3.分段: 当前分段超过segment_time秒或segment_size字节后, 在下一个关键帧关闭当前文件, 由open_segment打开新文件
+    4.video_filename(segment_index)返回分段的录屏文件名时, 写入时为每个分段生成KeyframeIndex
+    """
+    def __init__(self, recorder, device_id, scid, queue_size=RECORDER_QUEUE_SIZE, segment_time=0, segment_size=0,
+                 open_segment=None, on_segment=None, video_filename=None):
+        self.recorder = recorder
+        self.device_id = device_id
+        self.scid = scid
+        # 分段参数, 0为不分段
+        self.segment_time = segment_time
+        self.segment_size = segment_size
+        # open_segment(index, video_header) -> recorder, 在写入线程中调用
+        self.open_segment = open_segment
+        # on_segment(segment), 分段关闭后在写入线程中调用, segment见segment_info
+        self.on_segment = on_segment
+        self.segment_index = 0
+        self.segment_start_pts = None
+        self.segment_bytes = 0
+        self.video_filename = video_filename
+        self.index = KeyframeIndex.create(video_filename(0)) if video_filename else None
+        # 最近的视频配置帧(pts, data), 作为新分段的header
+        self.video_header = None
+        # (typ, pts, data), None表示结束
+        self.queue = queue.Queue(queue_size)
+        # 丢帧后等待关键帧
+        self.wait_keyframe = False
+        self.error = None
+        self.duration = 0
+        # 统计
+        self.written_packets = 0
+        self.dropped_packets = 0
+        self.max_queue_depth = 0
+        # 线程写入耗时,秒
+        self.write_time = 0
+        self.thread = threading.Thread(target=self._write_thread, name=f"recorder_{scid}", daemon=True)
+        self.thread.start()
+
+    @property
+    def start_time(self):
+        return self.recorder.start_time
+
+    @property
+    def finish_time(self):
+        return self.recorder.finish_time
+
+    def write(self, pts, data, typ='video'):
+        if self.error:
+            return
+        if typ == 'video' and not pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+            if pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+                self.wait_keyframe = False
+            elif self.wait_keyframe:
+                self.dropped_packets += 1
+                return
+        try:
+            self.queue.put_nowait((typ, pts, data))
+        except queue.Full:
+            if typ == 'video' and pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+                # 配置帧必须写入, 磁盘阻塞时不能在事件循环中等待线程腾出位置, 丢弃积压的packet, 从下一个关键帧继续
+                self.dropped_packets += self.drop_backlog()
+                self.queue.put_nowait((typ, pts, data))
+                self.wait_keyframe = True
+                return
+            self.dropped_packets += 1
+            if typ == 'video':
+                self.wait_keyframe = True
+            return
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def drop_backlog(self):
+        """清空队列, 只有事件循环向队列写入, 清空后put_nowait不会失败, return 丢弃的packet数"""
+        dropped = 0
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return dropped
+            dropped += 1
+
+    def _write_thread(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                continue
+            typ, pts, data = item
+            start_time = time.perf_counter()
+            try:
+                if typ == 'video':
+                    if pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+                        self.video_header = (pts, data)
+                    elif pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME and self.need_rollover(pts):
+                        self.rollover(pts)
+                    if self.segment_start_pts is None and not pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+                        self.segment_start_pts = pts & sc_packet_flag.SC_PACKET_PTS_MASK
+                    if self.index is not None and pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME and not pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+                        self.index.add((pts & sc_packet_flag.SC_PACKET_PTS_MASK) - self.segment_start_pts, self.recorder.tell())
+                    self.segment_bytes += len(data)
+                    assert self.recorder.write_video_packet(pts, len(data), data)
+                else:
+                    assert self.recorder.write_audio_packet(pts, len(data), data)
+                self.written_packets += 1
+            except Exception as e:
+                self.error = e
+                logging.error(f"【RecorderWriter】({self.device_id}:{self.scid}) recorder_error write {typ} {type(e)}: {str(e)}")
+            self.write_time += time.perf_counter() - start_time
+        if not self.error:
+            self.duration = self.recorder.close_container()
+        if self.index is not None:
+            self.index.close()
+
+    def need_rollover(self, pts):
+        if not self.open_segment or self.segment_start_pts is None:
+            return False
+        if self.segment_time and (pts & sc_packet_flag.SC_PACKET_PTS_MASK) - self.segment_start_pts >= self.segment_time * 1000000:
+            return True
+        return bool(self.segment_size and self.segment_bytes >= self.segment_size)
+
+    def segment_info(self, duration):
+        return {
+            'index': self.segment_index,
+            'duration': duration,
+            'start_time': self.recorder.start_time,
+            'finish_time': self.recorder.finish_time,
+        }
+
+    def rollover(self, pts):
+        """关闭当前分段, 打开下一个分段, 由写入线程在关键帧前调用"""
+        duration = self.recorder.close_container()
+        # Recorder的时长不含最后一帧, 分段时长以下一个分段的起始pts计算
+        if duration:
+            duration = round(((pts & sc_packet_flag.SC_PACKET_PTS_MASK) - self.segment_start_pts) / 1000000)
+        segment = self.segment_info(duration)
+        self.segment_index += 1
+        self.segment_start_pts = None
+        self.segment_bytes = 0
+        self.recorder = self.open_segment(self.segment_index, self.video_header)
+        if self.index is not None:
+            self.index.close()
+            self.index = KeyframeIndex.create(self.video_filename(self.segment_index))
+        logging.info(f"【RecorderWriter】({self.device_id}:{self.scid}) segment {segment['index']} closed, duration {duration}s")
+        if self.on_segment:
+            self.on_segment(segment)
+
+    async def close(self):
+        """写完队列中的packet并关闭容器, return 最后一个分段的录屏时长(秒)"""
+        await asyncio.to_thread(self.queue.put, None)
+        await asyncio.to_thread(self.thread.join)
+        logging.info(f"【RecorderWriter】({self.device_id}:{self.scid}) closed {self.stats()}")
+        return self.duration
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'written_packets': self.written_packets,
+            'segment_index': self.segment_index,
+            'keyframes': len(self.index) if self.index is not None else 0,
+            'dropped_packets': self.dropped_packets,
+            'write_time': round(self.write_time, 3),
+            'error': str(self.error) if self.error else None,
+        }
+
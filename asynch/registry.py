@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+from collections import deque
+
+from asynch.device import DeviceController
+from asynch.subscriber import HubSubscriber
+from asynch.tools.ring import RingWriter, RingReader, get_ring_name
+from asynch.tools.cache import FRAME_TYPE_KEY, FRAME_TYPE_CONFIG, FRAME_TYPE_AUDIO_CONFIG
+from django_scrcpy.settings import DEVICE_REGISTRY_DIR, DEVICE_RING_SIZE
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# 所有者 -> 其它worker: kind(1) + frame_type(1) + pts(8) + length(4)
+PEER_FRAME = struct.Struct('>BBQI')
+PEER_KIND_PACKET = 0
+PEER_KIND_INFO = 1
+PEER_KIND_REPLY = 2
+# 共享内存ring中有新的packet
+PEER_KIND_RING = 3
+# 其它worker -> 所有者: kind(1) + length(4)
+PEER_REQUEST = struct.Struct('>BI')
+PEER_REQUEST_HELLO = 0
+PEER_REQUEST_CONTROL = 1
+PEER_REQUEST_GET_CLIPBOARD = 2
+PEER_REQUEST_SET_CLIPBOARD = 3
+# 远端worker上报各订阅者的sent_bytes、丢帧和发送队列延迟, 供AdaptiveController使用
+PEER_REQUEST_STATS = 4
+
+
+def get_registry_path(device_id, suffix):
+    name = device_id.replace(':', '_').replace('/', '_').replace('.', ',')
+    return os.path.join(DEVICE_REGISTRY_DIR, f"{name}.{suffix}")
+
+
+class RegistryPeer(HubSubscriber):
+    """
+    所有者worker上代表一个远端worker的订阅者
+    ring_name为None时packet写入unix socket, 否则packet已写入共享内存ring, unix socket只发送通知
+    """
+    # 远端上报超过该时间(秒)未更新视为无数据
+    report_ttl = 6
+
+    def __init__(self, scid, reader, writer, ring_name=None):
+        self.reader = reader
+        self.writer = writer
+        self.ring_name = ring_name
+        self.notify_handle = None
+        # 远端worker上报的[[viewer_id, scid, sent_bytes, dropped_frames, queue_latency], ...]
+        self.remote_viewers = []
+        self.report_time = None
+        super().__init__(None)
+        self.scid = scid
+
+    @property
+    def client(self):
+        return self
+
+    def on_attach(self, hub):
+        device_client = hub.device_client
+        info = {
+            'scid': device_client.scid,
+            'device_name': device_client.device_name,
+            'scrcpy_kwargs': device_client.scrcpy_kwargs,
+            'raw_scrcpy_kwargs': device_client.raw_scrcpy_kwargs,
+            'recorder_filename': device_client.recorder_filename,
+            'ring': self.ring_name,
+            'video_audio_info': {k: v for k, v in device_client.video_audio_info.items() if not k.endswith('_header')},
+        }
+        self.write(PEER_KIND_INFO, 0, 0, json.dumps(info).encode())
+
+    def write(self, kind, frame_type, pts, data):
+        self.writer.write(PEER_FRAME.pack(kind, frame_type, pts, len(data)))
+        self.writer.write(data)
+
+    async def send(self, frame_type, pts, data):
+        self.write(PEER_KIND_PACKET, frame_type, pts, data)
+        await self.writer.drain()
+
+    def feed(self, frame_type, pts, data):
+        if self.ring_name is None:
+            return super().feed(frame_type, pts, data)
+        # 同一轮事件循环中的多个packet只通知一次
+        if self.notify_handle is None:
+            self.notify_handle = asyncio.get_running_loop().call_soon(self.notify)
+
+    def notify(self):
+        self.notify_handle = None
+        # 上一个通知还未发出, 远端worker读取时会一并读到新的packet
+        if self.writer.is_closing() or self.writer.transport.get_write_buffer_size():
+            return
+        self.write(PEER_KIND_RING, 0, 0, b'')
+        self.sent_frames += 1
+
+    def report(self, viewers):
+        self.remote_viewers = viewers
+        self.report_time = time.monotonic()
+
+    def viewer_stats(self):
+        """
+        ring模式下本对象只发送通知, 不反映远端订阅者的链路, 只使用远端上报的统计
+        unix socket模式下本对象的发送队列反映socket的拥塞, 同时计入
+        """
+        stats = [] if self.ring_name else super().viewer_stats()
+        if self.report_time and time.monotonic() - self.report_time < self.report_ttl:
+            for viewer_id, scid, sent_bytes, dropped_frames, queue_latency in self.remote_viewers:
+                stats.append(((self, viewer_id), scid, sent_bytes, dropped_frames, queue_latency))
+        return stats
+
+    async def close_client(self):
+        self.writer.close()
+
+    async def close(self):
+        if self.notify_handle:
+            self.notify_handle.cancel()
+            self.notify_handle = None
+        await super().close()
+
+
+class DeviceRegistry:
+    """
+    多worker共享的设备所有权, 基于文件锁和unix socket, 无需外部服务
+    1.获得{device}.lock文件锁的worker为所有者, 启动scrcpy server, 在{device}.sock上向其它worker转发数据
+    2.其它worker连接{device}.sock, 通过RemoteDeviceClient接收数据和转发控制消息
+    3.DEVICE_RING_SIZE大于0时, packet只写入一次共享内存ring, 其它worker直接从ring读取, unix socket只发送通知
+    worker退出时文件锁自动释放
+    """
+    def __init__(self, hub):
+        self.hub = hub
+        self.device_id = hub.device_id
+        self.lock_path = get_registry_path(self.device_id, 'lock')
+        self.sock_path = get_registry_path(self.device_id, 'sock')
+        self.lock_file = None
+        self.server = None
+        self.ring = None
+
+    def acquire(self):
+        if fcntl is None:
+            return True
+        os.makedirs(DEVICE_REGISTRY_DIR, exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        # scrcpy server启动时就会发布配置帧, 在启动之前创建ring
+        if DEVICE_RING_SIZE:
+            self.ring = RingWriter(get_ring_name(self.device_id), DEVICE_RING_SIZE)
+        logging.info(f"【DeviceRegistry】({self.device_id}) owner is worker {os.getpid()}")
+        return True
+
+    def publish(self, frame_type, pts, data):
+        if self.ring is None:
+            return
+        if frame_type == FRAME_TYPE_CONFIG:
+            self.ring.put_config(0, pts, data)
+        elif frame_type == FRAME_TYPE_AUDIO_CONFIG:
+            self.ring.put_config(1, pts, data)
+        self.ring.write(frame_type, pts, data, key=frame_type == FRAME_TYPE_KEY)
+
+    async def start_server(self):
+        if self.lock_file is None or self.server:
+            return
+        # 上一个所有者异常退出时遗留的socket文件
+        if os.path.exists(self.sock_path):
+            os.remove(self.sock_path)
+        self.server = await asyncio.start_unix_server(self.handle_peer, self.sock_path)
+
+    async def release(self):
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+        if self.server:
+            self.server.close()
+            self.server = None
+            try:
+                os.remove(self.sock_path)
+            except OSError:
+                pass
+        if self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+            logging.info(f"【DeviceRegistry】({self.device_id}) worker {os.getpid()} release owner")
+
+    async def handle_peer(self, reader, writer):
+        peer = None
+        try:
+            kind, length = PEER_REQUEST.unpack(await reader.readexactly(PEER_REQUEST.size))
+            assert kind == PEER_REQUEST_HELLO
+            hello = json.loads(await reader.readexactly(length))
+            peer = RegistryPeer(hello['scid'], reader, writer, self.ring.name if self.ring else None)
+            if not await self.hub.add_subscriber(peer, hello['scrcpy_kwargs']):
+                await peer.close()
+                writer.close()
+                return
+            while True:
+                kind, length = PEER_REQUEST.unpack(await reader.readexactly(PEER_REQUEST.size))
+                data = await reader.readexactly(length)
+                await self.handle_request(peer, kind, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"【DeviceRegistry】({self.device_id}) peer error {type(e)}: {e}")
+        finally:
+            writer.close()
+            if peer:
+                await self.hub.remove_subscriber(peer)
+
+    async def handle_request(self, peer, kind, data):
+        controller = self.hub.device_client.controller
+        if kind == PEER_REQUEST_CONTROL:
+            await controller.inject(data)
+        elif kind == PEER_REQUEST_GET_CLIPBOARD:
+            reply = await controller.get_clipboard(copy_key=data[0])
+            peer.write(PEER_KIND_REPLY, 0, 0, reply)
+        elif kind == PEER_REQUEST_SET_CLIPBOARD:
+            kwargs = json.loads(data)
+            reply = await controller.set_clipboard(**kwargs)
+            peer.write(PEER_KIND_REPLY, 0, 0, reply)
+        elif kind == PEER_REQUEST_STATS:
+            peer.report(json.loads(data))
+
+
+class RemoteDeviceController(DeviceController):
+    """控制消息转发给所有者worker"""
+    async def inject(self, msg):
+        await self.device.request(PEER_REQUEST_CONTROL, msg)
+
+    async def inject_without_lock(self, msg):
+        await self.device.request(PEER_REQUEST_CONTROL, msg)
+
+    async def get_clipboard(self, copy_key=1):
+        return await self.device.request(PEER_REQUEST_GET_CLIPBOARD, bytes([copy_key]), wait_reply=True)
+
+    async def set_clipboard(self, text, sequence=1, paste=True):
+        data = json.dumps({'text': text, 'sequence': sequence, 'paste': paste}).encode()
+        return await self.device.request(PEER_REQUEST_SET_CLIPBOARD, data, wait_reply=True)
+
+
+class RemoteDeviceClient:
+    """
+    非所有者worker的数据源, 与DeviceClient接口一致
+    从所有者worker接收音视频数据并发布到本worker的DeviceHub
+    """
+    # 连接所有者的重试间隔,秒
+    connect_interval = 0.05
+    # 向所有者上报订阅者统计的间隔,秒
+    report_interval = 2
+
+    def __init__(self, hub, scid, scrcpy_kwargs):
+        self.hub = hub
+        self.device_id = hub.device_id
+        self.scid = scid
+        self.raw_scrcpy_kwargs = dict(scrcpy_kwargs)
+        self.scrcpy_kwargs = scrcpy_kwargs
+        self.device_name = None
+        self.resolution = None
+        self.video_audio_info = dict()
+        self.recorder_filename = ''
+        self.controller = RemoteDeviceController(self)
+        self.sock_path = get_registry_path(self.device_id, 'sock')
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.report_task = None
+        self.ring = None
+        # 等待所有者回复的请求
+        self.reply_futures = deque()
+
+    async def start(self):
+        logging.info(f"【RemoteDeviceClient】({self.device_id}:{self.scid}) =======> attach to owner {self.sock_path}")
+        # 1.所有者可能还在启动scrcpy server, 重试连接
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.sock_path)
+                break
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(self.connect_interval)
+        hello = json.dumps({'scid': self.scid, 'scrcpy_kwargs': self.raw_scrcpy_kwargs}).encode()
+        await self.request(PEER_REQUEST_HELLO, hello)
+        # 2.所有者的会话信息
+        kind, frame_type, pts, length = PEER_FRAME.unpack(await self.reader.readexactly(PEER_FRAME.size))
+        if kind != PEER_KIND_INFO:
+            raise ConnectionError(f"{self.device_id} registry owner refused")
+        info = json.loads(await self.reader.readexactly(length))
+        self.scid = info['scid']
+        self.device_name = info['device_name']
+        self.scrcpy_kwargs = info['scrcpy_kwargs']
+        self.raw_scrcpy_kwargs = info['raw_scrcpy_kwargs']
+        self.recorder_filename = info['recorder_filename']
+        self.video_audio_info.update(info['video_audio_info'])
+        # 3.共享内存ring, 从配置帧+最近的关键帧开始读取
+        if info['ring']:
+            self.ring = RingReader(info['ring'])
+            for idx, pts, data in self.ring.read_configs():
+                self.hub.publish(FRAME_TYPE_AUDIO_CONFIG if idx else FRAME_TYPE_CONFIG, pts, data)
+            self.ring.seek_keyframe()
+            self.publish_ring()
+        self.read_task = asyncio.create_task(self._read_task())
+        self.report_task = asyncio.create_task(self._report_task())
+
+    async def request(self, kind, data, wait_reply=False):
+        future = None
+        if wait_reply:
+            future = asyncio.get_running_loop().create_future()
+            self.reply_futures.append(future)
+        self.writer.write(PEER_REQUEST.pack(kind, len(data)) + data)
+        await self.writer.drain()
+        if future:
+            return await future
+
+    async def _read_task(self):
+        try:
+            while True:
+                kind, frame_type, pts, length = PEER_FRAME.unpack(await self.reader.readexactly(PEER_FRAME.size))
+                data = await self.reader.readexactly(length)
+                if kind == PEER_KIND_PACKET:
+                    self.hub.publish(frame_type, pts, data)
+                elif kind == PEER_KIND_RING:
+                    self.publish_ring()
+                elif kind == PEER_KIND_REPLY and self.reply_futures:
+                    self.reply_futures.popleft().set_result(data)
+        finally:
+            # 所有者停止推流, 关闭本worker所有ws_client
+            await self.hub.close_ws_clients()
+
+    async def _report_task(self):
+        """所有者的AdaptiveController根据上报的统计判断本worker订阅者的链路"""
+        while True:
+            await asyncio.sleep(self.report_interval)
+            # 读取ring落后一圈被跳过的数据, 本worker所有订阅者都丢失了
+            skips = self.ring.skips if self.ring else 0
+            viewers = []
+            for subscriber in list(self.hub.subscribers.values()):
+                for key, scid, sent_bytes, dropped_frames, queue_latency in subscriber.viewer_stats():
+                    viewers.append([id(key), scid, sent_bytes, dropped_frames + skips, round(queue_latency, 3)])
+            try:
+                await self.request(PEER_REQUEST_STATS, json.dumps(viewers).encode())
+            except (ConnectionError, AttributeError):
+                return
+
+    def publish_ring(self):
+        for frame_type, pts, data in self.ring.read():
+            self.hub.publish(frame_type, pts, data)
+
+    async def stop(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.report_task:
+            self.report_task.cancel()
+            self.report_task = None
+        if self.read_task:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except BaseException:
+                pass
+            self.read_task = None
+        while self.reply_futures:
+            self.reply_futures.popleft().cancel()
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+        logging.info(f"【RemoteDeviceClient】({self.device_id}:{self.scid}) =======> stopped")
@@ -1,6 +1,7 @@
 import json
+import struct
 
-from asynch.constants import sc_copy_key, sc_screen_power_mode
+from asynch.constants import sc_control_msg_type, sc_copy_key, sc_screen_power_mode
 
 
 class ReceiveMsgObj:
@@ -32,6 +33,8 @@ class ReceiveMsgObj:
         self.end_y = None
         self.unit = 5
         self.delay = 0.005
+        # used for [gesture], 见Gesture.from_dict
+        self.gesture = None
 
     def format_text_data(self, data):
         data_dict = json.loads(data)
@@ -40,6 +43,69 @@ class ReceiveMsgObj:
             setattr(self, k, v)
 
 
+# 浏览器发送的二进制控制消息, 格式与scrcpy control_msg一致, 校验长度后直接转发到control_socket
+# 定长消息, msg_type -> 长度
+CONTROL_MSG_LENGTH = {
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_KEYCODE: 14,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT: 32,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_SCROLL_EVENT: 21,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_BACK_OR_SCREEN_ON: 2,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_EXPAND_NOTIFICATION_PANEL: 1,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_EXPAND_SETTINGS_PANEL: 1,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_COLLAPSE_PANELS: 1,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD: 2,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_SET_SCREEN_POWER_MODE: 2,
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_ROTATE_DEVICE: 1,
+}
+# 变长消息, msg_type -> (头部长度, 最大数据长度), 头部最后4字节为数据长度
+CONTROL_MSG_VAR_LENGTH = {
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT: (5, 300),
+    sc_control_msg_type.SC_CONTROL_MSG_TYPE_SET_CLIPBOARD: (14, (1 << 18) - 14),
+}
+# 需要等待设备回复的消息, 不能直接转发
+CONTROL_MSG_REPLY = (sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD, sc_control_msg_type.SC_CONTROL_MSG_TYPE_SET_CLIPBOARD)
+CONTROL_MSG_DATA_LENGTH = struct.Struct('>I')
+
+
+def utf8_truncate_index(buffer, max_length):
+    """buffer截断到不超过max_length字节, 不截断多字节字符, return 截断位置"""
+    if len(buffer) <= max_length:
+        return len(buffer)
+    index = max_length
+    # 0b10xxxxxx为多字节字符的后续字节
+    while index and buffer[index] & 0xC0 == 0x80:
+        index -= 1
+    return index
+
+
+def split_control_data(data, limit=True):
+    """
+    一个ws消息中可以包含多个控制消息
+    limit: 校验变长消息的最大数据长度, 只用于浏览器发送的二进制消息, 服务端注入的消息不校验
+    return [(msg_type, start, end), ...], 长度不合法时raise ValueError
+    """
+    messages = []
+    start, total = 0, len(data)
+    while start < total:
+        msg_type = data[start]
+        length = CONTROL_MSG_LENGTH.get(msg_type)
+        if length is None:
+            if msg_type not in CONTROL_MSG_VAR_LENGTH:
+                raise ValueError(f"unknown control msg_type {msg_type}")
+            header_length, max_length = CONTROL_MSG_VAR_LENGTH[msg_type]
+            if start + header_length > total:
+                raise ValueError(f"control msg_type {msg_type} incomplete")
+            data_length = CONTROL_MSG_DATA_LENGTH.unpack_from(data, start + header_length - 4)[0]
+            if limit and data_length > max_length:
+                raise ValueError(f"control msg_type {msg_type} too long {data_length}")
+            length = header_length + data_length
+        if start + length > total:
+            raise ValueError(f"control msg_type {msg_type} incomplete")
+        messages.append((msg_type, start, start + length))
+        start += length
+    return messages
+
+
 # b'\x00\x00\x00\x01' start is video stream, so b'\x00\x00\x00\x02' for other msg
 # b'\x00\x00\x00\x02\x00' get_clipboard_data
 def format_get_clipboard_data(data):
@@ -56,6 +122,20 @@ def format_other_data(data):
     return b'\x00\x00\x00\x02\x02' + data
 
 
+# b'\x00\x00\x00\x02\x03' save_replay结果
+def format_replay_data(data):
+    return b'\x00\x00\x00\x02\x03' + data
+
+
+# b'\x00\x00\x00\x02\x04' 加入已启动的会话时未生效的scrcpy参数, json
+def format_config_mismatch_data(data):
+    return b'\x00\x00\x00\x02\x04' + data
+
+
 # b'\x00\x00\x00\x03' audio nal data
+AUDIO_DATA_PREFIX = b'\x00\x00\x00\x03'
+
+
 def format_audio_data(data):
-    return b'\x00\x00\x00\x03' + data
+    return AUDIO_DATA_PREFIX + data
+
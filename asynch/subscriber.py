@@ -0,0 +1,125 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from asynch.tools.cache import FRAME_TYPE_KEY, FRAME_TYPE_DELTA, FRAME_TYPES_CONFIG
+from django_scrcpy.settings import SUBSCRIBER_QUEUE_SIZE
+logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
+
+
+class HubSubscriber:
+    """
+    ws_client的有界发送队列和发送task
+    队列满时丢弃delta帧直到下一个关键帧, 不阻塞设备读取
+    """
+    def __init__(self, ws_client, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.ws_client = ws_client
+        self.scid = ws_client.scid if ws_client else None
+        self.queue_size = queue_size
+        # [(frame_type, pts, data, enqueue_time), ...]
+        self.queue = deque()
+        self.queue_event = asyncio.Event()
+        # 丢帧后等待关键帧
+        self.wait_keyframe = False
+        # 加入已启动的会话时, 未生效的scrcpy参数, 见DeviceHub.add_subscriber
+        self.config_mismatch = None
+        # 统计
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.max_queue_depth = 0
+        # 帧在发送队列中的等待时间(秒), 指数平均
+        self.queue_latency = 0
+        self.send_task = asyncio.create_task(self._send_task())
+
+    @property
+    def client(self):
+        """DeviceHub中的订阅者key"""
+        return self.ws_client
+
+    def on_attach(self, hub):
+        """加入hub时，在补发gop缓存之前调用"""
+        pass
+
+    async def send(self, frame_type, pts, data):
+        await self.ws_client.send(bytes_data=data)
+
+    async def close_client(self):
+        await self.ws_client.close()
+
+    def drop_droppable(self):
+        """关键帧或配置帧入队时队列已满, 丢弃队列中所有可丢弃的帧"""
+        kept = deque(item for item in self.queue if item[0] in FRAME_TYPES_CONFIG)
+        self.dropped_frames += len(self.queue) - len(kept)
+        self.queue = kept
+
+    def feed(self, frame_type, pts, data):
+        # 1.等待关键帧期间，丢弃delta帧
+        if self.wait_keyframe:
+            if frame_type == FRAME_TYPE_DELTA:
+                self.dropped_frames += 1
+                return
+            if frame_type == FRAME_TYPE_KEY:
+                self.wait_keyframe = False
+        # 2.队列已满
+        if len(self.queue) >= self.queue_size:
+            if frame_type == FRAME_TYPE_KEY or frame_type in FRAME_TYPES_CONFIG:
+                self.drop_droppable()
+            else:
+                self.dropped_frames += 1
+                if frame_type == FRAME_TYPE_DELTA:
+                    self.wait_keyframe = True
+                return
+        self.queue.append((frame_type, pts, data, time.monotonic()))
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self.queue_event.set()
+
+    async def _send_task(self):
+        while True:
+            if not self.queue:
+                self.queue_event.clear()
+                await self.queue_event.wait()
+                continue
+            frame_type, pts, data, enqueue_time = self.queue.popleft()
+            self.queue_latency = self.queue_latency * 0.9 + (time.monotonic() - enqueue_time) * 0.1
+            try:
+                await self.send(frame_type, pts, data)
+            except Exception as e:
+                logging.error(f"【HubSubscriber】({self.scid}) send error {type(e)}: {e}")
+                await self.close_client()
+                return
+            self.sent_frames += 1
+            self.sent_bytes += len(data)
+
+    def get_queue_latency(self):
+        """发送阻塞时队列头部的帧等待时间也计入延迟"""
+        if self.queue:
+            return max(self.queue_latency, time.monotonic() - self.queue[0][3])
+        return self.queue_latency
+
+    def viewer_stats(self):
+        """AdaptiveController统计用, return [(key, scid, sent_bytes, dropped_frames, queue_latency), ...]"""
+        return [(self, self.scid, self.sent_bytes, self.dropped_frames, self.get_queue_latency())]
+
+    async def close(self):
+        self.send_task.cancel()
+        try:
+            await self.send_task
+        except asyncio.CancelledError:
+            pass
+        self.queue.clear()
+
+    def stats(self):
+        return {
+            'scid': self.scid,
+            'type': self.__class__.__name__,
+            'queue_depth': len(self.queue),
+            'max_queue_depth': self.max_queue_depth,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+            'dropped_frames': self.dropped_frames,
+            'queue_latency': round(self.queue_latency, 3),
+            'wait_keyframe': self.wait_keyframe,
+            'config_mismatch': self.config_mismatch or None,
+        }
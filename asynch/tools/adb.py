@@ -39,23 +39,37 @@ class AsyncAdbDevice:
     def get_adb_socket(self):
         return AsyncAdbSocket(socket_timeout=self.socket_timeout)
 
-    async def create_connection_socket(self, connect_name, timeout=300):
+    async def create_connection_socket(self, connect_name, timeout=300, ready=None, min_interval=0.005, max_interval=0.1):
+        """
+        timeout: 最长等待时间, 单位10ms
+        ready: asyncio.Event, 目标socket就绪时set, 立即重试; 未set时按指数退避重试
+        """
         socket = self.get_adb_socket()
-        for _ in range(timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout * 0.01
+        interval = min_interval
+        while True:
             try:
                 await socket.connect()
-                await socket.write(self.cmd_format(f'host:transport:{self.device_id}'))
-                assert await socket.read_exactly(4) == b'OKAY'
-                await socket.write(self.cmd_format(connect_name))
-                assert await socket.read_exactly(4) == b'OKAY'
+                # host:transport和目标服务两个请求一次发出, 减少一个往返
+                await socket.write(self.cmd_format(f'host:transport:{self.device_id}') + self.cmd_format(connect_name))
+                assert await socket.read_exactly(8) == b'OKAYOKAY'
                 return socket
             except Exception as e:
                 await socket.disconnect()
                 if isinstance(e, asyncio.CancelledError):
                     raise e
-            await asyncio.sleep(0.01)
-        else:
-            raise ConnectionError(f"{self.device_id} create_connection to {connect_name} error!!")
+            remain = deadline - loop.time()
+            if remain <= 0:
+                raise ConnectionError(f"{self.device_id} create_connection to {connect_name} error!!")
+            if ready is not None and not ready.is_set():
+                try:
+                    await asyncio.wait_for(ready.wait(), min(interval, remain))
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(min(interval, remain))
+            interval = min(interval * 2, max_interval)
 
     async def create_shell_socket(self, command, timeout=300):
         socket = self.get_adb_socket()
@@ -134,7 +148,8 @@ class AsyncAdbDevice:
     async def list_directory(self, path):
         return [_ async for _ in self.iter_directory(path)]
 
-    async def push_file(self, src, dst, mode=0o755, check=True):
+    async def push_file(self, src, dst, mode=0o755, check=True, mtime=None):
+        """mtime: 设备上文件的修改时间(时间戳), 默认为当前时间"""
         path = dst + "," + str(stat.S_IFREG | mode)
         socket = await self.create_sync_socket(path, 'SEND')
         try:
@@ -143,7 +158,7 @@ class AsyncAdbDevice:
                 while True:
                     chunk = f.read(4096)
                     if not chunk:
-                        mtime = int(datetime.datetime.now().timestamp())
+                        mtime = int(mtime or datetime.datetime.now().timestamp())
                         await socket.write(b"DONE" + struct.pack("<I", mtime))
                         break
                     await socket.write(b"DATA" + struct.pack("<I", len(chunk)))
@@ -0,0 +1,166 @@
+import collections
+
+from asynch.constants import sc_packet_flag
+
+
+# 帧类型, 决定发送队列满时能否丢弃
+FRAME_TYPE_CONFIG = 0
+FRAME_TYPE_KEY = 1
+FRAME_TYPE_DELTA = 2
+FRAME_TYPE_AUDIO = 3
+FRAME_TYPE_AUDIO_CONFIG = 4
+# 不可丢弃的帧
+FRAME_TYPES_CONFIG = (FRAME_TYPE_CONFIG, FRAME_TYPE_AUDIO_CONFIG)
+
+
+def get_video_frame_type(pts):
+    if pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+        return FRAME_TYPE_CONFIG
+    elif pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+        return FRAME_TYPE_KEY
+    return FRAME_TYPE_DELTA
+
+
+class GopCache:
+    """
+    缓存最近的视频配置帧、音频配置帧、最后一个关键帧及其后续帧
+    新加入的ws_client先收到缓存数据，无需等待下一个关键帧即可解码出画面
+    """
+    def __init__(self, max_bytes, max_frames):
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        # (pts, data)
+        self.video_config = None
+        self.audio_config = None
+        # 关键帧 + 后续帧, [(pts, data), ...]
+        self.frames = []
+        self.frames_bytes = 0
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.frames = []
+        self.frames_bytes = 0
+
+    def put_video(self, pts, data):
+        # 1.配置帧, 之前的gop失效
+        if pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+            self.video_config = (pts, data)
+            self.clear()
+        # 2.关键帧, 开始新的gop
+        elif pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+            self.clear()
+            self.append(pts, data)
+        # 3.后续帧, 无关键帧时缓存无意义
+        elif self.frames:
+            self.append(pts, data)
+
+    def put_audio_config(self, pts, data):
+        self.audio_config = (pts, data)
+
+    def append(self, pts, data):
+        if len(self.frames) >= self.max_frames or self.frames_bytes + len(data) > self.max_bytes:
+            # 超出限制，整个gop丢弃，等待下一个关键帧
+            self.evictions += 1
+            self.clear()
+            return
+        self.frames.append((pts, data))
+        self.frames_bytes += len(data)
+
+    def dump(self):
+        """返回新ws_client需要首先发送的数据, [(frame_type, pts, data), ...]"""
+        if self.frames:
+            self.hits += 1
+        else:
+            self.misses += 1
+        data = []
+        if self.video_config is not None:
+            data.append((FRAME_TYPE_CONFIG, *self.video_config))
+        if self.audio_config is not None:
+            data.append((FRAME_TYPE_AUDIO_CONFIG, *self.audio_config))
+        for idx, (pts, frame) in enumerate(self.frames):
+            data.append((FRAME_TYPE_DELTA if idx else FRAME_TYPE_KEY, pts, frame))
+        return data
+
+    def stats(self):
+        return {
+            'frames': len(self.frames),
+            'bytes': self.frames_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class ReplayBuffer:
+    """
+    即时回放: 按gop缓存最近max_seconds秒的编码数据(不解码), 保存时整体写入录屏文件
+    1.gops为deque, 每个gop: [起始pts, 字节数, 视频配置帧(pts, data), [(typ, pts, data), ...]], 淘汰最旧的gop为O(1)
+    2.去掉最旧的gop后时长仍不小于max_seconds, 或总字节数超过max_bytes时淘汰最旧的gop, 至少保留当前gop
+    3.第一个关键帧之前的数据无法解码, 不缓存
+    """
+    def __init__(self, max_seconds, max_bytes=0):
+        self.max_seconds = max_seconds
+        # 0为不限制
+        self.max_bytes = max_bytes
+        self.gops = collections.deque()
+        self.video_config = None
+        self.bytes = 0
+        self.packets = 0
+        self.last_pts = 0
+        # 统计
+        self.evictions = 0
+
+    @property
+    def duration(self):
+        """缓存的时长,秒"""
+        return (self.last_pts - self.gops[0][0]) / 1000000 if self.gops else 0
+
+    def put_video(self, pts, data):
+        if pts & sc_packet_flag.SC_PACKET_FLAG_CONFIG:
+            self.video_config = (pts, data)
+            return
+        if pts & sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME:
+            self.gops.append([pts & sc_packet_flag.SC_PACKET_PTS_MASK, 0, self.video_config, []])
+        self.last_pts = pts & sc_packet_flag.SC_PACKET_PTS_MASK
+        self.append('video', pts, data)
+        self.evict()
+
+    def put_audio(self, pts, data):
+        self.append('audio', pts, data)
+
+    def append(self, typ, pts, data):
+        if not self.gops:
+            return
+        gop = self.gops[-1]
+        gop[1] += len(data)
+        gop[3].append((typ, pts, data))
+        self.bytes += len(data)
+        self.packets += 1
+
+    def evict(self):
+        while len(self.gops) > 1:
+            if self.last_pts - self.gops[1][0] < self.max_seconds * 1000000 and not (self.max_bytes and self.bytes > self.max_bytes):
+                break
+            _, size, _, packets = self.gops.popleft()
+            self.bytes -= size
+            self.packets -= len(packets)
+            self.evictions += 1
+
+    def dump(self):
+        """
+        当前缓存的副本, 可在其它线程中写入文件
+        return [(视频配置帧, [(typ, pts, data), ...]), ...], 每个元素为一个gop
+        """
+        return [(video_config, list(packets)) for _, _, video_config, packets in self.gops]
+
+    def stats(self):
+        return {
+            'gops': len(self.gops),
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'duration': round(self.duration, 3),
+            'evictions': self.evictions,
+        }
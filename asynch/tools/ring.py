@@ -0,0 +1,230 @@
+import sys
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+from asynch.tools.cache import FRAME_TYPE_KEY, FRAME_TYPE_DELTA
+
+
+# ring头部: magic(4) + capacity(4) + write_pos(8) + reserve_pos(8) + last_key_pos(8) + config_seq(8)
+# + video_config: pts(8) + length(4) + audio_config: pts(8) + length(4)
+RING_HEADER = struct.Struct('<4sIQQQQQIQI')
+RING_MAGIC = b'SCRR'
+RING_HEADER_SIZE = 0x100
+# 配置帧单独存放, 不会被覆盖, 读者随时可从配置帧+最近的关键帧开始解码
+RING_CONFIG_SIZE = 0x10000
+RING_DATA_OFFSET = RING_HEADER_SIZE + RING_CONFIG_SIZE * 2
+# 记录头: pts(8) + length(4) + frame_type(1)
+RING_RECORD = struct.Struct('<QIB')
+# 数据区末尾放不下记录时, 写入填充记录, 读者跳回数据区开头
+RING_FRAME_TYPE_PAD = 0xff
+# RING_HEADER中各字段的偏移
+_OFFSET_WRITE_POS = 8
+_OFFSET_RESERVE_POS = 16
+_OFFSET_LAST_KEY_POS = 24
+_OFFSET_CONFIG_SEQ = 32
+_POS = struct.Struct('<Q')
+
+
+def get_ring_name(device_id):
+    return 'scrcpy_' + ''.join(c if c.isalnum() else '_' for c in device_id)
+
+
+class RingWriter:
+    """
+    设备所有者进程将packet写入multiprocessing.shared_memory环形缓冲区, 其它进程的RingReader直接读取
+    1.位置为单调递增的绝对值, 数据区偏移 = pos % capacity, 读者据此判断自己是否已被覆盖
+    2.先更新reserve_pos(包含填充和记录), 再写填充和记录, 最后更新write_pos
+      读者只读取write_pos之前的记录, 读取记录头和复制数据后都用reserve_pos判断是否被覆盖
+    3.只有一个写者, 无需加锁
+    """
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        # 上一个所有者异常退出时遗留的共享内存
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=RING_DATA_OFFSET + capacity)
+        self.buf = self.shm.buf
+        self.write_pos = 0
+        self.last_key_pos = 0
+        self.config_seq = 0
+        # video_config, audio_config: (pts, length)
+        self.configs = [(0, 0), (0, 0)]
+        self.records = 0
+        self.write_header()
+
+    def write_header(self):
+        (video_pts, video_length), (audio_pts, audio_length) = self.configs
+        RING_HEADER.pack_into(self.buf, 0, RING_MAGIC, self.capacity, self.write_pos, self.write_pos,
+                              self.last_key_pos, self.config_seq, video_pts, video_length, audio_pts, audio_length)
+
+    def put_config(self, idx, pts, data):
+        """idx: 0视频配置帧, 1音频配置帧"""
+        if len(data) > RING_CONFIG_SIZE:
+            return
+        # 奇数config_seq表示正在写入, 读者重试
+        self.config_seq += 1
+        _POS.pack_into(self.buf, _OFFSET_CONFIG_SEQ, self.config_seq)
+        offset = RING_HEADER_SIZE + RING_CONFIG_SIZE * idx
+        self.buf[offset:offset + len(data)] = data
+        self.configs[idx] = (pts, len(data))
+        self.config_seq += 1
+        self.write_header()
+
+    def write(self, frame_type, pts, data, key=False):
+        length = len(data)
+        record_size = RING_RECORD.size + length
+        if record_size > self.capacity:
+            return
+        offset = self.write_pos % self.capacity
+        pad_size = self.capacity - offset if offset + record_size > self.capacity else 0
+        # 1.先发布将要覆盖的范围, 落后一圈的读者在读到填充或记录头之前就能发现
+        _POS.pack_into(self.buf, _OFFSET_RESERVE_POS, self.write_pos + pad_size + record_size)
+        # 2.数据区末尾放不下, 填充后从开头写
+        if pad_size:
+            if pad_size >= RING_RECORD.size:
+                RING_RECORD.pack_into(self.buf, RING_DATA_OFFSET + offset, 0, 0, RING_FRAME_TYPE_PAD)
+            self.write_pos += pad_size
+            offset = 0
+        # 3.记录头+数据
+        start = RING_DATA_OFFSET + offset
+        RING_RECORD.pack_into(self.buf, start, pts, length, frame_type)
+        self.buf[start + RING_RECORD.size:start + record_size] = data
+        # 4.发布
+        if key:
+            self.last_key_pos = self.write_pos
+            _POS.pack_into(self.buf, _OFFSET_LAST_KEY_POS, self.last_key_pos)
+        self.write_pos += record_size
+        _POS.pack_into(self.buf, _OFFSET_WRITE_POS, self.write_pos)
+        self.records += 1
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'capacity': self.capacity,
+            'write_pos': self.write_pos,
+            'records': self.records,
+        }
+
+
+class RingReader:
+    """
+    读取RingWriter写入的packet, 数据从共享内存复制一次后交给调用者
+    落后超过一圈(数据已被覆盖)时, 跳到最近的关键帧继续读取
+    """
+    def __init__(self, name):
+        self.name = name
+        self.shm = self.open_shared_memory(name)
+        self.buf = self.shm.buf
+        magic, self.capacity, *_ = RING_HEADER.unpack_from(self.buf, 0)
+        if magic != RING_MAGIC:
+            raise ValueError(f"{name} is not a packet ring")
+        self.read_pos = 0
+        self.wait_keyframe = False
+        self.records = 0
+        self.skips = 0
+
+    @staticmethod
+    def open_shared_memory(name):
+        """只读方不负责unlink, 不注册到resource_tracker, 避免进程退出时删除所有者的共享内存"""
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+    def read_configs(self):
+        """return [(idx, pts, data), ...], idx: 0视频配置帧, 1音频配置帧"""
+        while True:
+            _, _, _, _, _, seq, video_pts, video_length, audio_pts, audio_length = RING_HEADER.unpack_from(self.buf, 0)
+            if seq & 1:
+                continue
+            configs = []
+            for idx, (pts, length) in enumerate(((video_pts, video_length), (audio_pts, audio_length))):
+                if length:
+                    offset = RING_HEADER_SIZE + RING_CONFIG_SIZE * idx
+                    configs.append((idx, pts, bytes(self.buf[offset:offset + length])))
+            if _POS.unpack_from(self.buf, _OFFSET_CONFIG_SEQ)[0] == seq:
+                return configs
+
+    def seek_keyframe(self):
+        """从最近的关键帧开始读取, 关键帧也已被覆盖时等待下一个关键帧"""
+        write_pos = _POS.unpack_from(self.buf, _OFFSET_WRITE_POS)[0]
+        self.read_pos = _POS.unpack_from(self.buf, _OFFSET_LAST_KEY_POS)[0]
+        if self.is_overwritten():
+            self.read_pos = write_pos
+            self.wait_keyframe = True
+
+    def is_overwritten(self):
+        return _POS.unpack_from(self.buf, _OFFSET_RESERVE_POS)[0] - self.read_pos > self.capacity
+
+    def read(self):
+        """读取write_pos之前的所有记录, return [(frame_type, pts, data), ...]"""
+        records = []
+        write_pos = _POS.unpack_from(self.buf, _OFFSET_WRITE_POS)[0]
+        while self.read_pos < write_pos:
+            # 1.已被覆盖
+            if self.is_overwritten():
+                self.skip()
+                write_pos = _POS.unpack_from(self.buf, _OFFSET_WRITE_POS)[0]
+                continue
+            offset = self.read_pos % self.capacity
+            # 2.末尾填充
+            if self.capacity - offset < RING_RECORD.size:
+                self.read_pos += self.capacity - offset
+                continue
+            start = RING_DATA_OFFSET + offset
+            pts, length, frame_type = RING_RECORD.unpack_from(self.buf, start)
+            # 3.读取记录头(包括填充记录)期间被写者覆盖, 记录头不可信
+            if self.is_overwritten():
+                continue
+            if frame_type == RING_FRAME_TYPE_PAD:
+                self.read_pos += self.capacity - offset
+                continue
+            data = bytes(self.buf[start + RING_RECORD.size:start + RING_RECORD.size + length])
+            # 4.复制期间被写者覆盖, 丢弃
+            if self.is_overwritten():
+                continue
+            self.read_pos += RING_RECORD.size + length
+            # 5.跳过后等待关键帧, 丢弃delta帧
+            if self.wait_keyframe:
+                if frame_type == FRAME_TYPE_DELTA:
+                    continue
+                if frame_type == FRAME_TYPE_KEY:
+                    self.wait_keyframe = False
+            records.append((frame_type, pts, data))
+            self.records += 1
+        return records
+
+    def skip(self):
+        self.skips += 1
+        self.seek_keyframe()
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'read_pos': self.read_pos,
+            'records': self.records,
+            'skips': self.skips,
+            'wait_keyframe': self.wait_keyframe,
+        }
+
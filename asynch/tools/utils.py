@@ -1,8 +1,140 @@
+import struct
+import random
+import asyncio
+from collections import deque
+
+
+# scrcpy frame_meta: pts(8) + data_length(4)
+FRAME_HEADER = struct.Struct('>QL')
+
+
+def create_scid():
+    """scrcpy投屏id, 同一个手机的scrcpy进程scid不能相同"""
+    return '0' + ''.join([hex(random.randint(0, 15))[-1] for _ in range(7)])
+
+
+class FrameDemuxer(asyncio.BufferedProtocol):
+    """
+    scrcpy音视频socket解包协议
+    socket数据直接读入可复用的缓冲区, 用预编译的Struct解析12字节frame_meta, 每个packet只分配一次内存
+    prefix: 输出数据的前缀(如音频数据前缀), 与payload一次拼接
+    """
+    def __init__(self, stream_protocol, prefix=b'', buffer_size=0x40000, max_frames=64):
+        # 原StreamReaderProtocol, 连接关闭和写流控仍交给它处理
+        self.stream_protocol = stream_protocol
+        self.prefix = prefix
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # 未解析数据在buffer中的区间 [start, end)
+        self.start = 0
+        self.end = 0
+        # 已解析的(pts, data)
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.waiter = None
+        self.transport = None
+        self.paused = False
+        self.eof = False
+        self.exception = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exception = exc
+        self.wakeup()
+        self.stream_protocol.connection_lost(exc)
+
+    def eof_received(self):
+        self.eof = True
+        self.wakeup()
+
+    def pause_writing(self):
+        self.stream_protocol.pause_writing()
+
+    def resume_writing(self):
+        self.stream_protocol.resume_writing()
+
+    def reserve(self, size):
+        """保证buffer末尾至少有size字节空闲"""
+        remain = self.end - self.start
+        if len(self.buffer) - self.end >= size:
+            return
+        # 1.已解析的数据前移
+        if self.start and len(self.buffer) - remain >= size:
+            self.buffer[:remain] = bytes(self.view[self.start:self.end])
+        # 2.单个packet大于buffer, 扩容(buffer已被memoryview引用, 不能原地resize)
+        else:
+            new_buffer = bytearray(max(len(self.buffer) * 2, remain + size))
+            new_buffer[:remain] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        self.start, self.end = 0, remain
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buffer):
+            self.reserve(max(sizehint, 0x10000))
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.parse()
+
+    def feed(self, data):
+        """切换协议前StreamReader中已缓存的数据"""
+        if data:
+            self.reserve(len(data))
+            self.buffer[self.end:self.end + len(data)] = data
+            self.end += len(data)
+            self.parse()
+
+    def parse(self):
+        header_size = FRAME_HEADER.size
+        while self.end - self.start >= header_size:
+            pts, data_length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            frame_end = self.start + header_size + data_length
+            if frame_end > self.end:
+                # 为不完整的packet预留空间
+                self.reserve(header_size + data_length - (self.end - self.start))
+                break
+            data = b''.join((self.prefix, self.view[self.start + header_size:frame_end]))
+            self.frames.append((pts, data))
+            self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.frames:
+            self.wakeup()
+        if len(self.frames) >= self.max_frames and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def wakeup(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read_frame(self):
+        while not self.frames:
+            if self.eof:
+                raise self.exception or asyncio.IncompleteReadError(b'', FRAME_HEADER.size)
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if self.paused and len(self.frames) <= self.max_frames // 2:
+            self.paused = False
+            self.transport.resume_reading()
+        return self.frames.popleft()
+
+
 class AsyncSocket:
     def __init__(self, socket_timeout=1, reader=None, writer=None):
         self.socket_timeout = socket_timeout
         self.reader = reader
         self.writer = writer
+        self.demuxer = None
 
     async def read(self, cnt=-1):
         return await self.reader.read(cnt)
@@ -28,6 +160,22 @@ class AsyncSocket:
     async def read_string_until(self, sep, encoding='utf-8'):
         return (await self.reader.readuntil(sep)).decode(encoding)
 
+    def attach_demuxer(self, prefix=b''):
+        """之后的数据由FrameDemuxer解析, 只能使用read_frame读取"""
+        transport = self.writer.transport
+        self.demuxer = FrameDemuxer(transport.get_protocol(), prefix=prefix)
+        self.demuxer.connection_made(transport)
+        transport.set_protocol(self.demuxer)
+        # StreamReader中已缓存的数据
+        self.demuxer.feed(bytes(self.reader._buffer))
+        self.reader._buffer.clear()
+        if not transport.is_reading():
+            transport.resume_reading()
+
+    async def read_frame(self):
+        """return (pts, data)"""
+        return await self.demuxer.read_frame()
+
     async def write(self, data):
         self.writer.write(data)
         await self.writer.drain()
@@ -39,4 +187,5 @@ class AsyncSocket:
                 await self.writer.wait_closed()
             except ConnectionAbortedError:
                 pass
-            self.writer = self.reader = None
+            self.writer = self.reader = self.demuxer = None
+
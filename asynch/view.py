@@ -1,31 +1,38 @@
 import os
-import re
 
-import mimetypes
-import aiofiles
 from ninja import NinjaAPI
+from ninja.security import django_auth
 
 from django.shortcuts import render
 from django.urls import reverse
-from django.http import StreamingHttpResponse
+from asynch.hub import DeviceHub
+from asynch.device import DeviceClient
+from asynch.merge import video_filename
+from asynch.ranges import serve_file
+from general.models import Video
 from django_scrcpy.settings import MEDIA_ROOT
 
 
 api = NinjaAPI(urls_namespace='asynch')
 
 
-async def file_iterator(file_name, chunk_size=8192*100, offset=0, length=None):
-        async with aiofiles.open(file_name, "rb") as f:
-            await f.seek(offset)
-            remaining = length
-            while True:
-                bytes_length = chunk_size if remaining is None else min(remaining, chunk_size)
-                data = await f.read(bytes_length)
-                if not data:
-                    break
-                if remaining:
-                    remaining -= len(data)
-                yield data
+# 与DeviceWebsocketConsumer一致, 需要登录
+@api.get("/device/stats", url_name='device-stats', auth=django_auth)
+async def device_stats(request):
+    return DeviceHub.all_stats()
+
+
+@api.post("/device/replay", url_name='device-replay', auth=django_auth)
+async def device_replay(request, device_id: str):
+    """把设备当前投屏的即时回放保存为录屏"""
+    hub = DeviceHub.hubs.get(device_id)
+    save_replay = getattr(hub.device_client, 'save_replay', None) if hub else None
+    if save_replay is None:
+        return api.create_response(request, {'detail': 'device not streaming in this worker'}, status=404)
+    video_id = await save_replay()
+    if video_id is None:
+        return api.create_response(request, {'detail': 'replay not available'}, status=400)
+    return {'video_id': video_id}
 
 
 @api.get("/video/play", url_name='video-play')
@@ -38,27 +45,15 @@ async def video_play(request, filename: str) ->str:
 @api.get("/video/stream", url_name='video-stream')
 async def video_stream(request, filename: str) -> str:
     full_filename = os.path.join(MEDIA_ROOT, "video", filename)
-    range_header = request.META.get('HTTP_RANGE', '').strip()
-    range_re = re.compile(r'bytes\s*=\s*(\d+)\s*-\s*(\d*)', re.I)
-    range_match = range_re.match(range_header)
-    size = os.path.getsize(full_filename)
-    if range_match:
-        content_type, encoding = mimetypes.guess_type(full_filename)
-        content_type = content_type or 'application/octet-stream'
-        first_byte, last_byte = range_match.groups()
-        first_byte = int(first_byte) if first_byte else 0
-        last_byte = first_byte + 1024 * 1024 * 8  # 8M 每片,响应体最大体积
-        if last_byte >= size:
-            last_byte = size - 1
-        length = last_byte - first_byte + 1
-        resp = StreamingHttpResponse(file_iterator(full_filename, offset=first_byte, length=length), status=206, content_type=content_type)
-        resp['Content-Length'] = str(length)
-        resp['Content-Range'] = 'bytes %s-%s/%s' % (first_byte, last_byte, size)
-    else:
-        content_type = 'application/octet-stream'
-        resp = StreamingHttpResponse(file_iterator(full_filename), content_type=content_type)
-        resp['Content-Length'] = str(size)
-        resp['Content-Disposition'] = 'attachment;filename="%s"' % os.path.basename(filename)
-    resp.is_async = True
-    resp['Accept-Ranges'] = 'bytes'
-    return resp
+    return await serve_file(request, full_filename, attachment=True)
+
+
+@api.get("/video/{video_id}/stream", url_name='video-id-stream', auth=django_auth)
+async def video_id_stream(request, video_id: str):
+    """Video的录屏文件, VideoModelViewSet.stream重定向到这里, 在事件循环中流式返回, 不占用同步线程"""
+    video = await Video.objects.filter(video_id=video_id).afirst()
+    if video is None:
+        return api.create_response(request, {'detail': 'video not found'}, status=404)
+    full_filename = video_filename(video.device_id, video.video_id, video.format)
+    # 录制结束后才保存Video, 只有即时回放等本进程正在写入的文件还在录制
+    return await serve_file(request, full_filename, recording=full_filename in DeviceClient.recording_files)
@@ -1,15 +1,18 @@
 import re
 import os
-import random
-import asyncio
+import json
+import struct
 import logging
 from urllib import parse
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from asynch.device import DeviceClient
+from asynch.hub import DeviceHub
+from asynch.gesture import Gesture
+from asynch.tools.utils import create_scid
 from asynch.constants import sc_control_msg_type
-from asynch.serializers import ReceiveMsgObj, format_get_clipboard_data, format_set_clipboard_data, format_other_data
+from asynch.serializers import ReceiveMsgObj, format_get_clipboard_data, format_set_clipboard_data, format_other_data, \
+    format_replay_data, format_config_mismatch_data, split_control_data, CONTROL_MSG_REPLY
 logging.basicConfig(format='%(asctime)s.%(msecs)s:%(name)s:%(thread)d:%(levelname)s:%(process)d:%(message)s', level=logging.INFO)
 
 
@@ -17,10 +20,15 @@ class DeviceWebsocketConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # 投屏的scid,极端情况下会出现scid重复的情况，同一个手机的scrcpy进程scid不能相同
-        self.scid = '0' + ''.join([hex(random.randint(0, 15))[-1] for _ in range(7)])
+        self.scid = create_scid()
         self.device_id = None
         self.query_params = None
-        self.device_client = None
+        self.device_hub = None
+
+    @property
+    def device_client(self):
+        """自适应画质切换时hub会重建device_client, 每次从hub获取"""
+        return self.device_hub.device_client if self.device_hub else None
 
     async def check_login(self):
         cookie_data = ''
@@ -49,22 +57,28 @@ class DeviceWebsocketConsumer(AsyncWebsocketConsumer):
         # 1.获取请求参数
         self.query_params = parse.parse_qs(self.scope['query_string'].decode('utf-8'))
         self.device_id = self.scope['url_route']['kwargs']['device_id'].replace(',', '.').replace('_', ':')
-        # 2.获取当前ws_client对应的 device_client
+        # 2.获取当前ws_client对应的 device_hub，同一设备的多个ws_client共享一个device_client
         await self.accept()
         logging.info(f"【DeviceWebsocketConsumer】({self.device_id}:{self.scid}) =======> connected")
-        self.device_client = DeviceClient(self, self.scid)
-        recorder_filename = self.device_client.recorder_filename.split(os.sep)[-1]
-        await self.send(format_other_data(recorder_filename.encode()))
         try:
-            await asyncio.wait_for(self.device_client.start(), 4)
+            self.device_hub = await DeviceHub.subscribe(self)
         except Exception as e:
             await self.close()
             logging.error(f"【DeviceWebsocketConsumer】({self.device_id}:{self.scid}) start session error {type(e)}!!!")
+            return
+        recorder_filename = self.device_client.recorder_filename.split(os.sep)[-1]
+        await self.send(bytes_data=format_other_data(recorder_filename.encode()))
+        # 3.共享的会话参数与请求的不一致, 告知前端哪些参数未生效
+        subscriber = self.device_hub.subscribers.get(self)
+        if subscriber and subscriber.config_mismatch:
+            await self.send(bytes_data=format_config_mismatch_data(json.dumps(subscriber.config_mismatch).encode()))
 
     async def receive(self, text_data=None, bytes_data=None):
         """receive used to control device"""
-        if not self.device_client.scrcpy_kwargs['control']:
+        if not self.device_client or not self.device_client.scrcpy_kwargs['control']:
             return
+        if bytes_data is not None:
+            return await self.receive_control_data(bytes_data)
         obj = ReceiveMsgObj()
         obj.format_text_data(text_data)
         # keycode
@@ -104,12 +118,55 @@ class DeviceWebsocketConsumer(AsyncWebsocketConsumer):
         # swipe
         elif obj.msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_SWIPE_EVENT:
             await self.device_client.controller.swipe(x=obj.x, y=obj.y, end_x=obj.end_x, end_y=obj.end_y, resolution=obj.resolution, unit=obj.unit, delay=obj.delay)
+        # gesture
+        elif obj.msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_GESTURE:
+            try:
+                gesture = Gesture.from_dict(obj.gesture, obj.resolution)
+                gesture.build()
+            except (ValueError, struct.error) as e:
+                logging.error(f"【DeviceWebsocketConsumer】({self.device_id}:{self.scid}) invalid gesture {e}")
+                return
+            await self.device_client.controller.play_gesture(gesture)
+        # save_replay, 其它worker中的投屏没有即时回放
+        elif obj.msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_SAVE_REPLAY:
+            save_replay = getattr(self.device_client, 'save_replay', None)
+            video_id = await save_replay() if save_replay else None
+            await self.send(bytes_data=format_replay_data((video_id or '').encode()))
         # update resolution
         elif obj.msg_type == 999:
             self.device_client.resolution = obj.resolution
 
+    async def receive_control_data(self, data):
+        """二进制控制消息, 格式与scrcpy control_msg一致, 校验后直接转发到control_socket"""
+        try:
+            messages = split_control_data(data)
+        except ValueError as e:
+            logging.error(f"【DeviceWebsocketConsumer】({self.device_id}:{self.scid}) invalid control data {e}")
+            return
+        controller = self.device_client.controller
+        # 连续的可转发消息合并为一次写入
+        start = 0
+        for msg_type, msg_start, msg_end in messages:
+            if msg_type not in CONTROL_MSG_REPLY:
+                continue
+            if msg_start > start:
+                await controller.inject(data[start:msg_start])
+            start = msg_end
+            # get_clipboard
+            if msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD:
+                reply = await controller.get_clipboard(copy_key=data[msg_start + 1])
+                await self.send(bytes_data=format_get_clipboard_data(reply))
+            # set_clipboard
+            else:
+                _, sequence, paste, _ = struct.unpack_from('>BQ?I', data, msg_start)
+                text = data[msg_start + 14:msg_end].decode('utf-8', 'replace')
+                reply = await controller.set_clipboard(text=text, sequence=sequence, paste=paste)
+                await self.send(bytes_data=format_set_clipboard_data(reply))
+        if start < len(data):
+            await controller.inject(data[start:] if start else data)
+
     async def disconnect(self, code):
-        if self.device_client:
-            await self.device_client.stop()
-            self.device_client = None
+        if self.device_hub:
+            await self.device_hub.remove_subscriber(self)
+            self.device_hub = None
         logging.info(f"【DeviceWebsocketConsumer】({self.device_id}:{self.scid}) =======> disconnected")
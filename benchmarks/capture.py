@@ -0,0 +1,56 @@
+"""
+1080p60 8Mbit/s 60秒, 原始抓取(缓冲/mmap) vs extension.recorder封装, 每个packet的CPU耗时
+在项目根目录运行:
+    python -m benchmarks.capture
+"""
+import os
+import time
+import logging
+import tempfile
+
+from asynch.capture import RawCapture
+from asynch.constants import sc_packet_flag
+from asynch.recorder import open_recorder
+try:
+    from extension.recorder import Recorder
+except ImportError:
+    Recorder = None
+
+SECONDS = 60
+FPS = 60
+
+
+def packets():
+    key_frame, delta_frame = os.urandom(120000), os.urandom(14000)
+    for idx in range(SECONDS * FPS):
+        pts = idx * 1000000 // FPS
+        if idx % FPS == 0:
+            yield pts | sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME, key_frame
+        else:
+            yield pts, delta_frame
+
+
+def run(name, tmp_dir):
+    info = {'video_encode': 'h264', 'width': 1920, 'height': 1080}
+    header = (sc_packet_flag.SC_PACKET_FLAG_CONFIG, os.urandom(32))
+    data = list(packets())
+    cpu_start = time.process_time()
+    if name == 'recorder':
+        recorder = open_recorder(os.path.join(tmp_dir, 'bench.mkv'), 'mkv', info, header)
+        for pts, payload in data:
+            recorder.write_video_packet(pts, len(payload), payload)
+        recorder.close_container()
+    else:
+        capture = RawCapture(os.path.join(tmp_dir, f'{name}.raw'), info, header, use_mmap=name == 'mmap')
+        for pts, payload in data:
+            capture.write_video_packet(pts, len(payload), payload)
+        capture.close_container()
+    cpu = time.process_time() - cpu_start
+    print(f"{name:<9} packets {len(data)}  cpu {cpu * 1000:>7.1f}ms  {cpu / len(data) * 1000000:>6.1f}us/packet")
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ('buffered', 'mmap') + (('recorder',) if Recorder else ()):
+            run(name, tmp_dir)
@@ -0,0 +1,169 @@
+"""
+1.coalesce: 1kHz的触摸输入(一次down, 持续move, 一次up), control_socket每次写入耗时4ms(adb转发慢或设备消费慢)
+  对比逐条写入和ControlWriter合并写入的写入次数及up的延迟
+2.clipboard: 1kHz触摸输入期间每100ms读取一次剪切板, 设备2ms后回复
+  对比原实现(持device_lock清空socket后同步读取回复)和ControlReader的剪切板往返时间及触摸输入延迟
+在项目根目录运行:
+    python -m benchmarks.control
+"""
+import time
+import socket
+import struct
+import asyncio
+
+from asynch.constants import sc_control_msg_type, sc_device_msg_type
+from asynch.control import ControlWriter, ControlReader
+from asynch.serializers import split_control_data
+from asynch.tools.utils import AsyncSocket
+
+SECONDS = 2
+RATE = 1000
+WRITE_COST = 0.004
+CLIPBOARD_INTERVAL = 0.1
+REPLY_COST = 0.002
+
+
+class SlowSocket:
+    def __init__(self):
+        self.msgs = []
+
+    async def write(self, data):
+        await asyncio.sleep(WRITE_COST)
+        for _, start, end in split_control_data(data):
+            self.msgs.append((time.perf_counter(), data[start:end]))
+
+
+class BenchDevice:
+    device_id = 'bench'
+    scid = '00000000'
+
+    def __init__(self):
+        self.device_lock = asyncio.Lock()
+        self.control_socket = SlowSocket()
+
+
+def touch(action, x, y):
+    return struct.pack(">BBqiiHHHii", sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, action, 0,
+                       x, y, 1080, 2400, 0 if action == 1 else 1, 1, 0 if action == 1 else 1)
+
+
+async def inject_direct(device, data):
+    """原DeviceController.inject, 每条消息持锁write+drain"""
+    async with device.device_lock:
+        await device.control_socket.write(data)
+
+
+async def run_coalesce(coalesce):
+    device = BenchDevice()
+    writer = ControlWriter(device) if coalesce else None
+    events = [touch(0, 0, 0)] + [touch(2, idx % 1080, idx % 2400) for idx in range(SECONDS * RATE - 2)] + [touch(1, 1, 1)]
+    start = time.perf_counter()
+    for idx, data in enumerate(events):
+        if coalesce:
+            await writer.put(data)
+        else:
+            await inject_direct(device, data)
+        # 按1kHz的节奏产生事件, 注入阻塞时事件在ws接收缓冲区中积压
+        delay = start + (idx + 1) / RATE - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    if coalesce:
+        await writer.flush()
+        await writer.close()
+    msgs = device.control_socket.msgs
+    assert msgs[0][1] == events[0] and msgs[-1][1] == events[-1]
+    # up产生到写入socket的延迟
+    up_latency = (msgs[-1][0] - start - (len(events) - 1) / RATE) * 1000
+    print(f"{'coalesce' if coalesce else 'direct':<9} events {len(events)}  written {len(msgs)}  "
+          f"up_latency {up_latency:>7.1f}ms  {writer.stats() if writer else ''}")
+
+
+
+
+class BenchControlDevice(BenchDevice):
+    def __init__(self, control_socket):
+        self.device_lock = asyncio.Lock()
+        self.control_socket = control_socket
+        self.touch_latencies = []
+
+    async def serve(self, reader, writer, start):
+        """模拟scrcpy server: 记录touch到达时间, 回复剪切板请求"""
+        while True:
+            msg_type = (await reader.readexactly(1))[0]
+            if msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT:
+                data = await reader.readexactly(31)
+                idx = struct.unpack_from('>i', data, 9)[0]
+                self.touch_latencies.append(time.perf_counter() - start - idx / RATE)
+            elif msg_type == sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD:
+                await reader.readexactly(1)
+                await asyncio.sleep(REPLY_COST)
+                writer.write(struct.pack('>BI', sc_device_msg_type.SC_DEVICE_MSG_TYPE_CLIPBOARD, 4) + b'text')
+
+
+async def old_get_clipboard(device):
+    """原DeviceController.get_clipboard"""
+    async with device.device_lock:
+        for _ in range(10):
+            try:
+                await asyncio.wait_for(device.control_socket.read(0x10000), timeout=0.02)
+            except:
+                break
+        await device.control_socket.write(struct.pack('>BB', sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD, 1))
+        msg_type, length = struct.unpack('>BI', await asyncio.wait_for(device.control_socket.read_exactly(5), 1))
+        return await device.control_socket.read_exactly(length)
+
+
+async def run_clipboard(use_reader):
+    server_sock, client_sock = socket.socketpair()
+    server_reader, server_writer = await asyncio.open_connection(sock=server_sock)
+    client_reader, client_writer = await asyncio.open_connection(sock=client_sock)
+    device = BenchControlDevice(AsyncSocket(reader=client_reader, writer=client_writer))
+    writer = ControlWriter(device) if use_reader else None
+    reader = ControlReader(device) if use_reader else None
+    start = time.perf_counter()
+    serve_task = asyncio.create_task(device.serve(server_reader, server_writer, start))
+    rtts = []
+
+    async def clipboard_task():
+        while True:
+            await asyncio.sleep(CLIPBOARD_INTERVAL)
+            request_time = time.perf_counter()
+            if use_reader:
+                inject = writer.put(struct.pack('>BB', sc_control_msg_type.SC_CONTROL_MSG_TYPE_GET_CLIPBOARD, 1))
+                assert await reader.request(inject, reader.wait_clipboard(), 1) == b'text'
+            else:
+                assert await old_get_clipboard(device) == b'text'
+            rtts.append(time.perf_counter() - request_time)
+
+    task = asyncio.create_task(clipboard_task())
+    for idx in range(SECONDS * RATE):
+        data = touch(2, idx, idx)
+        if use_reader:
+            await writer.put(data)
+        else:
+            await inject_direct(device, data)
+        delay = start + (idx + 1) / RATE - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    task.cancel()
+    if use_reader:
+        await writer.flush()
+    await asyncio.sleep(0.05)
+    for item in (task, serve_task, writer, reader):
+        if isinstance(item, asyncio.Task):
+            item.cancel()
+        elif item:
+            await item.close()
+    client_writer.close()
+    server_writer.close()
+    latencies = sorted(device.touch_latencies)
+    print(f"{'reader' if use_reader else 'old':<7} clipboard_rtt avg {sum(rtts) / len(rtts) * 1000:>5.1f}ms  "
+          f"touch_latency p50 {latencies[len(latencies) // 2] * 1000:>5.1f}ms  p99 {latencies[int(len(latencies) * 0.99)] * 1000:>5.1f}ms  "
+          f"max {latencies[-1] * 1000:>5.1f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(run_coalesce(False))
+    asyncio.run(run_coalesce(True))
+    asyncio.run(run_clipboard(False))
+    asyncio.run(run_clipboard(True))
@@ -0,0 +1,64 @@
+"""
+scrcpy音视频socket解包: 1080p60(8Mbit/s, 每秒一个关键帧), StreamReader逐个readexactly vs FrameDemuxer
+在项目根目录运行:
+    python -m benchmarks.demuxer
+"""
+import os
+import time
+import socket
+import struct
+import asyncio
+import threading
+import tracemalloc
+
+from asynch.tools.utils import FRAME_HEADER, AsyncSocket
+
+FRAME_CNT = 6000
+
+
+def make_stream():
+    key_frame, delta_frame = os.urandom(120000), os.urandom(14000)
+    frames = []
+    for idx in range(FRAME_CNT):
+        data = key_frame if idx % 60 == 0 else delta_frame
+        frames.append(FRAME_HEADER.pack(idx, len(data)) + data)
+    return b''.join(frames)
+
+
+async def bench(name, stream_data, use_demuxer):
+    # 数据由线程通过socketpair发送, sendall(memoryview)不产生额外内存分配
+    read_sock, write_sock = socket.socketpair()
+    sender = threading.Thread(target=write_sock.sendall, args=(memoryview(stream_data),))
+    reader, writer = await asyncio.open_connection(sock=read_sock)
+    async_socket = AsyncSocket(reader=reader, writer=writer)
+    sender.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    if use_demuxer:
+        async_socket.attach_demuxer()
+        for _ in range(FRAME_CNT):
+            await async_socket.read_frame()
+    else:
+        for _ in range(FRAME_CNT):
+            frame_meta = await async_socket.read_exactly(12)
+            pts = struct.unpack('>Q', frame_meta[:8])[0]
+            data_length = struct.unpack('>L', frame_meta[8:])[0]
+            await async_socket.read_exactly(data_length)
+    cost = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {FRAME_CNT / cost:>10.0f} packets/s  {len(stream_data) / cost / 1024 / 1024:>8.1f} MB/s  "
+          f"peak_alloc {peak / 1024:.0f} KB")
+    await async_socket.disconnect()
+    sender.join()
+    write_sock.close()
+
+
+async def main():
+    stream_data = make_stream()
+    await bench('AsyncSocket', stream_data, False)
+    await bench('FrameDemuxer', stream_data, True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
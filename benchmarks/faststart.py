@@ -0,0 +1,135 @@
+"""
+faststart前后的首帧时间: 512MB的mp4(mdat为稀疏文件), 4Mbit/s~100Mbit/s带宽
+1.estimate: faststart返回的模型估算值(estimate_ttff)
+2.measured: 模拟浏览器的渐进式播放器, 通过serve_file的Range请求实际读取文件, 读到moov和第一个关键帧的时间
+  网络按bandwidth和rtt模拟: 每个新请求等待rtt, 每收到64KB等待64KB / bandwidth
+在项目根目录运行:
+    python -m benchmarks.faststart
+"""
+import os
+import time
+import struct
+import asyncio
+import logging
+import tempfile
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_scrcpy.settings')
+django.setup()
+
+from django.test import AsyncRequestFactory
+
+from asynch.faststart import ATOM_HEADER, SEEK_DISTANCE, faststart, read_atoms
+from asynch.ranges import serve_file
+
+MDAT_SIZE = 512 * 1024 * 1024
+SAMPLES = 30000
+# 第一个关键帧的大小
+KEYFRAME_SIZE = 120000
+RTT = 0.05
+# 模拟网络时每次接收的字节数
+RECV_SIZE = 64 * 1024
+
+
+def build_mp4(filename):
+    ftyp = ATOM_HEADER.pack(20, b'ftyp') + b'isom' + struct.pack('>I', 512) + b'isom'
+    stco_entries = struct.pack('>%dI' % SAMPLES, *(len(ftyp) + 8 + idx * (MDAT_SIZE // SAMPLES) for idx in range(SAMPLES)))
+    stco = ATOM_HEADER.pack(16 + len(stco_entries), b'stco') + struct.pack('>II', 0, SAMPLES) + stco_entries
+    # 其它sample表的大小与stco相近
+    stsz = ATOM_HEADER.pack(20 + len(stco_entries), b'stsz') + struct.pack('>III', 0, 0, SAMPLES) + stco_entries
+    stbl = ATOM_HEADER.pack(8 + len(stco) + len(stsz), b'stbl') + stco + stsz
+    for container in (b'minf', b'mdia', b'trak', b'moov'):
+        stbl = ATOM_HEADER.pack(8 + len(stbl), container) + stbl
+    with open(filename, 'wb') as f:
+        f.write(ftyp)
+        f.write(ATOM_HEADER.pack(8 + MDAT_SIZE, b'mdat'))
+        f.truncate(len(ftyp) + 8 + MDAT_SIZE)
+        f.seek(0, os.SEEK_END)
+        f.write(stbl)
+
+
+class RangeReader:
+    """一个HTTP连接: 顺序读取时沿用当前响应, 向后跳过不超过SEEK_DISTANCE时读取并丢弃, 否则发起新的Range请求"""
+    def __init__(self, filename, bandwidth, rtt):
+        self.filename = filename
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.factory = AsyncRequestFactory()
+        self.stream = None
+        self.position = None
+        self.buffer = self.pending = b''
+        self.requests = 0
+
+    async def request(self, offset):
+        if self.stream is not None:
+            await self.stream.aclose()
+        await asyncio.sleep(self.rtt)
+        request = self.factory.get('/', headers={'range': f'bytes={offset}-'})
+        resp = await serve_file(request, self.filename, recording=False)
+        assert resp.status_code == 206, resp.status_code
+        self.stream = resp.streaming_content
+        self.position = offset
+        self.buffer = self.pending = b''
+        self.requests += 1
+
+    async def read(self, offset, size):
+        if self.stream is None or not 0 <= offset - self.position <= SEEK_DISTANCE:
+            await self.request(offset)
+        elif offset > self.position:
+            await self.read(self.position, offset - self.position)
+        while len(self.buffer) < size:
+            # serve_file每次产生READ_CHUNK, 按RECV_SIZE逐段到达
+            if not self.pending:
+                self.pending = await self.stream.__anext__()
+            data, self.pending = self.pending[:RECV_SIZE], self.pending[RECV_SIZE:]
+            await asyncio.sleep(len(data) / self.bandwidth)
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += size
+        return data
+
+    async def close(self):
+        if self.stream is not None:
+            await self.stream.aclose()
+
+
+async def measure_ttff(filename, bandwidth, rtt=RTT):
+    """return (读到moov和第一个关键帧的时间(秒), Range请求数)"""
+    reader = RangeReader(filename, bandwidth, rtt)
+    start = time.perf_counter()
+    file_size = os.path.getsize(filename)
+    position, moov, mdat_payload = 0, False, None
+    try:
+        while position < file_size and not (moov and mdat_payload is not None):
+            size, atom_type = ATOM_HEADER.unpack(await reader.read(position, ATOM_HEADER.size))
+            if atom_type == b'moov':
+                await reader.read(position + ATOM_HEADER.size, size - ATOM_HEADER.size)
+                moov = True
+            elif atom_type == b'mdat':
+                mdat_payload = position + ATOM_HEADER.size
+            position += size
+        await reader.read(mdat_payload, KEYFRAME_SIZE)
+    finally:
+        await reader.close()
+    return time.perf_counter() - start, reader.requests
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mbit in (4, 20, 100):
+            bandwidth = mbit * 1000000 / 8
+            filename = os.path.join(tmp_dir, 'bench.mp4')
+            build_mp4(filename)
+            before, before_requests = asyncio.run(measure_ttff(filename, bandwidth))
+            result = faststart(filename, bandwidth=bandwidth, rtt=RTT)
+            after, after_requests = asyncio.run(measure_ttff(filename, bandwidth))
+            print(f"{mbit:>3}Mbit/s  moov {result['moov_size'] // 1024}KB  "
+                  f"estimate before {result['estimated_ttff_before']:>5.2f}s after {result['estimated_ttff_after']:>5.2f}s  "
+                  f"measured before {before:>5.2f}s({before_requests} requests) after {after:>5.2f}s({after_requests} requests)  "
+                  f"faststart {result['elapsed']:.2f}s  layout {[atom[0].decode() for atom in read_atoms(filename)]}")
+
+
+if __name__ == '__main__':
+    main()
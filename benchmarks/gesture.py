@@ -0,0 +1,83 @@
+"""
+1秒内从(100,100)滑动到(1000,2000), 原DeviceController.swipe(每5像素一步, 每步sleep) vs Gesture, 以及两指缩放
+注入本身不耗时, 对比实际耗时与预期1秒的偏差
+在项目根目录运行:
+    python -m benchmarks.gesture
+"""
+import time
+import asyncio
+
+from asynch.gesture import TOUCH_EVENT, Gesture
+
+RESOLUTION = (1080, 2400)
+
+
+class RecordController:
+    def __init__(self):
+        self.msgs = 0
+
+    async def inject(self, data):
+        self.msgs += len(data) // TOUCH_EVENT.size
+
+    async def inject_touch_event(self, x, y, resolution, action):
+        self.msgs += 1
+
+
+async def old_swipe(controller, x, y, end_x, end_y, resolution, unit=5, delay=1):
+    """原DeviceController.swipe"""
+    x_1, y_1 = x, y
+    step = 1
+    while True:
+        if x_1 > end_x:
+            x_1 -= min(x - end_x, unit)
+        elif x_1 < end_x:
+            x_1 += min(end_x - x_1, unit)
+        if y_1 > end_y:
+            y_1 -= min(y_1 - end_y, unit)
+        elif y < end_y:
+            y_1 += min(end_y - y_1, unit)
+        if x_1 == end_x and y_1 == end_y:
+            break
+        step += 1
+    unit_delay = delay / step
+    await controller.inject_touch_event(x, y, resolution, 0)
+    while True:
+        if x > end_x:
+            x -= min(x - end_x, unit)
+        elif x < end_x:
+            x += min(end_x - x, unit)
+        if y > end_y:
+            y -= min(y - end_y, unit)
+        elif y < end_y:
+            y += min(end_y - y, unit)
+        await controller.inject_touch_event(x, y, resolution, 2)
+        await asyncio.sleep(unit_delay)
+        if x == end_x and y == end_y:
+            await controller.inject_touch_event(x, y, resolution, 1)
+            break
+
+
+async def main():
+    for name in ('old_swipe', 'gesture', 'pinch'):
+        controller = RecordController()
+        start = time.perf_counter()
+        if name == 'old_swipe':
+            await old_swipe(controller, 100, 100, 1000, 2000, RESOLUTION)
+            build_cost = 0
+        else:
+            build_start = time.perf_counter()
+            gesture = Gesture(RESOLUTION)
+            if name == 'gesture':
+                gesture.line((100, 100), (1000, 2000), 1)
+            else:
+                gesture.pinch((540, 1200), 200, 1000, 1, angle=45)
+            gesture.build()
+            build_cost = time.perf_counter() - build_start
+            await gesture.play(controller)
+        cost = time.perf_counter() - start
+        print(f"{name:<10} msgs {controller.msgs:>4}  duration {cost * 1000:>7.1f}ms  drift {(cost - 1) * 1000:>+6.1f}ms  "
+              f"build {build_cost * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
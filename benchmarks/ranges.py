@@ -0,0 +1,69 @@
+"""
+每个worker可同时播放的录屏数, aiofiles 800KB分块(原video_stream) vs FileRangeResponse的os.pread 1MB分块
+每路播放读取整个文件, 统计总吞吐和事件循环延迟, 按8Mbit/s的录屏换算可同时播放的路数
+在项目根目录运行:
+    python -m benchmarks.ranges
+"""
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+import django
+import aiofiles
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_scrcpy.settings')
+django.setup()
+
+from asynch.ranges import FileRangeResponse
+
+FILE_SIZE = 64 * 1024 * 1024
+BITRATE = 8 * 1000 * 1000 / 8
+
+
+async def aiofiles_stream(filename):
+    async with aiofiles.open(filename, 'rb') as f:
+        while await f.read(8192 * 100):
+            pass
+
+
+async def pread_stream(filename):
+    resp = FileRangeResponse(filename, [(0, FILE_SIZE)])
+    async for _ in resp:
+        pass
+
+
+async def measure_lag(stop_event, lags):
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+
+async def run(name, stream, filename, concurrency):
+    stop_event, lags = asyncio.Event(), []
+    lag_task = asyncio.create_task(measure_lag(stop_event, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(stream(filename) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    await lag_task
+    throughput = FILE_SIZE * concurrency / elapsed
+    print(f"{name:<8} streams {concurrency:>3}  {throughput / 1024 / 1024:>7.0f}MB/s  "
+          f"max lag {max(lags) * 1000:>6.1f}ms  ~{int(throughput / BITRATE)} playbacks@8Mbit/s")
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'bench.mp4')
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(FILE_SIZE))
+        for concurrency in (1, 16, 64):
+            for name, stream in (('aiofiles', aiofiles_stream), ('pread', pread_stream)):
+                asyncio.run(run(name, stream, filename, concurrency))
+
+
+if __name__ == '__main__':
+    main()
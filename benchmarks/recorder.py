@@ -0,0 +1,105 @@
+"""
+一个worker中20个录屏会话(1080p60, 8Mbit/s), 写入在事件循环中 vs RecorderWriter写入线程, 对比事件循环延迟
+需要编译extension/recorder, 不可用时用time.sleep模拟libav写入磁盘(释放GIL)
+在项目根目录运行:
+    python -m benchmarks.recorder
+"""
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+from asynch.constants import sc_packet_flag
+from asynch.recorder import RecorderWriter
+try:
+    from extension.recorder import Recorder
+except ImportError:
+    Recorder = None
+
+SESSIONS = 20
+SECONDS = 5
+FPS = 60
+
+
+class SimulatedRecorder:
+    """每个packet复制一次并阻塞1ms(磁盘写入)"""
+    start_time = finish_time = 0
+
+    def __init__(self, *args):
+        pass
+
+    def write_video_packet(self, pts, length, data):
+        bytes(bytearray(data))
+        time.sleep(0.001)
+        return True
+
+    write_audio_packet = write_video_packet
+
+    def close_container(self):
+        return SECONDS
+
+
+def create_recorder(path):
+    if Recorder is None:
+        return SimulatedRecorder()
+    recorder = Recorder('matroska', path, False)
+    assert recorder.add_video_stream('h264', 1920, 1080)
+    assert recorder.write_video_header(sc_packet_flag.SC_PACKET_FLAG_CONFIG, 32, os.urandom(32))
+    assert recorder.write_header()
+    return recorder
+
+
+async def session(idx, use_thread, tmp_dir):
+    recorder = create_recorder(os.path.join(tmp_dir, f"{idx}.mkv"))
+    writer = RecorderWriter(recorder, 'bench', str(idx)) if use_thread else None
+    key_frame, delta_frame = os.urandom(120000), os.urandom(14000)
+    start = time.perf_counter()
+    for frame_idx in range(SECONDS * FPS):
+        pts = frame_idx * 1000000 // FPS
+        if frame_idx % FPS == 0:
+            pts |= sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME
+        data = key_frame if frame_idx % FPS == 0 else delta_frame
+        if use_thread:
+            writer.write(pts, data)
+        else:
+            recorder.write_video_packet(pts, len(data), data)
+        delay = start + (frame_idx + 1) / FPS - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    if use_thread:
+        await writer.close()
+        return writer.dropped_packets
+    recorder.close_container()
+    return 0
+
+
+async def measure_lag(stop_event, lags):
+    interval = 0.005
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(use_thread):
+    lags = []
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop_event, lags))
+    cpu_start = time.process_time()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dropped = await asyncio.gather(*[session(idx, use_thread, tmp_dir) for idx in range(SESSIONS)])
+    cpu = time.process_time() - cpu_start
+    stop_event.set()
+    await lag_task
+    lags.sort()
+    print(f"{'thread' if use_thread else 'loop':<7} sessions {SESSIONS}  loop_lag p50 {lags[len(lags) // 2] * 1000:>5.2f}ms  "
+          f"p99 {lags[int(len(lags) * 0.99)] * 1000:>6.2f}ms  max {lags[-1] * 1000:>6.2f}ms  "
+          f"cpu {cpu / SECONDS * 100:>5.1f}%  dropped {sum(dropped)}")
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"recorder: {'extension.recorder' if Recorder else 'simulated'}")
+    asyncio.run(run(False))
+    asyncio.run(run(True))
@@ -0,0 +1,79 @@
+"""
+1080p60(8Mbit/s, 每秒一个关键帧)单设备, 不同读者进程数下的CPU占用, shared_memory ring vs multiprocessing.Pipe
+在项目根目录运行:
+    python -m benchmarks.ring
+"""
+import os
+import time
+import multiprocessing
+
+from asynch.tools.cache import FRAME_TYPE_KEY, FRAME_TYPE_DELTA
+from asynch.tools.ring import RingWriter, RingReader, get_ring_name
+
+SECONDS = 3
+FPS = 60
+RING_SIZE = 0x1000000
+
+
+def make_frames():
+    key_frame, delta_frame = os.urandom(120000), os.urandom(14000)
+    return [(FRAME_TYPE_KEY if idx % FPS == 0 else FRAME_TYPE_DELTA, idx, key_frame if idx % FPS == 0 else delta_frame)
+            for idx in range(SECONDS * FPS)]
+
+
+def ring_reader(name, conn, result):
+    reader = RingReader(name)
+    reader.seek_keyframe()
+    cnt = 0
+    # 与DeviceRegistry一致, 每个packet只通过pipe发送1字节通知, 数据从共享内存读取
+    while conn.recv_bytes():
+        cnt += len(reader.read())
+    result.put((cnt, time.process_time()))
+    reader.close()
+
+
+def pipe_reader(conn, result):
+    cnt = 0
+    while conn.recv_bytes():
+        cnt += 1
+    result.put((cnt, time.process_time()))
+
+
+def run(readers_cnt, use_ring):
+    frames = make_frames()
+    result = multiprocessing.Queue()
+    pipes = [multiprocessing.Pipe(duplex=False) for _ in range(readers_cnt)]
+    if use_ring:
+        writer = RingWriter(get_ring_name('bench'), RING_SIZE)
+        processes = [multiprocessing.Process(target=ring_reader, args=(writer.name, recv_conn, result)) for recv_conn, _ in pipes]
+    else:
+        processes = [multiprocessing.Process(target=pipe_reader, args=(recv_conn, result)) for recv_conn, _ in pipes]
+    for process in processes:
+        process.start()
+    time.sleep(0.5)
+    cpu_start = time.process_time()
+    for frame_type, pts, data in frames:
+        if use_ring:
+            writer.write(frame_type, pts, data, key=frame_type == FRAME_TYPE_KEY)
+        for _, send_conn in pipes:
+            send_conn.send_bytes(b'\x00' if use_ring else data)
+        time.sleep(1 / FPS)
+    writer_cpu = time.process_time() - cpu_start
+    for _, send_conn in pipes:
+        send_conn.send_bytes(b'')
+    results = [result.get() for _ in processes]
+    for process in processes:
+        process.join()
+    if use_ring:
+        writer.close()
+    readers_cpu = sum(cpu for _, cpu in results)
+    received = min(cnt for cnt, _ in results)
+    print(f"{'ring' if use_ring else 'pipe':<5} readers {readers_cnt:<3} writer_cpu {writer_cpu / SECONDS * 100:>5.1f}%  "
+          f"readers_cpu {readers_cpu / SECONDS * 100:>6.1f}%  per_reader {readers_cpu / readers_cnt / SECONDS * 100:>5.1f}%  "
+          f"received {received}/{len(frames)}")
+
+
+if __name__ == '__main__':
+    for cnt in (1, 2, 4, 8):
+        run(cnt, False)
+        run(cnt, True)
@@ -0,0 +1,39 @@
+"""
+单核每秒可处理的touch move事件数, json(解析+重新打包) vs 二进制(校验后转发)
+在项目根目录运行:
+    python -m benchmarks.serializers
+"""
+import json
+import time
+import struct
+
+from asynch.constants import sc_control_msg_type
+from asynch.serializers import ReceiveMsgObj, split_control_data
+
+COUNT = 200000
+RESOLUTION = [1080, 2400]
+JSON_DATA = json.dumps({'msg_type': sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT,
+                        'x': 540, 'y': 1200, 'resolution': RESOLUTION, 'action': 2})
+BYTES_DATA = struct.pack(">BBqiiHHHii", sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, 2, 0,
+                         540, 1200, RESOLUTION[0], RESOLUTION[1], 1, 1, 1)
+
+
+def json_path():
+    obj = ReceiveMsgObj()
+    obj.format_text_data(JSON_DATA)
+    return struct.pack(">BBqiiHHHii", obj.msg_type, obj.action, 0, int(obj.x), int(obj.y),
+                       int(obj.resolution[0]), int(obj.resolution[1]), 1, 1, 1)
+
+
+def bytes_path():
+    split_control_data(BYTES_DATA)
+    return BYTES_DATA
+
+
+if __name__ == '__main__':
+    for name, func, size in (('json', json_path, len(JSON_DATA)), ('binary', bytes_path, len(BYTES_DATA))):
+        start = time.process_time()
+        for _ in range(COUNT):
+            func()
+        cost = time.process_time() - start
+        print(f"{name:<7} {size:>3} bytes/event  {COUNT / cost:>10.0f} events/s per core")
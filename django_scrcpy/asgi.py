@@ -10,17 +10,27 @@ import os
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_scrcpy.settings')
 from concurrent.futures import ThreadPoolExecutor
 
+import django
 from channels.routing import ProtocolTypeRouter, URLRouter
-from django.core.asgi import get_asgi_application
 from asgiref.sync import SyncToAsync
 
+django.setup(set_prefix=False)
 from asynch import urls
+from asynch.pool import WarmPool
+from asynch.ranges import RangeASGIHandler
 
 SyncToAsync.single_thread_executor = ThreadPoolExecutor(max_workers=5)
 
 
-django_asgi_app = get_asgi_application()
-application = ProtocolTypeRouter({
+# 与get_asgi_application()相同, 服务器支持zerocopysend时录屏文件由服务器sendfile发送
+django_asgi_app = RangeASGIHandler()
+router = ProtocolTypeRouter({
     'websocket': URLRouter(urls.websocket_urlpatterns,),
     "http": django_asgi_app,
 })
+
+
+async def application(scope, receive, send):
+    # 服务以--lifespan off运行, 在第一个请求时启动预热池
+    WarmPool.ensure_started()
+    await router(scope, receive, send)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -168,3 +169,29 @@ REST_FRAMEWORK = {
 # adb
 ADB_SERVER_ADDR =  os.environ.get('ADB_SERVER_ADDR') or '127.0.0.1'  
 ADB_SERVER_PORT = os.environ.get('ADB_SERVER_PORT') or '5037'
+# scrcpy-server jar部署校验缓存时间(秒), 超时后用一次STAT校验设备上的jar, 0则每次都校验
+DEPLOY_CACHE_TTL = int(os.environ.get('DEPLOY_CACHE_TTL') or 600)
+# 预热池: 每个worker最多预热的设备数, 0则关闭; 预热的scrcpy server空闲超时(秒)后重建; 为1时预热所有在线设备, 否则只预热config中warm_pool为true的设备
+WARM_POOL_SIZE = int(os.environ.get('WARM_POOL_SIZE') or 0)
+WARM_POOL_TTL = int(os.environ.get('WARM_POOL_TTL') or 600)
+WARM_POOL_ALL = os.environ.get('WARM_POOL_ALL') == '1'
+
+# gop cache, 新加入的ws_client先收到最近的配置帧+关键帧+后续帧
+GOP_CACHE_MAX_BYTES = int(os.environ.get('GOP_CACHE_MAX_BYTES') or 8 * 1024 * 1024)
+GOP_CACHE_MAX_FRAMES = int(os.environ.get('GOP_CACHE_MAX_FRAMES') or 600)
+# ws_client发送队列长度(帧), 队列满时丢弃delta帧直到下一个关键帧
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('SUBSCRIBER_QUEUE_SIZE') or 120)
+# 录屏写入线程的队列长度(packet), 队列满时丢弃视频delta帧直到下一个关键帧
+RECORDER_QUEUE_SIZE = int(os.environ.get('RECORDER_QUEUE_SIZE') or 600)
+# recorder_format为raw时, 原始packet抓取通过mmap写入文件, 否则为带缓冲的顺序写入
+CAPTURE_MMAP = os.environ.get('CAPTURE_MMAP') == '1'
+# mp4录屏完成后把moov移动到文件头的后台任务数, 0则关闭
+FASTSTART_WORKERS = int(os.environ.get('FASTSTART_WORKERS') or 2)
+# 无浏览器录屏服务(manage.py record)同时录屏的最大设备数
+HEADLESS_MAX_DEVICES = int(os.environ.get('HEADLESS_MAX_DEVICES') or 32)
+
+# 多worker设备所有权, 同一设备只由一个worker启动scrcpy server, 其它worker通过unix socket接收数据
+DEVICE_REGISTRY_ENABLE = os.name != 'nt' and os.environ.get('DEVICE_REGISTRY_ENABLE', '1') == '1'
+DEVICE_REGISTRY_DIR = os.environ.get('DEVICE_REGISTRY_DIR') or os.path.join(tempfile.gettempdir(), 'django_scrcpy')
+# 所有者worker向其它worker分发packet的共享内存环形缓冲区大小(字节), 0则通过unix socket传输packet
+DEVICE_RING_SIZE = int(os.environ.get('DEVICE_RING_SIZE') or 16 * 1024 * 1024)
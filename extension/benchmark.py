@@ -0,0 +1,65 @@
+"""
+录屏写入的内存和CPU开销, 每录制1Mbit数据的CPU时间和常驻内存增长
+新旧版本分别编译后运行对比, 例如:
+    git stash && make build_ext && python benchmark.py && git stash pop && make build_ext && python benchmark.py
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+
+import recorder
+
+SECONDS = 60
+FPS = 60
+KEY_SIZE = 120000
+DELTA_SIZE = 14000
+SC_PACKET_FLAG_CONFIG = 1 << 63
+SC_PACKET_FLAG_KEY_FRAME = 1 << 62
+
+
+def rss_kb():
+    """linux下ru_maxrss单位为KB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(data_type):
+    config = b'\x00\x00\x00\x01\x67' + os.urandom(27)
+    key_frame, delta_frame = os.urandom(KEY_SIZE), os.urandom(DELTA_SIZE)
+    if data_type == 'memoryview':
+        key_frame, delta_frame = memoryview(key_frame), memoryview(delta_frame)
+    elif data_type == 'bytearray':
+        key_frame, delta_frame = bytearray(key_frame), bytearray(delta_frame)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        recorder_obj = recorder.Recorder("matroska", os.path.join(tmp_dir, 'benchmark.mkv'), False)
+        recorder_obj.add_video_stream('h264', 1920, 1080)
+        recorder_obj.write_video_header(SC_PACKET_FLAG_CONFIG, len(config), config)
+        recorder_obj.write_header()
+        rss_start = rss_kb()
+        cpu_start = time.process_time()
+        total = 0
+        for idx in range(SECONDS * FPS):
+            pts = idx * 1000000 // FPS
+            if idx % FPS == 0:
+                # 每个gop前有一个config packet, 与关键帧合并
+                recorder_obj.write_video_packet(pts | SC_PACKET_FLAG_CONFIG, len(config), config)
+                data = key_frame
+                pts |= SC_PACKET_FLAG_KEY_FRAME
+            else:
+                data = delta_frame
+            recorder_obj.write_video_packet(pts, len(data), data)
+            total += len(data)
+        recorder_obj.close_container()
+        cpu = time.process_time() - cpu_start
+    mbit = total * 8 / 1000000
+    print(f"{data_type:<11} {mbit:>7.0f}Mbit  cpu {cpu / mbit * 1000000:>7.1f}us/Mbit  rss +{rss_kb() - rss_start}KB")
+
+
+if __name__ == '__main__':
+    for data_type in sys.argv[1:] or ('bytes', 'memoryview', 'bytearray'):
+        try:
+            run(data_type)
+        except TypeError as e:
+            # 旧版本只接受bytes
+            print(f"{data_type:<11} unsupported: {e}")
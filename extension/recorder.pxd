@@ -1,11 +1,13 @@
 from libc.stdint cimport int64_t, uint64_t, uint32_t, uint8_t, UINT_LEAST32_MAX
-from libc.string cimport memcpy, memmove, strcmp
+from libc.string cimport memcpy, memmove, memcmp, strcmp
 from libc.stdlib cimport malloc, free
 from libc.time cimport time
+from cpython.buffer cimport Py_buffer, PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
 
 
 cdef extern from "libavutil/avutil.h" nogil:
     cdef int64_t AV_NOPTS_VALUE
+    cdef int AVERROR_EOF
 
     ctypedef struct AVDictionary:
         pass
@@ -18,6 +20,20 @@ cdef extern from "libavutil/avutil.h" nogil:
 
     cdef int av_dict_set(AVDictionary **pm, const char *key, const char *value, int flags)
 
+    cdef void av_dict_free(AVDictionary **m)
+
+    cdef int64_t av_rescale_q(int64_t a, AVRational bq, AVRational cq)
+
+
+cdef extern from "libavutil/buffer.h" nogil:
+    cdef int AV_BUFFER_FLAG_READONLY
+
+    ctypedef struct AVBufferRef:
+        uint8_t *data
+
+    cdef AVBufferRef* av_buffer_create(uint8_t *data, size_t size, void (*free)(void *opaque, uint8_t *data) noexcept nogil,
+                                       void *opaque, int flags)
+
 
 cdef extern from "libavformat/avformat.h" nogil:
     cdef int LIBAVFORMAT_VERSION_INT
@@ -29,9 +45,14 @@ cdef extern from "libavformat/avformat.h" nogil:
         pass
 
     cdef struct AVCodecParameters:
+        int codec_id
+        uint32_t codec_tag
         uint8_t *extradata
         int extradata_size
-        
+        int width
+        int height
+        int sample_rate
+
     cdef struct AVStream:
         AVCodecParameters *codecpar
         AVRational time_base
@@ -43,7 +64,9 @@ cdef extern from "libavformat/avformat.h" nogil:
         AVOutputFormat *oformat
         AVIOContext *pb
         AVDictionary *metadata
+        unsigned int nb_streams
         AVStream **streams
+        int64_t start_time
         int64_t duration
 
     cdef AVFormatContext* avformat_alloc_context()
@@ -62,8 +85,18 @@ cdef extern from "libavformat/avformat.h" nogil:
 
     cdef int avio_close(AVIOContext *s)
 
+    cdef int64_t avio_tell(AVIOContext *s)
+
     cdef int avformat_free_context(AVFormatContext *ctx)
 
+    cdef int avformat_open_input(AVFormatContext **ps, const char *url, void *fmt, AVDictionary **options)
+
+    cdef int avformat_find_stream_info(AVFormatContext *ic, AVDictionary **options)
+
+    cdef void avformat_close_input(AVFormatContext **s)
+
+    cdef int av_read_frame(AVFormatContext *s, AVPacket *pkt)
+
 
 cdef extern from "libavcodec/avcodec.h" nogil:
     cdef int AV_CODEC_FLAG_LOW_DELAY
@@ -99,6 +132,7 @@ cdef extern from "libavcodec/avcodec.h" nogil:
         int channel_layout
 
     cdef struct AVPacket:
+        AVBufferRef *buf
         int64_t pts
         int64_t dts
         uint8_t *data
@@ -132,6 +166,12 @@ cdef extern from "libavcodec/avcodec.h" nogil:
 
     cdef void av_packet_rescale_ts(AVPacket *pkt, AVRational src_tb, AVRational dst_tb)
 
+    cdef AVCodecParameters *avcodec_parameters_alloc()
+
+    cdef void avcodec_parameters_free(AVCodecParameters **par)
+
+    cdef int avcodec_parameters_copy(AVCodecParameters *dst, const AVCodecParameters *src)
+
 
 cdef struct video_packet_merger:
     uint8_t *config
@@ -151,12 +191,40 @@ cdef class Recorder(object):
     cdef AVCodecContext *audio_codec_ctx
     cdef video_packet_merger merger
 
-    cdef void packet_merger_init(self)
+    cdef void packet_merger_init(self) noexcept nogil
 
-    cdef void packet_merger_merge(self, AVPacket *packet)
+    cdef void packet_merger_merge(self, AVPacket *packet) noexcept nogil
 
-    cdef void packet_merger_destroy(self)
+    cdef void packet_merger_destroy(self) noexcept nogil
 
     cdef AVCodecID get_avcodec_id(self, char *codec_name)
 
-    cdef AVPacket* init_packet(self,  uint64_t pts, int length, uint8_t* data)
+    cdef void set_packet_pts(self, AVPacket *packet, uint64_t pts) noexcept nogil
+
+    cdef AVPacket* init_packet(self,  uint64_t pts, int length, uint8_t* data) noexcept nogil
+
+    cdef AVPacket* init_merged_packet(self, uint64_t pts, int length, uint8_t* data) noexcept nogil
+
+    cdef AVPacket* wrap_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil
+
+    cdef Py_buffer* get_py_buffer(self, object data, int length) except NULL
+
+    cdef int _write_video_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil
+
+    cdef int _write_audio_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil
+
+    cdef int _close_container(self) noexcept nogil
+
+
+cdef class Concat(object):
+    cdef bint has_header
+    cdef bint has_finish
+    cdef dict options
+    cdef int64_t offset
+    cdef AVFormatContext *container
+
+    cdef bint is_compatible(self, AVFormatContext *input_container)
+
+    cdef int _copy_packet(self, AVFormatContext *input_container, AVPacket *packet, int64_t start, int64_t *end) noexcept nogil
+
+    cdef int _close_container(self) noexcept nogil
@@ -4,6 +4,13 @@ cdef uint64_t SC_PACKET_PTS_MASK = (SC_PACKET_FLAG_KEY_FRAME - 1)
 cdef AVRational RECORD_TIME_BASE = {"num":1, "den":1000000}
 
 
+cdef void release_py_buffer(void *opaque, uint8_t *data) noexcept with gil:
+    """AVBuffer的释放回调, 也用于复制后直接释放"""
+    cdef Py_buffer *view = <Py_buffer *> opaque
+    PyBuffer_Release(view)
+    free(view)
+
+
 cdef class Recorder(object):
     def __cinit__(self, const char *muxer_name, const char *filename, bint has_audio):
         # 1.mark finish
@@ -34,10 +41,10 @@ cdef class Recorder(object):
     def finish_time(self):
         return self.finish_time   
 
-    cdef void packet_merger_init(self):
+    cdef void packet_merger_init(self) noexcept nogil:
         self.merger.config = NULL
 
-    cdef void packet_merger_merge(self, AVPacket *packet):
+    cdef void packet_merger_merge(self, AVPacket *packet) noexcept nogil:
         cdef size_t config_size
         cdef size_t media_size
         if packet.pts == AV_NOPTS_VALUE:
@@ -54,7 +61,7 @@ cdef class Recorder(object):
             free(self.merger.config)
             self.merger.config = NULL
 
-    cdef void packet_merger_destroy(self):
+    cdef void packet_merger_destroy(self) noexcept nogil:
         free(self.merger.config)
     
     cdef AVCodecID get_avcodec_id(self, char *codec_name,):
@@ -107,10 +114,7 @@ cdef class Recorder(object):
         avcodec_parameters_from_context(audio_stream.codecpar, self.audio_codec_ctx)
         return True
 
-    cdef AVPacket* init_packet(self,  uint64_t pts, int length, uint8_t* data):
-        cdef AVPacket* packet = av_packet_alloc()
-        av_new_packet(packet, length)
-        memcpy(packet.data, data, packet.size)
+    cdef void set_packet_pts(self, AVPacket *packet, uint64_t pts) noexcept nogil:
         if (SC_PACKET_FLAG_CONFIG & pts):
             packet.pts = AV_NOPTS_VALUE
         else:
@@ -118,8 +122,57 @@ cdef class Recorder(object):
         if pts & SC_PACKET_FLAG_KEY_FRAME:
             packet.flags |=  AV_PKT_FLAG_KEY
         packet.dts = packet.pts
+
+    cdef AVPacket* init_packet(self,  uint64_t pts, int length, uint8_t* data) noexcept nogil:
+        cdef AVPacket* packet = av_packet_alloc()
+        av_new_packet(packet, length)
+        memcpy(packet.data, data, packet.size)
+        self.set_packet_pts(packet, pts)
         return packet
 
+    cdef AVPacket* init_merged_packet(self, uint64_t pts, int length, uint8_t* data) noexcept nogil:
+        """缓存的config和关键帧一次分配合并, 不再grow+memmove"""
+        cdef size_t config_size = self.merger.config_size
+        cdef AVPacket* packet = av_packet_alloc()
+        av_new_packet(packet, config_size + length)
+        memcpy(packet.data, self.merger.config, config_size)
+        memcpy(packet.data + config_size, data, length)
+        free(self.merger.config)
+        self.merger.config = NULL
+        self.set_packet_pts(packet, pts)
+        return packet
+
+    cdef AVPacket* wrap_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil:
+        """只读buffer(bytes等)不复制, 由AVBuffer引用, 释放packet时释放Py_buffer; 可写buffer可能被调用方复用, 复制"""
+        cdef AVPacket* packet
+        if view.readonly:
+            packet = av_packet_alloc()
+            packet.buf = av_buffer_create(<uint8_t *> view.buf, length, release_py_buffer, view, AV_BUFFER_FLAG_READONLY)
+            if packet.buf != NULL:
+                packet.data = <uint8_t *> view.buf
+                packet.size = length
+                self.set_packet_pts(packet, pts)
+                return packet
+            av_packet_free(&packet)
+        packet = self.init_packet(pts, length, <uint8_t *> view.buf)
+        release_py_buffer(view, NULL)
+        return packet
+
+    cdef Py_buffer* get_py_buffer(self, object data, int length) except NULL:
+        cdef Py_buffer *view = <Py_buffer *> malloc(sizeof(Py_buffer))
+        if view == NULL:
+            raise MemoryError()
+        try:
+            PyObject_GetBuffer(data, view, PyBUF_SIMPLE)
+        except:
+            free(view)
+            raise
+        if length < 0 or length > view.len:
+            PyBuffer_Release(view)
+            free(view)
+            raise ValueError(f"length {length} out of buffer size {view.len}")
+        return view
+
     def write_video_header(self, uint64_t pts, int length, uint8_t* data):
         cdef AVPacket* packet
         cdef uint8_t *extradata
@@ -148,53 +201,85 @@ cdef class Recorder(object):
         finally:
             av_packet_free(&packet)
 
-    def write_header(self):
-        return (avformat_write_header(self.container, NULL) >= 0)
+    def write_header(self, dict options=None):
+        """
+        options: muxer参数, 例如fMP4
+        {"movflags": "frag_keyframe+empty_moov+default_base_moof", "frag_duration": "1000000", "flush_packets": "1"}
+        """
+        cdef AVDictionary *av_options = NULL
+        cdef int ret
+        if options:
+            for key, value in options.items():
+                av_dict_set(&av_options, str(key).encode(), str(value).encode(), 0)
+        ret = avformat_write_header(self.container, &av_options)
+        av_dict_free(&av_options)
+        return ret >= 0
 
-    def write_video_packet(self, uint64_t pts, int length, uint8_t* data):
-        cdef AVPacket* packet
-        try:
-            packet = self.init_packet(pts, length, data)
-            if self.pts_origin == AV_NOPTS_VALUE:
-                self.pts_origin = packet.pts
-            # config packet
-            if packet.pts == AV_NOPTS_VALUE:
-                self.packet_merger_merge(packet)
-                return True
-            # data packet
-            else:
-                self.pts_last = packet.pts
-                packet.stream_index = 0
-                packet.pts -= self.pts_origin
-                packet.dts = packet.pts
-                self.packet_merger_merge(packet)
-                if self.previous_video_packet:
-                    self.previous_video_packet.duration = packet.pts- self.previous_video_packet.pts
-                    av_packet_rescale_ts(self.previous_video_packet, RECORD_TIME_BASE, self.container.streams[0].time_base)
-                    if av_interleaved_write_frame(self.container, self.previous_video_packet)<0:
-                        return False
-                    av_packet_free(&self.previous_video_packet)
-                self.previous_video_packet = packet
-                packet = NULL
-                return True
-        finally:
-            av_packet_free(&packet)
+    def tell(self):
+        """当前写入位置(字节), 尚未写出的packet(上一个视频帧、交织缓冲)不计入, 因此不大于下一个packet的实际位置"""
+        return avio_tell(self.container.pb)
 
-    def write_audio_packet(self, uint64_t pts, int length, uint8_t* data):
-        cdef AVPacket* packet 
-        try:
-            packet = self.init_packet(pts, length, data)
-            if self.pts_origin == AV_NOPTS_VALUE:
-                self.pts_origin = packet.pts
-            packet.stream_index = 1
-            packet.pts -= self.pts_origin
-            packet.dts = packet.pts
-            av_packet_rescale_ts(packet, RECORD_TIME_BASE, self.container.streams[1].time_base)
-            return av_interleaved_write_frame(self.container, packet)>=0
-        finally:
-            av_packet_free(&packet)
+    # 以下写入方法在录屏写入线程中调用, libav调用期间释放GIL, 不阻塞其它线程和事件循环
+    # data: 任意buffer protocol对象(bytes、memoryview、bytearray), 只读buffer不复制
+    cdef int _write_video_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil:
+        cdef int ret = 0
+        cdef AVPacket* packet = NULL
+        # config packet, 缓存后与下一个packet合并
+        if SC_PACKET_FLAG_CONFIG & pts:
+            free(self.merger.config)
+            self.merger.config = <uint8_t *> malloc(length)
+            memcpy(self.merger.config, view.buf, length)
+            self.merger.config_size = length
+            release_py_buffer(view, NULL)
+            return 0
+        # data packet
+        if self.merger.config:
+            packet = self.init_merged_packet(pts, length, <uint8_t *> view.buf)
+            release_py_buffer(view, NULL)
+        else:
+            packet = self.wrap_packet(pts, length, view)
+        if self.pts_origin == AV_NOPTS_VALUE:
+            self.pts_origin = packet.pts
+        self.pts_last = packet.pts
+        packet.stream_index = 0
+        packet.pts -= self.pts_origin
+        packet.dts = packet.pts
+        if self.previous_video_packet:
+            self.previous_video_packet.duration = packet.pts- self.previous_video_packet.pts
+            av_packet_rescale_ts(self.previous_video_packet, RECORD_TIME_BASE, self.container.streams[0].time_base)
+            ret = av_interleaved_write_frame(self.container, self.previous_video_packet)
+            av_packet_free(&self.previous_video_packet)
+        self.previous_video_packet = packet
+        return ret
 
-    def close_container(self):
+    def write_video_packet(self, uint64_t pts, int length, data):
+        cdef int ret
+        cdef Py_buffer *view = self.get_py_buffer(data, length)
+        with nogil:
+            ret = self._write_video_packet(pts, length, view)
+        return ret >= 0
+
+    cdef int _write_audio_packet(self, uint64_t pts, int length, Py_buffer *view) noexcept nogil:
+        cdef int ret
+        cdef AVPacket* packet = self.wrap_packet(pts, length, view)
+        if self.pts_origin == AV_NOPTS_VALUE:
+            self.pts_origin = packet.pts
+        packet.stream_index = 1
+        packet.pts -= self.pts_origin
+        packet.dts = packet.pts
+        av_packet_rescale_ts(packet, RECORD_TIME_BASE, self.container.streams[1].time_base)
+        ret = av_interleaved_write_frame(self.container, packet)
+        av_packet_free(&packet)
+        return ret
+
+    def write_audio_packet(self, uint64_t pts, int length, data):
+        cdef int ret
+        cdef Py_buffer *view = self.get_py_buffer(data, length)
+        with nogil:
+            ret = self._write_audio_packet(pts, length, view)
+        return ret >= 0
+
+    cdef int _close_container(self) noexcept nogil:
         cdef int duration
         if self.previous_video_packet:
             self.previous_video_packet.duration = 100000
@@ -210,6 +295,12 @@ cdef class Recorder(object):
         avformat_free_context(self.container)
         self.has_finish = True
         return duration
+
+    def close_container(self):
+        cdef int duration
+        with nogil:
+            duration = self._close_container()
+        return duration
         
     def __dealloc__(self):
         # 1. free codec
@@ -227,3 +318,147 @@ cdef class Recorder(object):
         if self.has_finish == False:
             avio_close(self.container.pb)
             avformat_free_context(self.container)
+
+
+cdef class Concat(object):
+    """
+    多个录屏文件stream copy拼接为一个文件, 不解码, 用于合并同一设备的多个录屏
+    1.第一个输入文件的流参数作为输出文件的流参数, 之后的输入文件流的数量、编码、分辨率、extradata必须一致
+    2.每个输入文件的时间戳从上一个输入文件的结束时间开始
+    """
+    def __cinit__(self, const char *muxer_name, const char *filename, dict options=None):
+        # 1.mark header and finish
+        self.has_header = False
+        self.has_finish = False
+        # 2.muxer参数, 写入文件头时使用
+        self.options = options
+        # 3.下一个输入文件的起始时间(微秒)
+        self.offset = 0
+        # 4.open a container
+        self.container = avformat_alloc_context()
+        cdef void *opaque = NULL
+        while True:
+            oformat = av_muxer_iterate(&opaque)
+            assert oformat
+            if muxer_name in oformat.name:
+                self.container.oformat = <AVOutputFormat *>oformat
+                break
+        avio_open(&self.container.pb, filename, AVIO_FLAG_WRITE)
+        av_dict_set(&self.container.metadata, "comment","Recorded by django_scrcpy", 0)
+
+    @property
+    def duration(self):
+        """已拼接的时长(微秒)"""
+        return self.offset
+
+    cdef bint is_compatible(self, AVFormatContext *input_container):
+        cdef unsigned int i
+        cdef AVCodecParameters *par
+        cdef AVCodecParameters *ref
+        if input_container.nb_streams != self.container.nb_streams:
+            return False
+        for i in range(input_container.nb_streams):
+            par = input_container.streams[i].codecpar
+            ref = self.container.streams[i].codecpar
+            if par.codec_id != ref.codec_id or par.width != ref.width or par.height != ref.height or par.sample_rate != ref.sample_rate:
+                return False
+            if par.extradata_size != ref.extradata_size:
+                return False
+            if par.extradata_size and memcmp(par.extradata, ref.extradata, par.extradata_size) != 0:
+                return False
+        return True
+
+    cdef int _copy_packet(self, AVFormatContext *input_container, AVPacket *packet, int64_t start, int64_t *end) noexcept nogil:
+        """packet的时间戳后移到self.offset并写入, end为已写入packet的最大结束时间(微秒)"""
+        cdef AVRational input_time_base = input_container.streams[packet.stream_index].time_base
+        cdef int64_t shift = av_rescale_q(self.offset - start, RECORD_TIME_BASE, input_time_base)
+        cdef int64_t packet_end
+        if packet.pts != AV_NOPTS_VALUE:
+            packet.pts += shift
+        if packet.dts != AV_NOPTS_VALUE:
+            packet.dts += shift
+            packet_end = av_rescale_q(packet.dts + packet.duration, input_time_base, RECORD_TIME_BASE)
+            if packet_end > end[0]:
+                end[0] = packet_end
+        av_packet_rescale_ts(packet, input_time_base, self.container.streams[packet.stream_index].time_base)
+        packet.pos = -1
+        return av_interleaved_write_frame(self.container, packet)
+
+    def add_input(self, const char *filename):
+        """
+        拼接一个输入文件, 读取和写入期间释放GIL
+        return 输入文件的关键帧[(pts, offset), ...], pts为相对合并文件开头的微秒数, offset同Recorder.tell
+        无法读取或与之前的输入文件不兼容时不拼接, return None
+        """
+        cdef AVFormatContext *input_container = NULL
+        cdef AVPacket *packet = NULL
+        cdef AVStream *stream
+        cdef AVDictionary *av_options = NULL
+        cdef unsigned int i
+        cdef int ret
+        cdef int64_t start
+        cdef int64_t end = self.offset
+        keyframes = []
+        if avformat_open_input(&input_container, filename, NULL, NULL) < 0:
+            return None
+        try:
+            if avformat_find_stream_info(input_container, NULL) < 0:
+                return None
+            # 1.第一个输入文件: 复制流参数并写入文件头
+            if not self.has_header:
+                for i in range(input_container.nb_streams):
+                    stream = avformat_new_stream(self.container, NULL)
+                    avcodec_parameters_copy(stream.codecpar, input_container.streams[i].codecpar)
+                    stream.codecpar.codec_tag = 0
+                    stream.time_base = input_container.streams[i].time_base
+                if self.options:
+                    for key, value in self.options.items():
+                        av_dict_set(&av_options, str(key).encode(), str(value).encode(), 0)
+                ret = avformat_write_header(self.container, &av_options)
+                av_dict_free(&av_options)
+                if ret < 0:
+                    raise IOError(f"write header failed")
+                self.has_header = True
+            elif not self.is_compatible(input_container):
+                return None
+            # 2.stream copy, 输入文件末尾不完整时拼接到最后一个完整的packet
+            start = input_container.start_time if input_container.start_time != AV_NOPTS_VALUE else 0
+            packet = av_packet_alloc()
+            while True:
+                with nogil:
+                    ret = av_read_frame(input_container, packet)
+                if ret < 0:
+                    break
+                if packet.stream_index == 0 and packet.flags & AV_PKT_FLAG_KEY and packet.pts != AV_NOPTS_VALUE:
+                    keyframes.append((av_rescale_q(packet.pts, input_container.streams[0].time_base, RECORD_TIME_BASE) - start + self.offset,
+                                      avio_tell(self.container.pb)))
+                with nogil:
+                    ret = self._copy_packet(input_container, packet, start, &end)
+                if ret < 0:
+                    raise IOError(f"write packet {filename} failed")
+            self.offset = end
+            return keyframes
+        finally:
+            av_packet_free(&packet)
+            avformat_close_input(&input_container)
+
+    cdef int _close_container(self) noexcept nogil:
+        cdef int duration = 0
+        if self.has_header and av_write_trailer(self.container) >= 0:
+            duration = <int> (self.offset / 1000000)
+        avio_close(self.container.pb)
+        avformat_free_context(self.container)
+        self.has_finish = True
+        return duration
+
+    def close_container(self):
+        """return 时长(秒), 没有输入文件或写入失败时为0"""
+        cdef int duration
+        with nogil:
+            duration = self._close_container()
+        return duration
+
+    def __dealloc__(self):
+        if self.has_finish == False:
+            avio_close(self.container.pb)
+            avformat_free_context(self.container)
@@ -13,6 +13,8 @@ from import_export.admin import ExportActionMixin
 from general import forms
 from general import models
 from general import adb
+from asynch.merge import video_filename
+from asynch.recorder import KeyframeIndex
 from django_scrcpy.settings import MEDIA_ROOT
 
 
@@ -99,45 +101,62 @@ class MobileAdmin(ExportActionMixin, admin.ModelAdmin):
         obj.save()
 
 
+class MergedFilter(admin.SimpleListFilter):
+    title = '已合并'
+    parameter_name = 'merged'
+
+    def lookups(self, request, model_admin):
+        return (('0', '否'), ('1', '是'))
+
+    def queryset(self, request, queryset):
+        if self.value() == '0':
+            return queryset.filter(merged_into='')
+        if self.value() == '1':
+            return queryset.exclude(merged_into='')
+        return queryset
+
+
 @admin.register(models.Video)
 class VideoAdmin(ExportActionMixin, admin.ModelAdmin):
     list_per_page = 20
     show_full_result_count = True
-    search_fields = ['device_id']
-    list_filter = ['device_id', 'format', 'start_time', 'finish_time']
-    list_display = ['video_id', 'format', 'device_id', 'name', 'duration', 'size', 'video_play', 'start_time', 'finish_time']
+    search_fields = ['device_id', 'merged_into']
+    list_filter = [MergedFilter, 'device_id', 'format', 'start_time', 'finish_time']
+    list_display = ['video_id', 'format', 'device_id', 'group_id', 'segment_index', 'name', 'duration', 'size', 'video_play', 'start_time', 'finish_time']
 
     def get_readonly_fields(self, request, obj=None):
         if obj:
-            return ['video_id', 'device_id', 'format', 'start_time', 'finish_time', 'config', 'duration']
+            return ['video_id', 'device_id', 'format', 'start_time', 'finish_time', 'config', 'duration', 'group_id', 'segment_index', 'merged_into']
         else:
             return []
 
     def delete_queryset(self, request: HttpRequest, queryset: QuerySet[Any]) -> None:
         for obj in queryset:
-            video_path = os.path.join(MEDIA_ROOT, 'video', f'{obj.video_id}.{obj.format}')
+            video_path = video_filename(obj.device_id, obj.video_id, obj.format)
             try:
                 os.remove(video_path)
             except:
                 pass
+            KeyframeIndex.remove(video_path)
         return super().delete_queryset(request, queryset)
     
     def delete_model(self, request: HttpRequest, obj: Any) -> None:
-        video_path = os.path.join(MEDIA_ROOT, 'video', f'{obj.video_id}.{obj.format}')
+        video_path = video_filename(obj.device_id, obj.video_id, obj.format)
         try:
             os.remove(video_path)
         except:
             pass
+        KeyframeIndex.remove(video_path)
         return super().delete_model(request, obj)
 
     def download(self, obj):
-        download_url = f'/media/video/{obj.video_id}.{obj.format}'
-        download_name = f'{obj.video_id}.{obj.format}'
+        download_name = os.path.basename(video_filename(obj.device_id, obj.video_id, obj.format))
+        download_url = f'/media/video/{download_name}'
         return mark_safe(f'<a href="{download_url}" target="_blank" download="{download_name}">访问</a>')
     download.short_description = '下载'
 
     def video_play(self, obj):
-        filename = f"{obj.video_id}.{obj.format}"
+        filename = os.path.basename(video_filename(obj.device_id, obj.video_id, obj.format))
         video_play_url = reverse("asynch:video-play") + f"?filename={filename}"
         return mark_safe(f'<a href="{video_play_url}" target="_blank">访问</a>')
     video_play.short_description = '播放/下载'
@@ -10,6 +10,15 @@ class MobileForm(forms.ModelForm):
     audio = forms.BooleanField(label="开启声音", help_text="需要安卓版本>=11，安卓版本=11需要提前解锁手机", required=False)
     control = forms.BooleanField(label="开启控制", help_text="可远程控制手机，控制关闭时仅可投屏", required=False)
     recorder_format = forms.ChoiceField(label="录屏格式", choices=RECORDER_FORMAT, required=False)
+    recorder_fragmented = forms.BooleanField(label="边录边播", help_text="mp4录屏使用fMP4格式，录制中即可播放，异常退出时已录制的部分不损坏", required=False)
+    recorder_segment_time = forms.IntegerField(label="录屏分段时长", help_text="秒, 超过后在下一个关键帧切换到新文件, 0为不分段", required=False, min_value=0)
+    recorder_segment_size = forms.IntegerField(label="录屏分段大小", help_text="MB, 超过后在下一个关键帧切换到新文件, 0为不分段", required=False, min_value=0)
+    headless_record = forms.BooleanField(label="后台录屏", help_text="运行manage.py record时, 设备在线即录屏, 无需打开投屏页面", required=False)
+    headless_schedule = forms.CharField(label="后台录屏时间段", help_text="例如09:00-12:00,14:00-18:00, 可跨零点, 为空则全天", required=False)
+    replay_time = forms.IntegerField(label="即时回放时长", help_text="秒, 内存中保留最近的音视频数据, 可随时保存为录屏, 0为不开启", required=False, min_value=0)
+    replay_size = forms.IntegerField(label="即时回放大小", help_text="MB, 即时回放占用内存的上限, 0为不限制", required=False, min_value=0)
+    warm_pool = forms.BooleanField(label="预热", help_text="提前启动scrcpy server，访问屏幕时直接连接，需要设置WARM_POOL_SIZE", required=False)
+    adaptive_enable = forms.BooleanField(label="自适应画质", help_text="网络变差时自动降低码率、分辨率和帧率，恢复后提升，录屏时不生效", required=False)
     video_codec = forms.ChoiceField(label='视频codec', choices=VIDEO_CODEC_CHOICE, required=False)
     video_codec_options = forms.CharField(label='视频codec参数', help_text="若无画面请尝试设置: profile=1,level=2", required=False)
     video_encoder = forms.CharField(label='视频codec_encoder', required=False, help_text="若无画面请尝试以下某一或者手机支持的其他encoder：OMX.google.h264.encoder | OMX.qcom.video.encoder.hevc | c2.android.hevc.encoder | c2.mtk.hevc.encoder")
@@ -0,0 +1,84 @@
+import os
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from asynch.merge import video_filename, plan_merge, merge_videos
+from asynch.recorder import KeyframeIndex
+from asynch.tools.utils import create_scid
+from general.models import Video
+
+
+class Command(BaseCommand):
+    help = "同一设备时间段内编码参数相同的录屏stream copy合并为一个录屏, 多进程并行, 源录屏的merged_into指向合并后的录屏"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='devices', help="device_id, 可多次指定, 默认所有设备")
+        parser.add_argument('--start', type=datetime.datetime.fromisoformat, help="开始时间, 如2024-01-01T00:00")
+        parser.add_argument('--end', type=datetime.datetime.fromisoformat, help="结束时间")
+        parser.add_argument('--max-gap', type=int, default=0, help="相邻录屏间隔超过max_gap秒时分开合并, 0为不限制")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="进程数")
+        parser.add_argument('--dry-run', action='store_true', help="只打印合并计划")
+
+    def get_groups(self, options):
+        queryset = Video.objects.filter(merged_into='').exclude(format='raw').order_by('device_id', 'start_time')
+        if options['devices']:
+            queryset = queryset.filter(device_id__in=options['devices'])
+        if options['start']:
+            queryset = queryset.filter(start_time__gte=options['start'])
+        if options['end']:
+            queryset = queryset.filter(finish_time__lte=options['end'])
+        videos = [video for video in queryset
+                  if os.path.exists(video_filename(video.device_id, video.video_id, video.format))]
+        return plan_merge(videos, options['max_gap'])
+
+    @transaction.atomic
+    def save_video(self, result, video_id, group):
+        """合并后的录屏保存为Video, 拼接的源录屏merged_into指向它"""
+        sources = [video for video in group
+                   if video_filename(video.device_id, video.video_id, video.format) in result['merged']]
+        Video.objects.create(
+            video_id=video_id,
+            device_id=sources[0].device_id,
+            format=sources[0].format,
+            duration=result['duration'],
+            size=int(os.path.getsize(result['output']) / 1024),
+            start_time=sources[0].start_time,
+            finish_time=sources[-1].finish_time,
+            config=sources[0].config,
+            group_id=video_id,
+            details=f"merged from {len(sources)} videos",
+        )
+        Video.objects.filter(video_id__in=[video.video_id for video in sources]).update(merged_into=video_id)
+        return sources
+
+    def handle(self, *args, **options):
+        groups = self.get_groups(options)
+        for group in groups:
+            self.stdout.write(f"{group[0].device_id} {group[0].start_time} ~ {group[-1].finish_time}: {len(group)} videos")
+        if options['dry_run'] or not groups:
+            return
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = dict()
+            for group in groups:
+                video_id = f"merged_{create_scid()}"
+                output = video_filename(group[0].device_id, video_id, group[0].format)
+                filenames = [video_filename(video.device_id, video.video_id, video.format) for video in group]
+                future = executor.submit(merge_videos, output, filenames, group[0].format)
+                futures[future] = (video_id, output, group)
+            for future in as_completed(futures):
+                video_id, output, group = futures[future]
+                try:
+                    result = future.result()
+                    assert result['duration'], 'duration is 0'
+                    sources = self.save_video(result, video_id, group)
+                except Exception as e:
+                    self.stderr.write(f"{output} merge error {type(e)}: {e}")
+                    for path in (output, KeyframeIndex.index_filename(output)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    continue
+                self.stdout.write(f"{output}: merged {len(sources)} videos, skipped {len(result['skipped'])}, "
+                                  f"duration {result['duration']}s, elapsed {result['elapsed']}s")
@@ -0,0 +1,24 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from asynch.headless import HeadlessRecorder
+from django_scrcpy.settings import HEADLESS_MAX_DEVICES
+
+
+class Command(BaseCommand):
+    help = "无浏览器录屏: 录制config中headless_record为true的在线设备, 或--device指定的设备"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='devices', help="录屏的设备device_id, 可多次指定")
+        parser.add_argument('--schedule', default='', help="录屏时间段, 例如09:00-12:00,14:00-18:00, 设备config中的headless_schedule优先")
+        parser.add_argument('--max-devices', type=int, default=HEADLESS_MAX_DEVICES, help="同时录屏的最大设备数")
+        parser.add_argument('--interval', type=int, default=HeadlessRecorder.interval, help="检查设备状态的间隔(秒)")
+
+    def handle(self, *args, **options):
+        recorder = HeadlessRecorder(options['devices'], options['schedule'], options['max_devices'])
+        recorder.interval = options['interval']
+        try:
+            asyncio.run(recorder.run())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,76 @@
+import os
+import json
+import glob
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from asynch.capture import remux_capture
+from asynch.device import DeviceClient
+from asynch.recorder import KeyframeIndex
+from general.models import Video
+from django_scrcpy.settings import MEDIA_ROOT
+
+
+class Command(BaseCommand):
+    help = "原始packet文件(recorder_format为raw)离线转为mp4/mkv, 多进程并行, 有同名.json时保存为录屏"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="原始packet文件, 默认为MEDIA_ROOT/video下所有抓取完成的.raw文件")
+        parser.add_argument('--format', default='mp4', choices=('mp4', 'mkv'), help="输出格式")
+        parser.add_argument('--fragmented', action='store_true', help="mp4使用fMP4格式")
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="进程数")
+        parser.add_argument('--keep', action='store_true', help="转换成功后保留原始packet文件")
+
+    def save_video(self, result, recorder_format):
+        """原始packet文件的.json中有device_id、video_id、config和起止时间"""
+        meta_filename = result['filename'] + '.json'
+        if not os.path.exists(meta_filename):
+            return False
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        Video.objects.create(
+            video_id=meta['video_id'],
+            device_id=meta['device_id'],
+            format=recorder_format,
+            duration=result['duration'],
+            size=int(os.path.getsize(result['output']) / 1024),
+            start_time=datetime.datetime.fromtimestamp(meta['start_time']),
+            finish_time=datetime.datetime.fromtimestamp(meta['finish_time']),
+            config=json.dumps(meta['config']),
+            group_id=meta['video_id'],
+        )
+        return True
+
+    @staticmethod
+    def get_files():
+        """抓取完成的.raw文件, RawCapture关闭时才写入.json, 没有.json或正在抓取的文件跳过"""
+        return [filename for filename in sorted(glob.glob(os.path.join(MEDIA_ROOT, 'video', '*.raw')))
+                if os.path.exists(filename + '.json') and filename not in DeviceClient.recording_files]
+
+    def handle(self, *args, **options):
+        files = options['files'] or self.get_files()
+        recorder_format = options['format']
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(remux_capture, filename, f"{os.path.splitext(filename)[0]}.{recorder_format}",
+                                       recorder_format, options['fragmented']): filename for filename in files}
+            for future in as_completed(futures):
+                filename = futures[future]
+                output = f"{os.path.splitext(filename)[0]}.{recorder_format}"
+                try:
+                    result = future.result()
+                    assert result['duration'], 'duration is 0'
+                    saved = self.save_video(result, recorder_format)
+                except Exception as e:
+                    self.stderr.write(f"{filename} remux error {type(e)}: {e}")
+                    for path in (output, KeyframeIndex.index_filename(output)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    continue
+                # 未保存为Video时保留原始packet文件
+                if saved and not options['keep']:
+                    for path in (filename, filename + '.json'):
+                        if os.path.exists(path):
+                            os.remove(path)
+                self.stdout.write(f"{filename} -> {output}, duration {result['duration']}s, saved: {saved}")
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 17:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('general', '0011_alter_mobile_config_alter_video_config'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mobile',
+            name='config',
+            field=models.TextField(default='{"recorder_enable": false, "recorder_format": "mp4", "recorder_fragmented": false, "recorder_segment_time": 0, "recorder_segment_size": 0, "replay_time": 0, "replay_size": 64, "adaptive_enable": false, "warm_pool": false, "audio": true, "video_codec": "h264", "audio_codec": "aac", "audio_source": "output", "max_size": 720, "video_bit_rate": 800000, "audio_bit_rate": 128000, "max_fps": 25, "tunnel_forward": true, "crop": "", "control": true, "show_touches": false, "stay_awake": true, "video_codec_options": "profile=1,level=2", "audio_codec_options": "", "video_encoder": "", "audio_encoder": "", "power_off_on_close": false, "clipboard_autosync": false, "power_on": true}', help_text='配置视频分辨率，帧率等', verbose_name='配置详情'),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='config',
+            field=models.TextField(default='{"recorder_enable": false, "recorder_format": "mp4", "recorder_fragmented": false, "recorder_segment_time": 0, "recorder_segment_size": 0, "replay_time": 0, "replay_size": 64, "adaptive_enable": false, "warm_pool": false, "audio": true, "video_codec": "h264", "audio_codec": "aac", "audio_source": "output", "max_size": 720, "video_bit_rate": 800000, "audio_bit_rate": 128000, "max_fps": 25, "tunnel_forward": true, "crop": "", "control": true, "show_touches": false, "stay_awake": true, "video_codec_options": "profile=1,level=2", "audio_codec_options": "", "video_encoder": "", "audio_encoder": "", "power_off_on_close": false, "clipboard_autosync": false, "power_on": true}', help_text='配置视频分辨率，帧率等', verbose_name='配置详情'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('general', '0013_alter_mobile_config_alter_video_config'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='merged_into',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=127, verbose_name='合并到'),
+        ),
+    ]
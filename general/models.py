@@ -57,12 +57,29 @@ AUDIO_SOURCE_CHOICE = (
 
 RECORDER_FORMAT = (
     ('mp4', 'mp4'),
-    ('mkv', 'mkv')
+    ('mkv', 'mkv'),
+    # 原始packet, 开销最小, 由manage.py remux离线转为mp4/mkv
+    ('raw', 'raw'),
 )
 
 DEFAULT_SCRCPY_KWARGS = {
     "recorder_enable": False,
     "recorder_format": "mp4",
+    # mp4录屏使用fMP4(empty moov + 每个gop一个moof/mdat), 录制中即可播放, 进程异常退出时已写入的分片仍可播放
+    "recorder_fragmented": False,
+    # 录屏分段, 超过时长(秒)或大小(MB)后在下一个关键帧切换到新文件, 0为不分段
+    "recorder_segment_time": 0,
+    "recorder_segment_size": 0,
+    # 无浏览器录屏(manage.py record), 设备在线且在时间段内时录屏, 时间段如"09:00-12:00,14:00-18:00", 为空则全天
+    "headless_record": False,
+    "headless_schedule": "",
+    # 即时回放, 内存中保留最近的时长(秒), 不超过大小(MB), 可随时保存为录屏, 时长为0不开启
+    "replay_time": 0,
+    "replay_size": 64,
+    # 根据ws_client的网络状况自动切换码率、分辨率和帧率, 录屏时不生效
+    "adaptive_enable": False,
+    # 预热scrcpy server, 访问屏幕时直接连接, 需要设置WARM_POOL_SIZE
+    "warm_pool": False,
     # 1 scrcpy adb-socket-id, 用于手机区分多个启动的scrcpy。每次运行自动生成
     # "scid": -1,
     # 2. scrcpy日志等级
@@ -164,6 +181,11 @@ class Video(models.Model):
     updated_time = models.DateTimeField("更新时间", auto_now=True, db_index=True)
     name = models.CharField('名称', max_length=32, blank=True, null=False)
     details = models.TextField("备注信息", blank=True)
+    # 分段录屏, 同一次录屏的各分段group_id相同
+    group_id = models.CharField("录屏组id", max_length=127, blank=True, null=False, default='', db_index=True)
+    segment_index = models.IntegerField("分段序号", default=0)
+    # manage.py merge合并后, 源录屏的merged_into为合并后录屏的video_id
+    merged_into = models.CharField("合并到", max_length=127, blank=True, null=False, default='', db_index=True)
 
     def __str__(self):
         return self.video_id
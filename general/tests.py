@@ -1,3 +1,771 @@
-from django.test import TestCase
+import os
+import json
+import time
+import uuid
+import struct
+import socket
+import asyncio
+import tempfile
+import datetime
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase
+from django.utils.http import http_date
+
+from asynch.capture import RawCapture, read_capture
+from asynch.constants import sc_control_msg_type, sc_packet_flag
+from asynch.constants.input import android_motionevent_action
+from asynch.control import ControlWriter
+from asynch.device import DeviceController
+from asynch.faststart import ATOM_HEADER, faststart, patch_chunk_offsets, read_atoms
+from asynch.gesture import TOUCH_EVENT, MAX_TRACKS, Gesture
+from asynch.ranges import RECORDING_MTIME, is_recording, parse_range, resolve_ranges, serve_file
+from asynch.recorder import KeyframeIndex, RecorderWriter
+from asynch.serializers import CONTROL_MSG_VAR_LENGTH, split_control_data, utf8_truncate_index
+from asynch.subscriber import HubSubscriber
+from asynch.tools.cache import FRAME_TYPE_CONFIG, FRAME_TYPE_KEY, FRAME_TYPE_DELTA
+from asynch.tools.ring import (RING_RECORD, RING_FRAME_TYPE_PAD, RING_DATA_OFFSET, _OFFSET_RESERVE_POS, _POS,
+                               RingWriter, RingReader, get_ring_name)
+from asynch.tools.utils import FRAME_HEADER, AsyncSocket
+from general.management.commands.remux import Command as RemuxCommand
+from general.models import Video
+
+
+class HubSubscriberTests(SimpleTestCase):
+    """feed是同步调用, 测试期间不让出事件循环, 发送task不会取走队列中的帧"""
+
+    async def test_full_queue_drops_delta_until_keyframe(self):
+        subscriber = HubSubscriber(None, queue_size=3)
+        try:
+            for pts in range(3):
+                subscriber.feed(FRAME_TYPE_DELTA, pts, b'delta')
+            # 1.队列已满, delta帧被丢弃并开始等待关键帧
+            subscriber.feed(FRAME_TYPE_DELTA, 3, b'delta')
+            self.assertTrue(subscriber.wait_keyframe)
+            self.assertEqual(subscriber.dropped_frames, 1)
+            # 2.等待关键帧期间即使队列有空位也丢弃delta帧
+            subscriber.queue.popleft()
+            subscriber.feed(FRAME_TYPE_DELTA, 4, b'delta')
+            self.assertEqual(subscriber.dropped_frames, 2)
+            self.assertEqual(len(subscriber.queue), 2)
+            # 3.关键帧结束等待
+            subscriber.feed(FRAME_TYPE_KEY, 5, b'key')
+            self.assertFalse(subscriber.wait_keyframe)
+            self.assertEqual([item[1] for item in subscriber.queue], [1, 2, 5])
+        finally:
+            await subscriber.close()
+
+    async def test_full_queue_keyframe_evicts_droppable(self):
+        subscriber = HubSubscriber(None, queue_size=3)
+        try:
+            subscriber.feed(FRAME_TYPE_CONFIG, 0, b'config')
+            subscriber.feed(FRAME_TYPE_DELTA, 1, b'delta')
+            subscriber.feed(FRAME_TYPE_DELTA, 2, b'delta')
+            subscriber.feed(FRAME_TYPE_KEY, 3, b'key')
+            # 配置帧保留, 积压的delta帧被丢弃
+            self.assertEqual([item[0] for item in subscriber.queue], [FRAME_TYPE_CONFIG, FRAME_TYPE_KEY])
+            self.assertEqual(subscriber.dropped_frames, 2)
+            self.assertFalse(subscriber.wait_keyframe)
+        finally:
+            await subscriber.close()
+
+
+class FrameDemuxerTests(SimpleTestCase):
+
+    async def test_read_frames(self):
+        # 空packet, 大于初始buffer的packet, frame_meta被拆分到两次发送
+        payloads = [b'a' * 10, b'', b'b' * 0x50000, b'c' * 3]
+        stream_data = b''.join(FRAME_HEADER.pack(pts, len(data)) + data for pts, data in enumerate(payloads))
+        read_sock, write_sock = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=read_sock)
+        async_socket = AsyncSocket(reader=reader, writer=writer)
+        try:
+            async_socket.attach_demuxer(prefix=b'\x00\x00\x00\x03')
+            for idx in range(0, len(stream_data), 7000):
+                write_sock.sendall(stream_data[idx:idx + 7000])
+                await asyncio.sleep(0)
+            for pts, data in enumerate(payloads):
+                self.assertEqual(await async_socket.read_frame(), (pts, b'\x00\x00\x00\x03' + data))
+            write_sock.close()
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await async_socket.read_frame()
+        finally:
+            await async_socket.disconnect()
+            write_sock.close()
+
+
+class RingTests(SimpleTestCase):
+    capacity = 1000
+
+    def setUp(self):
+        self.writer = RingWriter(get_ring_name('test_' + uuid.uuid4().hex[:8]), self.capacity)
+        self.reader = RingReader(self.writer.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_configs(self):
+        self.writer.put_config(0, 1, b'video')
+        self.writer.put_config(1, 2, b'audio')
+        self.writer.put_config(0, 3, b'video2')
+        self.assertEqual(self.reader.read_configs(), [(0, 3, b'video2'), (1, 2, b'audio')])
+
+    def test_pad_record(self):
+        # 第三条记录放不下, 数据区末尾写入填充记录
+        self.writer.write(FRAME_TYPE_KEY, 0, b'k' * 387, key=True)
+        self.writer.write(FRAME_TYPE_DELTA, 1, b'd' * 387)
+        self.assertEqual([record[1] for record in self.reader.read()], [0, 1])
+        pad_offset = self.writer.write_pos
+        self.writer.write(FRAME_TYPE_DELTA, 2, b'e' * 200)
+        self.assertEqual(RING_RECORD.unpack_from(self.writer.buf, RING_DATA_OFFSET + pad_offset)[2], RING_FRAME_TYPE_PAD)
+        self.assertEqual(self.writer.write_pos, self.capacity + RING_RECORD.size + 200)
+        self.assertEqual(self.reader.read(), [(FRAME_TYPE_DELTA, 2, b'e' * 200)])
+        self.assertEqual(self.reader.read_pos, self.writer.write_pos)
+
+    def test_short_tail(self):
+        # 数据区末尾不足一个记录头, 不写填充记录, 读者直接跳过
+        self.writer.write(FRAME_TYPE_KEY, 0, b'k' * (self.capacity - RING_RECORD.size - 5), key=True)
+        self.assertEqual([record[1] for record in self.reader.read()], [0])
+        self.writer.write(FRAME_TYPE_DELTA, 1, b'd' * 10)
+        self.assertEqual(self.reader.read(), [(FRAME_TYPE_DELTA, 1, b'd' * 10)])
+
+    def test_lapped_reader_skips_to_keyframe(self):
+        for pts in range(12):
+            frame_type = FRAME_TYPE_KEY if pts % 4 == 0 else FRAME_TYPE_DELTA
+            self.writer.write(frame_type, pts, bytes([pts]) * 87, key=frame_type == FRAME_TYPE_KEY)
+        # 落后超过一圈, 从最近的关键帧(pts 8)继续
+        self.assertEqual([record[1] for record in self.reader.read()], [8, 9, 10, 11])
+        self.assertEqual(self.reader.skips, 1)
+        self.assertFalse(self.reader.wait_keyframe)
+
+    def test_lapped_reader_waits_keyframe(self):
+        self.writer.write(FRAME_TYPE_KEY, 0, b'k' * 87, key=True)
+        for pts in range(1, 12):
+            self.writer.write(FRAME_TYPE_DELTA, pts, b'd' * 87)
+        # 最近的关键帧也已被覆盖, 丢弃delta帧直到下一个关键帧
+        self.assertEqual(self.reader.read(), [])
+        self.assertTrue(self.reader.wait_keyframe)
+        self.writer.write(FRAME_TYPE_DELTA, 12, b'd' * 87)
+        self.writer.write(FRAME_TYPE_KEY, 13, b'k' * 87, key=True)
+        self.assertEqual([record[1] for record in self.reader.read()], [13])
+
+    def test_reserved_record_is_not_read(self):
+        # 写者已发布reserve_pos但尚未写完记录时, 被覆盖范围内的记录不会返回给读者
+        for pts in range(9):
+            self.writer.write(FRAME_TYPE_KEY if pts == 0 else FRAME_TYPE_DELTA, pts, b'x' * 87, key=pts == 0)
+        _POS.pack_into(self.writer.buf, _OFFSET_RESERVE_POS, self.writer.write_pos + 200)
+        self.assertEqual(self.reader.read(), [])
+        self.assertTrue(self.reader.wait_keyframe)
+
+
+class SplitControlDataTests(SimpleTestCase):
+    touch = struct.pack(">BBqiiHHHii", sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, 2, 0,
+                        540, 1200, 1080, 2400, 1, 1, 1)
+    back = bytes([sc_control_msg_type.SC_CONTROL_MSG_TYPE_BACK_OR_SCREEN_ON, 0])
+
+    @staticmethod
+    def text_msg(buffer):
+        return struct.pack(">BI", sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT, len(buffer)) + buffer
+
+    def test_split(self):
+        text = self.text_msg('hello'.encode())
+        data = self.touch + text + self.back
+        self.assertEqual(split_control_data(data), [
+            (sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, 0, 32),
+            (sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT, 32, 32 + len(text)),
+            (sc_control_msg_type.SC_CONTROL_MSG_TYPE_BACK_OR_SCREEN_ON, 32 + len(text), len(data)),
+        ])
+
+    def test_invalid(self):
+        for data in (self.touch[:-1], self.text_msg(b'hello')[:-1], self.text_msg(b'')[:3], b'\xfe'):
+            with self.assertRaises(ValueError):
+                split_control_data(data)
+
+    def test_long_text(self):
+        # 超过300字节的文本: 浏览器的二进制消息拒绝, 服务端注入的消息不校验长度
+        text = self.text_msg(('中' * 101).encode())
+        with self.assertRaises(ValueError):
+            split_control_data(text)
+        self.assertEqual(split_control_data(text, limit=False),
+                         [(sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT, 0, len(text))])
+
+    def test_utf8_truncate_index(self):
+        buffer = ('中' * 101).encode()
+        max_length = CONTROL_MSG_VAR_LENGTH[sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TEXT][1]
+        self.assertEqual(utf8_truncate_index(buffer, max_length), 300)
+        self.assertEqual(utf8_truncate_index('a中'.encode(), 2), 1)
+        self.assertEqual(utf8_truncate_index(b'abc', 5), 3)
+
+
+def touch_msg(action, touch_id, x=0, y=0):
+    return struct.pack(">BBqiiHHHii", sc_control_msg_type.SC_CONTROL_MSG_TYPE_INJECT_TOUCH_EVENT, action, touch_id,
+                       x, y, 1080, 2400, 0 if action == 1 else 1, 1, 0 if action == 1 else 1)
+
+
+class FakeControlSocket:
+    def __init__(self, error=None):
+        self.writes = []
+        self.error = error
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def write(self, data):
+        await self.gate.wait()
+        if self.error:
+            raise self.error
+        self.writes.append([data[start:end] for _, start, end in split_control_data(data)])
+
+
+class FakeHub:
+    def __init__(self):
+        self.closed = 0
+
+    async def close_ws_clients(self):
+        self.closed += 1
+
+
+class FakeDevice:
+    device_id = 'test'
+    scid = '00000000'
+
+    def __init__(self, control_socket):
+        self.device_lock = asyncio.Lock()
+        self.control_socket = control_socket
+        self.hub = FakeHub()
+
+
+class ControlWriterTests(SimpleTestCase):
+
+    async def test_coalesce_moves(self):
+        device = FakeDevice(FakeControlSocket())
+        writer = ControlWriter(device)
+        try:
+            # 1.第一次写入阻塞, 之后的消息在队列中合并
+            device.control_socket.gate.clear()
+            down = touch_msg(0, 1)
+            await writer.put(down)
+            await asyncio.sleep(0)
+            await writer.put(touch_msg(2, 1, 1, 1) + touch_msg(2, 1, 2, 2))
+            await writer.put(touch_msg(2, 2, 3, 3))
+            # 其它touch_id的move不阻止合并
+            await writer.put(touch_msg(2, 1, 4, 4))
+            # up之后的move不能与up之前的合并
+            await writer.put(touch_msg(1, 1, 4, 4))
+            await writer.put(touch_msg(2, 1, 5, 5))
+            device.control_socket.gate.set()
+            await writer.flush()
+            self.assertEqual(device.control_socket.writes, [
+                [down],
+                [touch_msg(2, 1, 4, 4), touch_msg(2, 2, 3, 3), touch_msg(1, 1, 4, 4), touch_msg(2, 1, 5, 5)],
+            ])
+            self.assertEqual(writer.coalesced_msgs, 2)
+            self.assertEqual(writer.written_msgs, 5)
+            self.assertEqual(writer.written_batches, 2)
+        finally:
+            await writer.close()
+
+    async def test_write_error_closes_session(self):
+        device = FakeDevice(FakeControlSocket(error=ConnectionResetError('reset')))
+        writer = ControlWriter(device)
+        try:
+            with self.assertLogs(level='ERROR'):
+                await writer.put(touch_msg(0, 1) + touch_msg(1, 1))
+                await writer.flush()
+            self.assertEqual(writer.lost_msgs, 2)
+            self.assertEqual(writer.written_msgs, 0)
+            self.assertEqual(device.hub.closed, 1)
+            with self.assertRaises(ConnectionError):
+                await writer.put(touch_msg(0, 1))
+        finally:
+            await writer.close()
+
+    async def test_closed_socket_is_not_counted_as_written(self):
+        device = FakeDevice(None)
+        writer = ControlWriter(device)
+        try:
+            with self.assertLogs(level='ERROR'):
+                await writer.put(touch_msg(0, 1))
+                await writer.flush()
+            self.assertEqual((writer.lost_msgs, writer.written_msgs), (1, 0))
+            self.assertIsInstance(writer.error, ConnectionError)
+        finally:
+            await writer.close()
+
+
+def touch_events(data):
+    """return [(action, touch_id, x, y), ...]"""
+    return [TOUCH_EVENT.unpack_from(data, idx)[1:5] for idx in range(0, len(data), TOUCH_EVENT.size)]
+
+
+class GestureTests(SimpleTestCase):
+    resolution = (1080, 2400)
+
+    def test_line(self):
+        gesture = Gesture(self.resolution, tick=0.01).line((0, 0), (100, 200), 0.05, touch_id=3)
+        events = [touch_events(frame) for frame in gesture.build()]
+        self.assertEqual(len(events), 6)
+        self.assertEqual(events[0], [(android_motionevent_action.AMOTION_EVENT_ACTION_DOWN, 3, 0, 0)])
+        self.assertEqual(events[1], [(android_motionevent_action.AMOTION_EVENT_ACTION_MOVE, 3, 20, 40)])
+        self.assertEqual(events[-1], [(android_motionevent_action.AMOTION_EVENT_ACTION_MOVE, 3, 100, 200),
+                                      (android_motionevent_action.AMOTION_EVENT_ACTION_UP, 3, 100, 200)])
+
+    def test_pinch_and_delay(self):
+        gesture = Gesture(self.resolution, tick=0.01).pinch((500, 500), 100, 300, 0.02, touch_ids=(1, 2), delay=0.01)
+        frames = gesture.build()
+        self.assertEqual(frames[0], b'')
+        self.assertEqual([event[1:] for event in touch_events(frames[1])], [(1, 450, 500), (2, 550, 500)])
+        self.assertEqual([event[1:] for event in touch_events(frames[3])[::2]], [(1, 350, 500), (2, 650, 500)])
+
+    def test_coordinates_clamped_to_resolution(self):
+        frames = Gesture(self.resolution).line((-10, 100), (2000, 3000), 0.01).build()
+        self.assertEqual(touch_events(frames[0])[0][2:], (0, 100))
+        self.assertEqual(touch_events(frames[-1])[-1][2:], (1080, 2400))
+
+    def test_from_dict(self):
+        data = json.loads('{"tick": 0.01, "tracks": [{"type": "path", "points": [[0, 0], [10, 0], [10, 10]], '
+                          '"duration": 0.04, "touch_id": 5}]}')
+        frames = Gesture.from_dict(data, self.resolution).build()
+        self.assertEqual([event[2:] for frame in frames for event in touch_events(frame)],
+                         [(0, 0), (5, 0), (10, 0), (10, 5), (10, 10), (10, 10)])
+
+    def test_from_dict_invalid(self):
+        line = {'type': 'line', 'start': [0, 0], 'end': [10, 10], 'duration': 0.1}
+        invalid_tracks = [
+            dict(line, type='add_track'),
+            dict(line, touch_id='a'),
+            dict(line, touch_id=1 << 64),
+            dict(line, touch_id=True),
+            dict(line, start=[float('nan'), 0]),
+            dict(line, end=[0, float('inf')]),
+            dict(line, end=[0]),
+            dict(line, duration=float('nan')),
+            dict(line, duration=3600),
+            dict(line, unknown=1),
+            {'type': 'pinch', 'center': [0, 0], 'start_distance': 1, 'end_distance': 2, 'duration': 0.1, 'touch_ids': [1]},
+            {'type': 'path', 'points': [[0, 0]] * 1000, 'duration': 0.1},
+        ]
+        for track in invalid_tracks:
+            with self.subTest(track=track), self.assertRaises(ValueError):
+                Gesture.from_dict(json.loads(json.dumps({'tracks': [track]})), self.resolution).build()
+        for data in ({'tracks': {}}, {}, {'tick': 'nan', 'tracks': []}, {'tracks': [line] * (MAX_TRACKS + 1)}):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                Gesture.from_dict(data, self.resolution)
+
+    async def test_cancel_sends_up(self):
+        class Controller:
+            def __init__(self):
+                self.events = []
+
+            async def inject(self, data):
+                self.events.extend(touch_events(data))
+
+        controller = Controller()
+        gesture = Gesture(self.resolution, tick=0.01).line((0, 0), (100, 0), 1, touch_id=7)
+        task = asyncio.create_task(gesture.play(controller))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(controller.events[-1][:2], (android_motionevent_action.AMOTION_EVENT_ACTION_UP, 7))
+        self.assertLess(controller.events[-1][2], 100)
+
+
+class SwipeTests(SimpleTestCase):
+    """swipe的move事件数与原实现一致: 每unit像素一次"""
+
+    class Controller(DeviceController):
+        async def play_gesture(self, gesture):
+            return gesture
+
+    async def swipe_moves(self, *args, **kwargs):
+        gesture = await self.Controller(None).swipe(*args, **kwargs)
+        return sum(event[0] == android_motionevent_action.AMOTION_EVENT_ACTION_MOVE
+                   for frame in gesture.build() for event in touch_events(frame))
+
+    async def test_steps(self):
+        self.assertEqual(await self.swipe_moves(100, 100, 1000, 2000, (1080, 2400)), 380)
+        self.assertEqual(await self.swipe_moves(100, 100, 100, 100, (1080, 2400)), 1)
+
+    async def test_non_positive_unit_and_delay(self):
+        self.assertEqual(await self.swipe_moves(0, 0, 10, 0, (1080, 2400), unit=0), 10)
+        self.assertEqual(await self.swipe_moves(0, 0, 10, 0, (1080, 2400), unit=-5, delay=-1), 10)
+
+
+class FakeRecorder:
+    """Recorder接口, gate未set时写入阻塞"""
+    start_time = finish_time = 0
+
+    def __init__(self, error=None):
+        self.packets = []
+        self.error = error
+        self.gate = threading.Event()
+        self.gate.set()
+        self.writing = threading.Event()
+        self.offset = 0
+
+    def write_video_packet(self, pts, length, data):
+        self.writing.set()
+        self.gate.wait()
+        if self.error:
+            raise self.error
+        self.packets.append(pts)
+        self.offset += length
+        return True
+
+    write_audio_packet = write_video_packet
+
+    def tell(self):
+        return self.offset
+
+    def close_container(self):
+        return 1
+
+
+class RecorderWriterTests(SimpleTestCase):
+    key = sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME
+    config = sc_packet_flag.SC_PACKET_FLAG_CONFIG
+
+    async def test_full_queue(self):
+        recorder = FakeRecorder()
+        recorder.gate.clear()
+        writer = RecorderWriter(recorder, 'test', '00000000', queue_size=2)
+        # 1.写入线程阻塞在第一个关键帧, 队列满后delta帧被丢弃直到下一个关键帧
+        writer.write(self.key | 0, b'k')
+        await asyncio.to_thread(recorder.writing.wait)
+        for pts in (1, 2, 3, 4):
+            writer.write(pts, b'd')
+        self.assertTrue(writer.wait_keyframe)
+        self.assertEqual(writer.dropped_packets, 2)
+        # 2.配置帧不丢弃, 也不在事件循环中等待, 丢弃积压的packet后入队
+        writer.write(self.config | 5, b'c')
+        self.assertEqual(writer.dropped_packets, 4)
+        writer.write(6, b'd')
+        writer.write(self.key | 7, b'k')
+        self.assertFalse(writer.wait_keyframe)
+        self.assertEqual(writer.dropped_packets, 5)
+        recorder.gate.set()
+        self.assertEqual(await writer.close(), 1)
+        self.assertEqual(recorder.packets, [self.key | 0, self.config | 5, self.key | 7])
+        self.assertEqual(writer.written_packets, 3)
+
+    async def test_write_error(self):
+        recorder = FakeRecorder(error=OSError('disk full'))
+        writer = RecorderWriter(recorder, 'test', '00000000')
+        with self.assertLogs(level='ERROR'):
+            writer.write(self.key | 0, b'k')
+            writer.write(1, b'd')
+            duration = await writer.close()
+        # 写入失败后不再写入, 时长为0
+        self.assertEqual(duration, 0)
+        self.assertIsInstance(writer.error, OSError)
+        self.assertEqual(writer.written_packets, 0)
+
+
+class KeyframeIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'device_video.mp4')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookup(self):
+        index = KeyframeIndex.create(self.filename)
+        for pts, offset in ((0, 48), (1000000, 5000), (2000000, 9000)):
+            index.add(pts, offset)
+        index.close()
+        index = KeyframeIndex.load(self.filename)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.lookup(0), {'timestamp': 0, 'start': 48, 'end': 4999})
+        self.assertEqual(index.lookup(1.5), {'timestamp': 1, 'start': 5000, 'end': 8999})
+        self.assertEqual(index.lookup(1), {'timestamp': 1, 'start': 5000, 'end': 8999})
+        # 最后一个gop到文件末尾, 负数时间按第一个关键帧
+        self.assertEqual(index.lookup(100), {'timestamp': 2, 'start': 9000, 'end': None})
+        self.assertEqual(index.lookup(-1)['start'], 48)
+        self.assertIsNone(KeyframeIndex(index.filename).lookup(0))
+
+    def test_load_partial_entry(self):
+        # 录制中的文件可能只写入了半条
+        index = KeyframeIndex.create(self.filename)
+        index.add(0, 48)
+        index.file.write(b'\x01' * 12)
+        index.close()
+        self.assertEqual(len(KeyframeIndex.load(self.filename)), 1)
+
+    def test_remove(self):
+        KeyframeIndex.create(self.filename).close()
+        KeyframeIndex.remove(self.filename)
+        KeyframeIndex.remove(self.filename)
+        self.assertFalse(os.path.exists(KeyframeIndex.index_filename(self.filename)))
+
+
+class RawCaptureTests(SimpleTestCase):
+    info = {'video_encode': 'h264', 'width': 1920, 'height': 1080, 'audio_encoder': 'opus'}
+    video_header = (sc_packet_flag.SC_PACKET_FLAG_CONFIG, b'video config')
+    audio_header = (sc_packet_flag.SC_PACKET_FLAG_CONFIG, b'audio config')
+    packets = [
+        ('video', sc_packet_flag.SC_PACKET_FLAG_KEY_FRAME | 1000000, b'k' * 100),
+        ('audio', 1000000, b'a' * 10),
+        ('video', 3000000, b'd' * 50),
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'device_video.raw')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def capture(self, use_mmap):
+        capture = RawCapture(self.filename, self.info, self.video_header, self.audio_header, use_mmap=use_mmap,
+                             meta={'video_id': 'video'})
+        for typ, pts, data in self.packets:
+            getattr(capture, f'write_{typ}_packet')(pts, len(data), data)
+        return capture
+
+    def assert_capture(self):
+        video_audio_info, video_header, audio_header, packets = read_capture(self.filename)
+        self.assertEqual(video_audio_info, self.info)
+        self.assertEqual((video_header, audio_header), (self.video_header, self.audio_header))
+        self.assertEqual(list(packets), self.packets)
+        with open(self.filename + '.json') as f:
+            meta = json.load(f)
+        self.assertEqual((meta['video_id'], meta['duration']), ('video', 2))
+
+    def test_buffered(self):
+        capture = self.capture(False)
+        # 关闭前不写入.json, remux不会处理正在抓取的文件
+        self.assertFalse(os.path.exists(self.filename + '.json'))
+        with self.assertLogs(level='INFO'):
+            self.assertEqual(capture.close_container(), 2)
+        self.assertEqual(os.path.getsize(self.filename), capture.tell())
+        self.assert_capture()
+
+    def test_mmap_grow_and_truncate(self):
+        with mock.patch('asynch.capture.CAPTURE_MMAP_CHUNK', 64):
+            capture = self.capture(True)
+            with self.assertLogs(level='INFO'):
+                capture.close_container()
+        self.assertEqual(os.path.getsize(self.filename), capture.tell())
+        self.assert_capture()
+
+    def test_incomplete_record(self):
+        capture = self.capture(False)
+        with self.assertLogs(level='INFO'):
+            capture.close_container()
+        with open(self.filename, 'r+b') as f:
+            f.truncate(capture.tell() - 1)
+        self.assertEqual(list(read_capture(self.filename)[3]), self.packets[:-1])
+
+    async def test_recorder_writer(self):
+        # 由RecorderWriter的写入线程写入
+        capture = RawCapture(self.filename, self.info, self.video_header, meta={'video_id': 'video'})
+        writer = RecorderWriter(capture, 'test', '00000000')
+        for typ, pts, data in self.packets:
+            writer.write(pts, data, typ)
+        with self.assertLogs(level='INFO'):
+            self.assertEqual(await writer.close(), 2)
+        self.assertEqual(list(read_capture(self.filename)[3]), self.packets)
+
+    def test_remux_skips_unfinished(self):
+        video_dir = os.path.join(self.tmp_dir.name, 'video')
+        os.mkdir(video_dir)
+        files = [os.path.join(video_dir, f'device_{name}.raw') for name in ('done', 'writing', 'recording')]
+        for filename in files:
+            open(filename, 'wb').close()
+        for filename in (files[0], files[2]):
+            open(filename + '.json', 'w').close()
+        with mock.patch('general.management.commands.remux.MEDIA_ROOT', self.tmp_dir.name), \
+                mock.patch('asynch.device.DeviceClient.recording_files', {files[2]}):
+            self.assertEqual(RemuxCommand.get_files(), [files[0]])
+
+
+def atom(atom_type, payload):
+    return ATOM_HEADER.pack(ATOM_HEADER.size + len(payload), atom_type) + payload
+
+
+class FaststartTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'device_video.mp4')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build_mp4(self):
+        """ftyp, free, mdat(3个chunk), moov: trak1用stco, trak2用co64, return chunk数据"""
+        ftyp = atom(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isom')
+        free = atom(b'free', b'\x00' * 8)
+        chunks = [b'chunk0', b'chunk1', b'chunk2']
+        mdat_offset = len(ftyp) + len(free)
+        offsets = [mdat_offset + ATOM_HEADER.size + idx * 6 for idx in range(3)]
+        stco = atom(b'stco', struct.pack('>II', 0, 2) + struct.pack('>2I', *offsets[:2]))
+        co64 = atom(b'co64', struct.pack('>II', 0, 1) + struct.pack('>Q', offsets[2]))
+        traks = b''
+        for table in (stco, co64):
+            box = atom(b'stbl', table)
+            for container in (b'minf', b'mdia', b'trak'):
+                box = atom(container, box)
+            traks += box
+        with open(self.filename, 'wb') as f:
+            f.write(ftyp + free + atom(b'mdat', b''.join(chunks)) + atom(b'moov', traks))
+        index = KeyframeIndex.create(self.filename)
+        index.add(0, offsets[0])
+        index.close()
+        os.utime(self.filename, (1000000000, 1000000000))
+        return chunks
+
+    def chunk_offsets(self):
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        stco = data.index(b'stco') - 4
+        co64 = data.index(b'co64') - 4
+        return list(struct.unpack_from('>2I', data, stco + 16)) + list(struct.unpack_from('>Q', data, co64 + 16)), data
+
+    def test_faststart(self):
+        chunks = self.build_mp4()
+        size = os.path.getsize(self.filename)
+        result = faststart(self.filename)
+        self.assertEqual([atom_type for atom_type, _, _ in read_atoms(self.filename)], [b'ftyp', b'moov', b'free', b'mdat'])
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.assertEqual(os.stat(self.filename).st_mtime, 1000000000)
+        # stco/co64和关键帧索引的偏移仍指向原来的chunk
+        offsets, data = self.chunk_offsets()
+        self.assertEqual([data[offset:offset + 6] for offset in offsets], chunks)
+        self.assertEqual(KeyframeIndex.load(self.filename).entries[1], offsets[0])
+        self.assertLess(result['estimated_ttff_after'], result['estimated_ttff_before'])
+        # moov已在mdat之前
+        self.assertIsNone(faststart(self.filename))
+
+    def test_stco_overflow(self):
+        moov = bytearray(atom(b'stco', struct.pack('>III', 0, 1, 0xfffffff0)))
+        with self.assertRaises(ValueError):
+            patch_chunk_offsets(moov, 0x100)
+
+    def test_invalid_atom(self):
+        moov = bytearray(ATOM_HEADER.pack(100, b'stco') + b'\x00' * 8)
+        with self.assertRaises(ValueError):
+            patch_chunk_offsets(moov, 0x100)
+
+
+class RangeParseTests(SimpleTestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-499, 1000-,-500'), [(0, 499), (1000, None), (None, 500)])
+        self.assertEqual(parse_range('Bytes = 5-5'), [(5, 5)])
+        for header in ('', 'bytes=', 'items=0-1', 'bytes=-', 'bytes=5-1', 'bytes=a-1', 'bytes=0-1,' + ','.join(['0-1'] * 16)):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header))
+
+    def test_resolve_ranges(self):
+        self.assertEqual(resolve_ranges([(0, 99), (50, 199), (200, 299)], 1000), [(0, 299)])
+        self.assertEqual(resolve_ranges([(900, None), (None, 50), (0, 9)], 1000), [(0, 9), (900, 999)])
+        self.assertEqual(resolve_ranges([(None, 2000)], 1000), [(0, 999)])
+        # 不可满足的range
+        self.assertEqual(resolve_ranges([(1000, None), (None, 0)], 1000), [])
+
+
+class ServeFileTests(SimpleTestCase):
+    data = bytes(range(256)) * 40
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, 'device_video.mp4')
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        self.factory = AsyncRequestFactory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def serve(self, recording=False, **headers):
+        resp = await serve_file(self.factory.get('/', headers=headers), self.filename, recording=recording)
+        body = b''
+        if resp.streaming:
+            async for chunk in resp.streaming_content:
+                body += chunk
+        else:
+            body = resp.content
+        return resp, body
+
+    async def test_full(self):
+        resp, body = await self.serve()
+        self.assertEqual((resp.status_code, body, resp['Content-Length']), (200, self.data, str(len(self.data))))
+        self.assertEqual(resp['Content-Type'], 'video/mp4')
+        self.assertIn('ETag', resp)
+
+    async def test_single_range(self):
+        resp, body = await self.serve(range='bytes=-100')
+        self.assertEqual((resp.status_code, body), (206, self.data[-100:]))
+        self.assertEqual(resp['Content-Range'], f'bytes {len(self.data) - 100}-{len(self.data) - 1}/{len(self.data)}')
+
+    async def test_multiple_ranges(self):
+        resp, body = await self.serve(range='bytes=0-9,20-29')
+        self.assertEqual(resp.status_code, 206)
+        self.assertTrue(resp['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(resp['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 0-9/10240\r\n\r\n' + self.data[:10], body)
+        self.assertIn(b'Content-Range: bytes 20-29/10240\r\n\r\n' + self.data[20:30], body)
+
+    async def test_unsatisfiable(self):
+        resp, _ = await self.serve(range='bytes=20000-')
+        self.assertEqual((resp.status_code, resp['Content-Range']), (416, 'bytes */10240'))
+
+    async def test_conditional(self):
+        resp, _ = await self.serve()
+        etag, last_modified = resp['ETag'], resp['Last-Modified']
+        self.assertEqual((await self.serve(if_none_match=etag))[0].status_code, 304)
+        self.assertEqual((await self.serve(if_none_match='"other", ' + etag))[0].status_code, 304)
+        self.assertEqual((await self.serve(if_modified_since=last_modified))[0].status_code, 304)
+        self.assertEqual((await self.serve(if_none_match='"other"', if_modified_since=last_modified))[0].status_code, 200)
+
+    async def test_if_range(self):
+        resp, _ = await self.serve()
+        etag, last_modified = resp['ETag'], resp['Last-Modified']
+        self.assertEqual((await self.serve(range='bytes=0-9', if_range=etag))[0].status_code, 206)
+        self.assertEqual((await self.serve(range='bytes=0-9', if_range=last_modified))[0].status_code, 206)
+        # If-Range不匹配时忽略Range返回整个文件
+        self.assertEqual((await self.serve(range='bytes=0-9', if_range='"other"'))[0].status_code, 200)
+        self.assertEqual((await self.serve(range='bytes=0-9', if_range=http_date(0)))[0].status_code, 200)
+        self.assertEqual((await self.serve(range='bytes=0-9', if_range='W/' + etag))[0].status_code, 200)
+
+    async def test_recording(self):
+        # 正在录制的文件不返回校验信息, 总大小未知
+        resp, body = await self.serve(recording=True, range='bytes=0-9')
+        self.assertEqual((resp.status_code, body, resp['Content-Range']), (206, self.data[:10], 'bytes 0-9/*'))
+        self.assertNotIn('ETag', resp)
+
+
+class IsRecordingTests(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_file(self, name, mtime=None):
+        filename = os.path.join(self.tmp_dir.name, name)
+        open(filename, 'wb').close()
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    async def test_is_recording(self):
+        now = datetime.datetime.now()
+        await Video.objects.acreate(video_id='video_1', device_id='device_a', format='mp4', duration=1, size=1,
+                                    start_time=now, finish_time=now)
+        finished = self.create_file('device_a_video_1.mp4')
+        other_worker = self.create_file('device_b_video_2.mp4')
+        stale = self.create_file('device_b_video_3.mp4', time.time() - RECORDING_MTIME - 1)
+        local = self.create_file('device_b_video_4.mp4', time.time() - RECORDING_MTIME - 1)
+        with mock.patch('asynch.device.DeviceClient.recording_files', {local}):
+            # 刚录制完成的文件有Video, 不按修改时间判断
+            self.assertFalse(await is_recording(finished))
+            self.assertTrue(await is_recording(other_worker))
+            self.assertFalse(await is_recording(stale))
+            self.assertTrue(await is_recording(local))
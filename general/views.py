@@ -1,14 +1,11 @@
-import re
 import pytz
 import base64
 import os.path
 import datetime
-import mimetypes
-from wsgiref.util import FileWrapper
 
 from django.urls import reverse
 from django.shortcuts import render
-from django.http import StreamingHttpResponse
+from django.http import StreamingHttpResponse, HttpResponseRedirect
 from django.core.files.base import ContentFile
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -21,7 +18,9 @@ from general import models
 from general import pagination
 from general import serializers
 from general import permissions
-from django_scrcpy.settings import TIME_ZONE, MEDIA_ROOT
+from asynch.merge import video_filename
+from asynch.recorder import KeyframeIndex
+from django_scrcpy.settings import TIME_ZONE
 
 
 class MobileModelViewSet(ReadOnlyModelViewSet):
@@ -143,51 +142,43 @@ class VideoModelViewSet(ModelViewSet):
     serializer_class = serializers.VideoModelSerializer
     permission_classes = (permissions.GeneralPermission,)
 
-    @classmethod
-    def file_iterator(cls, file_name, chunk_size=8192, offset=0, length=None):
-        with open(file_name, "rb") as f:
-            f.seek(offset, os.SEEK_SET)
-            remaining = length
-            while True:
-                bytes_length = chunk_size if remaining is None else min(remaining, chunk_size)
-                data = f.read(bytes_length)
-                if not data:
-                    break
-                if remaining:
-                    remaining -= len(data)
-                yield data
-
     @action(methods=['get'], detail=True, url_path='stream')
     def stream(self, request, *args, **kwargs):
+        """重定向到asynch的异步接口, 流式响应不占用同步线程"""
+        obj = self.get_object()
+        url = reverse("asynch:video-id-stream", kwargs={"video_id": obj.video_id})
+        query_string = request.META.get('QUERY_STRING')
+        return HttpResponseRedirect(f"{url}?{query_string}" if query_string else url)
+
+    @action(methods=['get'], detail=True, url_path='seek')
+    def seek(self, request, *args, **kwargs):
+        """
+        t(秒)所在gop的字节范围, 播放器可直接用Range请求stream
+        return {'timestamp': 关键帧的时间(秒), 'start': 起始字节, 'end': 结束字节(含), 'size': 文件大小}
+        """
         obj = self.get_object()
-        video_path = os.path.join(MEDIA_ROOT, "video", f"{obj.video_id}.{obj.format}")
-        range_header = request._request.META.get('HTTP_RANGE', '').strip()
-        range_re = re.compile(r'bytes\s*=\s*(\d+)\s*-\s*(\d*)', re.I)
-        range_match = range_re.match(range_header)
+        video_path = video_filename(obj.device_id, obj.video_id, obj.format)
+        try:
+            timestamp = float(request.query_params.get('t', 0))
+            index = KeyframeIndex.load(video_path)
+        except ValueError:
+            return Response({'detail': 'invalid t'}, status=400)
+        except FileNotFoundError:
+            return Response({'detail': 'keyframe index not found'}, status=404)
+        result = index.lookup(timestamp)
+        if result is None:
+            return Response({'detail': 'no keyframe'}, status=404)
         size = os.path.getsize(video_path)
-        content_type, encoding = mimetypes.guess_type(video_path)
-        content_type = content_type or 'application/octet-stream'
-        if range_match:
-            first_byte, last_byte = range_match.groups()
-            first_byte = int(first_byte) if first_byte else 0
-            last_byte = first_byte + 1024 * 1024 * 8  # 8M 每片,响应体最大体积
-            if last_byte >= size:
-                last_byte = size - 1
-            length = last_byte - first_byte + 1
-            resp = StreamingHttpResponse(self.file_iterator(video_path, offset=first_byte, length=length), status=206, content_type=content_type)
-            resp['Content-Length'] = str(length)
-            resp['Content-Range'] = 'bytes %s-%s/%s' % (first_byte, last_byte, size)
-        else:
-            resp = StreamingHttpResponse(FileWrapper(open(video_path, 'rb')), content_type=content_type)
-            resp['Content-Length'] = str(size)
-        resp['Accept-Ranges'] = 'bytes'
-        return resp
+        if result['end'] is None or result['end'] >= size:
+            result['end'] = size - 1
+        result['size'] = size
+        return Response(result)
 
     @action(methods=['get'], detail=True, url_path='play')
     def play(self, request, *args, **kwargs):
         obj = self.get_object()
-        play_url = reverse("video-stream", kwargs={"video_id": obj.video_id, "version": "v1"})
-        kwargs = {"filename": f"{obj.video_id}.{obj.format}", "play_url": play_url}
+        play_url = reverse("asynch:video-id-stream", kwargs={"video_id": obj.video_id})
+        kwargs = {"filename": os.path.basename(video_filename(obj.device_id, obj.video_id, obj.format)), "play_url": play_url}
         return render(request, "general/video_play.html", kwargs)
 
 